@@ -0,0 +1,205 @@
+"""
+pandastim/benchmarks/buddy_throughput.py
+
+how many stimuli per second a StimulusBuddy takes in, and the latency from send to queue
+insertion, over tcp loopback, ipc and inproc
+
+a producer (a second process for tcp/ipc, a thread for inproc since it has to share the zmq
+context) sends realistic "stim" messages at each rate into a real StimulusBuddy listening on
+the comms hub, no window is opened. reported per endpoint and rate:
+
+    sent/queued   messages sent and stimuli that made it into the queue (past the hwm zmq
+                  drops them)
+    stim/s        queued stimuli over the time from first to last insertion
+    p50/p99/max   send -> queue insertion in ms (both ends on the same monotonic clock)
+    cpu %         buddy process and producer cpu time over the run's wall time
+
+    python buddy_throughput.py [seconds_per_rate] [texture_size]
+
+rates are stimuli/s, 0 sends as fast as the producer can. the texture size sets how much
+texture creation is in the path, keep it small to measure the comms side
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import multiprocessing as mp
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import zmq
+
+from pandastim import utils
+from pandastim.buddies.stimulus_buddies import StimulusBuddy, StimulusQueue
+
+endpoints = {
+    "tcp": ("tcp://127.0.0.1:", "5950"),
+    "ipc": ("ipc:///tmp/pandastim_throughput_", "5951"),
+    "inproc": ("inproc://pandastim_throughput_", "5952"),
+}
+rates = (100, 1000, 5000, 0)
+default_params_path = Path(__file__).parents[1].joinpath(
+    "resources", "params", "default_params.json"
+)
+
+
+def stim_message(i, texture_size):
+    return {
+        "stimulus": {
+            "stim_name": "wholefield_forward",
+            "angle": (i * 15) % 360,
+            "velocity": 0.05,
+            "stationary_time": 5,
+            "duration": 20,
+        },
+        "texture": {
+            "texture_size": (texture_size, texture_size),
+            "texture_name": "grating_gray",
+            "frequency": 32,
+        },
+        "id": i,
+    }
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def produce(address, rate, seconds, texture_size, results, context=None):
+    """
+    binds a PUB and sends stim messages at rate for seconds, sent times go into results
+    """
+    context = context or zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind(address)
+    time.sleep(0.5)  # subscriber reconnect, zmq slow joiner
+
+    count = int(rate * seconds) if rate else None
+    sent_ns = []
+    cpu_start, start = cpu_seconds(), time.perf_counter()
+    i = 0
+    while (count is None and time.perf_counter() - start < seconds) or (
+        count is not None and i < count
+    ):
+        if rate:
+            # absolute deadlines so a slow send doesn't lower the rate
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        payload = utils.encode_message("stim", stim_message(i, texture_size))
+        sent_ns.append(time.monotonic_ns())
+        socket.send_multipart([b"stim", payload])
+        i += 1
+    cpu = cpu_seconds() - cpu_start
+
+    time.sleep(0.5)  # let the buddy catch up before the socket goes
+    socket.close(linger=0)
+    results.send((sent_ns, cpu, time.perf_counter() - start))
+
+
+class ThroughputBuddy(StimulusBuddy):
+    """
+    stamps every queue insertion and drops the stimulus right after, so the queue (and its
+    textures) doesn't grow over the run
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._queue = StampedQueue(self.tracer)
+
+
+class StampedQueue(StimulusQueue):
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+        self.queued_ns = {}  # stimulus id -> insertion time
+
+    def append(self, item, priority=StimulusQueue.NORMAL):
+        super().append(item, priority)
+        queued_ns = time.monotonic_ns()
+        stim_id = self.tracer.lookup(item)
+        self.tracer.finish(item)
+        self.queued_ns[stim_id] = queued_ns
+        self.clear()
+
+
+def run(name, rate, seconds, texture_size):
+    ip, port = endpoints[name]
+    buddy = ThroughputBuddy(
+        outputMethod="print",
+        receipts=False,
+        console=False,
+        default_params_path=default_params_path,
+        pstim_comms={"port": port, "ip": ip},
+    )
+    receiving, results = mp.Pipe(duplex=False)
+    args = (ip + port, rate, seconds, texture_size, results)
+    if name == "inproc":
+        producer = threading.Thread(
+            target=produce, args=args, kwargs={"context": buddy.context}
+        )
+    else:
+        # spawned, not forked, the comms hub thread is already running
+        producer = mp.get_context("spawn").Process(target=produce, args=args)
+
+    cpu_start, start = cpu_seconds(), time.perf_counter()
+    producer.start()
+    # a producer that dies never sends its results, don't wait on it forever
+    deadline = start + seconds + 30
+    while not receiving.poll(0.5):
+        if not producer.is_alive() or time.perf_counter() > deadline:
+            if receiving.poll(0):
+                break
+            buddy.wrap_up()
+            raise RuntimeError(f"{name} producer at {rate}/s died without results")
+    sent_ns, producer_cpu, producer_wall = receiving.recv()
+    producer.join()
+    wall = time.perf_counter() - start
+    buddy_cpu = cpu_seconds() - cpu_start
+    if name == "inproc":
+        buddy_cpu -= producer_cpu  # same process
+    buddy.wrap_up()
+
+    queued = buddy.queue.queued_ns
+    ids = np.array([i for i in queued if i is not None and i < len(sent_ns)], dtype=int)
+    latencies = np.array([queued[i] for i in ids]) - np.array(sent_ns)[ids]
+    span = (max(queued.values()) - min(queued.values())) / 1e9 if len(queued) > 1 else 0
+    return {
+        "sent": len(sent_ns),
+        "queued": len(ids),
+        "throughput": len(ids) / span if span else 0.0,
+        "latency_ms": latencies / 1e6,
+        "buddy_cpu": 100 * buddy_cpu / wall,
+        "producer_cpu": 100 * producer_cpu / producer_wall,
+    }
+
+
+def main(seconds=2.0, texture_size=64):
+    print(
+        f"{'endpoint':<8} {'rate':>6} {'sent':>7} {'queued':>7} {'stim/s':>8} "
+        f"{'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'buddy %':>8} {'prod %':>7}"
+    )
+    for name in endpoints:
+        for rate in rates:
+            result = run(name, rate, seconds, texture_size)
+            latencies = result["latency_ms"]
+            p50, p99, worst = (
+                (*np.percentile(latencies, [50, 99]), latencies.max())
+                if len(latencies)
+                else (np.nan, np.nan, np.nan)
+            )
+            print(
+                f"{name:<8} {rate or 'max':>6} {result['sent']:>7} {result['queued']:>7} "
+                f"{result['throughput']:>8.0f} {p50:>7.2f} {p99:>7.2f} {worst:>7.2f} "
+                f"{result['buddy_cpu']:>8.1f} {result['producer_cpu']:>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 2.0,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 64,
+    )
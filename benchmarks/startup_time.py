@@ -0,0 +1,86 @@
+"""
+pandastim/benchmarks/startup_time.py
+
+startup regression check
+
+- each core module is imported cold in a fresh interpreter, none of them should pull in
+  the heavy optional dependencies (cv2, matplotlib, scipy, zmq)
+- time-to-first-frame is measured on an offscreen window and checked against a budget
+
+    python startup_time.py [budget_seconds]
+
+exits non-zero if a heavy import sneaks back in or the budget is exceeded
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import json
+import subprocess
+import sys
+
+default_budget = 10.0  # seconds, matches startup_budget in the params files
+
+core_modules = [
+    "pandastim.utils",
+    "pandastim.stimuli.textures",
+    "pandastim.stimuli.stimulus_details",
+]
+heavy_modules = ["cv2", "matplotlib", "scipy", "zmq"]
+
+import_check = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0)
+print(",".join(m for m in {heavy} if m in sys.modules))
+"""
+
+first_frame_check = """
+import json
+from panda3d.core import loadPrcFileData
+loadPrcFileData("", "window-type offscreen")
+loadPrcFileData("", "audio-library-name null")
+
+from pandastim.stimuli import stimulus, stimulus_details
+
+pstim = stimulus.StimulusSequencing(params_path="default")
+pstim.current_stimulus = stimulus_details.MonocularStimulusDetails(velocity=0.05, duration=1)
+pstim.set_stimulus()
+while "first_texture" not in pstim.startup_report:
+    pstim.taskMgr.step()
+print(json.dumps(pstim.startup_report))
+"""
+
+
+def run(code):
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip().splitlines()
+
+
+def main(budget=default_budget):
+    failed = False
+
+    for module in core_modules:
+        seconds, heavy = run(import_check.format(module=module, heavy=heavy_modules))[-2:]
+        print(f"import {module}: {float(seconds) * 1000:.1f} ms")
+        if heavy:
+            print(f"    FAIL: importing {module} pulled in {heavy}")
+            failed = True
+
+    report = json.loads(run(first_frame_check)[-1])
+    for stage, seconds in report.items():
+        print(f"{stage}: {seconds * 1000:.1f} ms")
+
+    if report["time_to_first_frame"] > budget:
+        print(
+            f"FAIL: time to first frame {report['time_to_first_frame']:.3f} s over {budget} s budget"
+        )
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else default_budget
+    sys.exit(main(budget))
@@ -0,0 +1,128 @@
+"""
+pandastim/benchmarks/transport_latency.py
+
+one way latency of the shared memory ring (shmring) against zmq over tcp loopback
+
+a second process echoes every message straight back, latency is half the round trip as
+seen by this process (one clock, no sync needed). messages go out at a fixed rate like the
+buddy's events would, for a small stimulus message and a telemetry sized array
+
+    python transport_latency.py [messages] [rate_hz]
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import multiprocessing as mp
+import select
+import sys
+import time
+
+import numpy as np
+
+from pandastim import shmring, utils
+
+transports = {"tcp": (5920, 5921), "shm": (5930, 5931)}
+
+stim = {
+    "stimulus": {"stim_name": "wholefield_forward", "angle": 90, "velocity": 0.05},
+    "texture": {"texture_size": (1024, 1024), "texture_name": "grating_gray"},
+}
+telemetry = np.zeros((60, 19))
+
+
+def receive(subscriber, timeout):
+    """
+    recv_message with a timeout (seconds), None if nothing arrived
+    """
+    if isinstance(subscriber, shmring.ShmSubscriber):
+        deadline = time.perf_counter() + timeout
+        while (frames := subscriber.poll()) is None:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            select.select([subscriber.doorbell], [], [], remaining)
+            subscriber.clear_doorbell()
+        return utils.decode_frames(frames)
+    if subscriber.socket.poll(timeout * 1000):
+        return subscriber.recv_message()
+    return None
+
+
+def echo(transport, ready, done):
+    ping_port, echo_port = transports[transport]
+    subscriber = shmring.make_subscriber(str(ping_port), transport=transport)
+    publisher = shmring.make_publisher(str(echo_port), transport=transport)
+    ready.set()
+    while not done.is_set():
+        message = receive(subscriber, 0.1)
+        if message is None:
+            continue
+        topic, data = message
+        if "array" in data:
+            array, name = data.pop("array"), data.pop("name")
+            del data["shape"], data["dtype"]
+            publisher.send_array(topic, array, name, **data)
+        else:
+            publisher.send_message(topic, data)
+    subscriber.kill()
+    publisher.kill()
+
+
+def measure(transport, messages, rate):
+    ping_port, echo_port = transports[transport]
+    publisher = shmring.make_publisher(str(ping_port), transport=transport)
+    subscriber = shmring.make_subscriber(str(echo_port), transport=transport)
+
+    ready, done = mp.Event(), mp.Event()
+    process = mp.Process(target=echo, args=(transport, ready, done))
+    process.start()
+    ready.wait()
+
+    # both ends join asynchronously (zmq slow joiner, the ring attaching), ping until through
+    for _ in range(100):
+        publisher.send_message("warmup", {"id": -1})
+        if receive(subscriber, 0.05) is not None:
+            break
+    while receive(subscriber, 0.05) is not None:
+        pass
+
+    results = {}
+    for name, send in {
+        "stim": lambda i: publisher.send_message("stim", {"id": i, **stim}),
+        "telemetry": lambda i: publisher.send_array("telemetry", telemetry, "telemetry", id=i),
+    }.items():
+        latencies = []
+        for i in range(messages):
+            t0 = time.perf_counter_ns()
+            send(i)
+            message = receive(subscriber, 1.0)
+            if message is not None and message[1]["id"] == i:
+                latencies.append((time.perf_counter_ns() - t0) / 2e3)
+            time.sleep(1 / rate)
+        results[name] = (np.array(latencies), messages - len(latencies))
+
+    done.set()
+    process.join()
+    subscriber.kill()
+    publisher.kill()
+    return results
+
+
+def main(messages=2000, rate=500):
+    print(
+        f"{'transport':<10} {'message':<10} {'p50 us':>8} {'p90 us':>8} {'p99 us':>8} "
+        f"{'max us':>8} {'lost':>5}"
+    )
+    for transport in transports:
+        for name, (latencies, lost) in measure(transport, messages, rate).items():
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            print(
+                f"{transport:<10} {name:<10} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f} "
+                f"{latencies.max():>8.1f} {lost:>5}"
+            )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 500,
+    )
@@ -0,0 +1,94 @@
+"""
+pandastim/benchmarks/wire_format.py
+
+compares the binary wire format against pickle for typical buddy messages:
+encode time, decode time and message size
+
+    python wire_format.py [repeats]
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import pickle
+import sys
+import timeit
+
+import numpy as np
+
+from pandastim import utils
+
+monocular_stim = {
+    "stimulus": {
+        "stim_name": "wholefield_forward",
+        "angle": 90,
+        "velocity": 0.05,
+        "stationary_time": 5,
+        "duration": 20,
+        "hold_after": np.nan,
+    },
+    "texture": {
+        "texture_size": (1024, 1024),
+        "texture_name": "grating_gray",
+        "frequency": 32,
+        "light_value": 255,
+        "dark_value": 0,
+    },
+}
+
+binocular_stim = {
+    "stimulus": {
+        "stim_name": "binocular_converging",
+        "angle": (90, 270),
+        "velocity": (0.05, 0.05),
+        "stationary_time": (5, 5),
+        "duration": (20, 20),
+        "hold_after": (np.nan, np.nan),
+        "strip_width": 8,
+        "position": (0, 0),
+        "strip_angle": 0,
+    },
+    "texture": [
+        {"texture_size": (1024, 1024), "texture_name": "grating_gray", "frequency": 32},
+        {"texture_size": (1024, 1024), "texture_name": "grating_gray", "frequency": 32},
+    ],
+}
+
+event = {
+    "time": "2024-01-01 12:00:00.000000",
+    "message": f"motionOn: {monocular_stim}",
+}
+
+messages = {
+    "stim (monocular)": ("stim", monocular_stim),
+    "stim (binocular)": ("stim", binocular_stim),
+    "move": ("move", 3),
+    "event": ("event", event),
+}
+
+
+def main(repeats=20000):
+    print(f"{'message':<18} {'format':<7} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for name, (topic, data) in messages.items():
+        binary = utils.encode_message(topic, data)
+        pickled = pickle.dumps(data)
+
+        results = {
+            "binary": (
+                len(binary),
+                timeit.timeit(lambda: utils.encode_message(topic, data), number=repeats),
+                timeit.timeit(lambda: utils.decode_message(binary), number=repeats),
+            ),
+            "pickle": (
+                len(pickled),
+                timeit.timeit(lambda: pickle.dumps(data), number=repeats),
+                timeit.timeit(lambda: pickle.loads(pickled), number=repeats),
+            ),
+        }
+        for fmt, (size, encode, decode) in results.items():
+            print(
+                f"{name:<18} {fmt:<7} {size:>6} "
+                f"{encode / repeats * 1e6:>10.2f} {decode / repeats * 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
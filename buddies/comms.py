@@ -0,0 +1,298 @@
+"""
+pandastim/buddies/comms.py
+
+one asyncio event loop, on one background thread, that services every buddy zmq socket
+
+buddies register topic handlers with the hub instead of running their own receive threads,
+handlers run on the hub thread. slow ones (building stimuli and textures) can be
+offloaded to a single handler thread, in arrival order, so the loop stays free for i/o.
+anything that has to happen on the render thread (messenger events, panda calls) goes
+through the buddy's Mailbox, which the sequencer drains per frame
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+import zmq
+import zmq.asyncio
+
+from pandastim import shmring, utils
+
+
+class Mailbox:
+    """
+    Hand off from the hub (or any other thread) to the render thread
+
+    the sequencer drains it once per frame at a fixed point in the task order (before the
+    movement tasks), so a command is applied on the first frame after it arrives. each
+    command is stamped on arrival and when applied, latencies are kept for stats
+    """
+
+    def __init__(self, history=1024, on_applied=None):
+        self._pending = collections.deque()  # append/popleft are atomic, no lock needed
+        self.on_applied = on_applied  # fxn(name, arrival_ns, applied_ns)
+
+        self.latencies = np.full(history, np.nan)  # ms
+        self.count = 0
+        self.max_latency = 0.0
+
+    def post(self, fxn, *args, name=None, arrival_ns=None):
+        if arrival_ns is None:
+            arrival_ns = time.monotonic_ns()
+        name = name or getattr(fxn, "__name__", "command")
+        self._pending.append((fxn, args, name, arrival_ns))
+
+    def drain(self):
+        """
+        call once per frame from the render thread, only runs what was posted before the
+        call so a busy producer can't hold the frame up
+        """
+        for _ in range(len(self._pending)):
+            fxn, args, name, arrival_ns = self._pending.popleft()
+            try:
+                fxn(*args)
+            except Exception as e:
+                print(f"failed to run {name}: {e}")
+            applied_ns = time.monotonic_ns()
+
+            latency = (applied_ns - arrival_ns) / 1e6
+            self.latencies[self.count % len(self.latencies)] = latency
+            self.count += 1
+            self.max_latency = max(self.max_latency, latency)
+            if self.on_applied is not None:
+                self.on_applied(name, arrival_ns, applied_ns)
+
+    def stats(self) -> dict:
+        """
+        command arrival -> applied latency in ms
+        """
+        latencies = self.latencies[~np.isnan(self.latencies)]
+        return {
+            "commands": self.count,
+            "pending": len(self._pending),
+            "mean_ms": float(latencies.mean()) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "max_ms": self.max_latency,
+        }
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class CommsHub:
+    """
+    Owns the asyncio loop and the sockets it reads from
+
+    the hub is shared by every buddy in the process (instance/release keep count of users).
+    publishers stay plain zmq sockets on the same context, send on them from the hub thread
+    (call) so a socket is never used from two threads
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._lock:
+            if cls._instance is None or not cls._instance.running:
+                cls._instance = cls()
+            cls._instance.users += 1
+            return cls._instance
+
+    def __init__(self, context=None):
+        self.context = context or zmq.Context.instance()
+        self.async_context = zmq.asyncio.Context.shadow(self.context.underlying)
+        # a selector loop on every platform: windows defaults to the proactor, which has
+        # no add_reader for the shm doorbell (and zmq.asyncio wants one too)
+        self.loop = asyncio.SelectorEventLoop()
+        self.users = 0
+        self.running = True
+        self._tasks = set()
+        # one worker, offloaded handlers run one at a time in the order they arrived
+        self.worker = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="pandastim-handlers"
+        )
+
+        self.thread = threading.Thread(
+            target=self.run, daemon=True, name="pandastim-comms"
+        )
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def call(self, fxn, *args):
+        """
+        runs fxn on the hub thread, safe from any thread
+        """
+        self.loop.call_soon_threadsafe(fxn, *args)
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def subscribe(
+        self,
+        port,
+        handlers,
+        topic="",
+        ip=None,
+        transport="tcp",
+        allow_pickle=None,
+        offload=(),
+    ):
+        """
+        reads from a SUB socket (or a shared memory ring) and dispatches each message by topic
+
+        :param handlers: topic -> fxn(data), a None key catches any other topic. dict
+            messages get the arrival time as data["received_ns"] (time.monotonic_ns)
+        :param topic: subscribed to along with each handler topic, "" takes everything
+        :param transport: "tcp" or "shm" for a same-host shmring.ShmPublisher (ip is ignored)
+        :param allow_pickle: decode pickled messages, None only allows them off the ring
+            (see utils.decode_message, a pickle from the network can run any code)
+        :param offload: handler topics (None for the catch all) that run on the handler
+            thread instead of the hub thread, for handlers too slow to hold up the loop
+        :return: handle for close
+        """
+        topics = {topic} if topic else set()
+        topics |= {t for t in handlers if t is not None}
+        if "" in topics or not topic and None in handlers:
+            topics = {""}
+
+        if transport == "shm":
+            address = shmring.ring_name(port)
+            receive = self._receive_ring
+            allow_pickle = allow_pickle is not False
+        else:
+            assert transport == "tcp", f"{transport} not in transports"
+            address = (ip if ip is not None else "tcp://localhost:") + str(port)
+            receive = self._receive
+            allow_pickle = utils.pickle_allowed(address, allow_pickle)
+
+        async def start():
+            task = self.loop.create_task(
+                receive(address, port, topics, handlers, allow_pickle, offload)
+            )
+            self._tasks.add(task)
+            return task
+
+        return self._submit(start())
+
+    async def _receive(self, address, port, topics, handlers, allow_pickle, offload):
+        socket = self.async_context.socket(zmq.SUB)
+        socket.connect(address)
+        for t in topics:
+            socket.subscribe(t)
+        try:
+            while True:
+                frames = await socket.recv_multipart(copy=False)
+                self._dispatch(frames, handlers, address, allow_pickle, offload)
+        finally:
+            socket.close(linger=0)
+
+    async def _receive_ring(
+        self, address, port, topics, handlers, allow_pickle, offload
+    ):
+        ring = shmring.ShmSubscriber(port=port)
+        topics = tuple(t.encode() for t in topics)
+        doorbell = asyncio.Event()
+        self.loop.add_reader(ring.doorbell, doorbell.set)
+        try:
+            while True:
+                ring.clear_doorbell()
+                doorbell.clear()
+                for frames in ring.drain():
+                    if frames[0].startswith(topics):
+                        self._dispatch(
+                            frames, handlers, address, allow_pickle, offload
+                        )
+                # the doorbell wakes us, the timeout covers a missed one (or no ring yet)
+                try:
+                    await asyncio.wait_for(doorbell.wait(), ring.timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.loop.remove_reader(ring.doorbell)
+            ring.kill()
+
+    def _dispatch(self, frames, handlers, address, allow_pickle=False, offload=()):
+        received_ns = time.monotonic_ns()
+        try:
+            topic, data = utils.decode_frames(frames, allow_pickle=allow_pickle)
+        except Exception as e:
+            print(f"failed to decode message from {address}: {e}")
+            return
+        if isinstance(data, dict):
+            data["received_ns"] = received_ns
+        key = topic if topic in handlers else None
+        handler = handlers.get(key)
+        if handler is None:
+            print(f"message {topic} not understood")
+        elif key in offload:
+            self.worker.submit(self._handle, handler, data, address)
+        else:
+            self._handle(handler, data, address)
+
+    @staticmethod
+    def _handle(handler, data, address):
+        try:
+            handler(data)
+        except Exception as e:
+            print(f"failed to handle message from {address}: {e}")
+
+    def every(self, interval, fxn):
+        """
+        calls fxn every interval seconds on the hub thread
+        :return: handle for close
+        """
+
+        async def repeat():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    fxn()
+                except Exception as e:
+                    print(f"failed to run {fxn}: {e}")
+
+        async def start():
+            task = self.loop.create_task(repeat())
+            self._tasks.add(task)
+            return task
+
+        return self._submit(start())
+
+    def close(self, handle):
+        """
+        stops a subscription or repeating call, its socket is closed
+        """
+
+        def cancel():
+            handle.cancel()
+            self._tasks.discard(handle)
+
+        if self.running:
+            self.call(cancel)
+
+    def release(self):
+        """
+        a buddy is done with the hub, the last one out stops the loop
+        """
+        with self._lock:
+            self.users -= 1
+            if self.users > 0 or not self.running:
+                return
+            self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        # whatever is still waiting for the handler thread is dropped
+        self.worker.shutdown(cancel_futures=True)
@@ -1,3 +1,5 @@
+import collections
+import functools
 import json
 import sys
 import threading as tr
@@ -8,9 +10,11 @@ from pathlib import Path
 import zmq
 from direct.showbase import DirectObject
 from direct.showbase.MessengerGlobal import messenger
+from panda3d.core import ClockObject
 
-from pandastim import utils
-from pandastim.stimuli import stimulus_details
+from pandastim import clocksync, eventlog, flowcontrol, profiling, shmring, utils
+from pandastim.buddies import comms
+from pandastim.stimuli import stimulus_details, textures
 
 try:
     from scopeslip import planeAlignment
@@ -18,6 +22,131 @@ except ImportError:
     print("alignment unavailable, no scopeslip package found")
 
 
+class StimulusQueue:
+    """
+    Thread-safe stimulus queue with priority levels
+
+    one deque per priority level so pushing and popping at either end is O(1), the zmq
+    input thread pushes while the render thread pops. Anything pushed as URGENT flags a
+    preemption which the sequencer picks up on its next frame. on_drop(items) hears
+    about stimuli thrown out by replace/clear without being shown
+    """
+
+    NORMAL = 0
+    HIGH = 1
+    URGENT = 2
+
+    def __init__(self, items=None, levels=3, on_drop=None):
+        self._lock = tr.Lock()
+        self._levels = [collections.deque() for _ in range(levels)]
+        self._preempt = False
+        self.on_drop = on_drop
+        if items:
+            self.extend(items)
+
+    def append(self, item, priority=NORMAL):
+        with self._lock:
+            self._levels[priority].append(item)
+            if priority == self.URGENT:
+                self._preempt = True
+
+    def appendleft(self, item, priority=NORMAL):
+        with self._lock:
+            self._levels[priority].appendleft(item)
+            if priority == self.URGENT:
+                self._preempt = True
+
+    def extend(self, items, priority=NORMAL):
+        with self._lock:
+            self._levels[priority].extend(items)
+            if priority == self.URGENT:
+                self._preempt = True
+
+    def pop(self, index=0):
+        """
+        pops by position in play order (levels from URGENT down to NORMAL, each front to
+        back), like list.pop on the flattened queue. index 0 is the front of the highest
+        non empty level (what plays next), -1 the back of the lowest non empty level
+        (what plays last, not necessarily the last appended). both are O(1), anything
+        else is an O(n) walk
+        """
+        with self._lock:
+            if index == 0:
+                for level in reversed(self._levels):
+                    if level:
+                        return level.popleft()
+                raise IndexError("pop from an empty StimulusQueue")
+            if index == -1:
+                for level in self._levels:
+                    if level:
+                        return level.pop()
+                raise IndexError("pop from an empty StimulusQueue")
+
+            if index < 0:
+                index += self._length()
+            for level in reversed(self._levels):
+                if index < len(level):
+                    item = level[index]
+                    del level[index]
+                    return item
+                index -= len(level)
+            raise IndexError("StimulusQueue index out of range")
+
+    def popleft(self):
+        return self.pop(0)
+
+    def take_preemption(self):
+        """
+        true once for each time an urgent stimulus has been pushed
+        """
+        with self._lock:
+            preempt = self._preempt
+            self._preempt = False
+        return preempt
+
+    def replace(self, items):
+        items = list(items)
+        with self._lock:
+            kept = {id(item) for item in items}
+            dropped = [
+                item
+                for level in self._levels
+                for item in level
+                if id(item) not in kept
+            ]
+            for level in self._levels:
+                level.clear()
+            self._levels[self.NORMAL].extend(items)
+            self._preempt = False
+        if dropped and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def clear(self):
+        self.replace([])
+
+    def copy(self):
+        """
+        snapshot of the queue in pop order as a list
+        """
+        with self._lock:
+            return [item for level in reversed(self._levels) for item in level]
+
+    def _length(self):
+        return sum(len(level) for level in self._levels)
+
+    def __len__(self):
+        return self._length()
+
+    def __bool__(self):
+        return self._length() > 0
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __getitem__(self, index):
+        return self.copy()[index]
+
+
 class StimulusBuddy(DirectObject.DirectObject):
     def __init__(
         self,
@@ -27,6 +156,15 @@ class StimulusBuddy(DirectObject.DirectObject):
         pstim_comms=None,
         savePath=None,
         default_params_path=None,
+        memory_reporting=False,
+        metrics_rate=None,
+        wire_format="pickle",
+        log_format="text",
+        compact_events=False,
+        console=True,
+        clock_sync=None,
+        telemetry_batch=None,
+        queue_capacity=None,
     ):
 
         if not default_params_path:
@@ -44,18 +182,53 @@ class StimulusBuddy(DirectObject.DirectObject):
         assert reporting in reportingMethods, f"{reporting} not in reportingMethods"
         self.reportingMethod = reporting
 
+        # every buddy socket lives on the comms hub: one asyncio loop on one thread, shared
+        # by all buddies. its handlers hand render thread work over through the mailbox
+        self.hub = comms.CommsHub.instance()
+        self.context = self.hub.context
+        self.mailbox = comms.Mailbox(on_applied=self.command_applied)
+        self._subscriptions = []
+
         outputMethods = ["print", "zmq"]
         assert outputMethod in outputMethods, f"{reporting} not in reportingMethods"
         self.outputMethod = outputMethod
+
+        # incoming messages are decoded either way, this picks what events go out as
+        wireFormats = ["pickle", "binary"]
+        assert wire_format in wireFormats, f"{wire_format} not in wireFormats"
+        self.wire_format = wire_format
         if outputMethod == "zmq":
-            self.publisher = utils.Publisher(
-                port=str(self.default_params["publish_port"])
+            # "shm" publishes on a shared memory ring for subscribers on the same machine
+            self.publisher = shmring.make_publisher(
+                str(self.default_params["publish_port"]),
+                transport=self.default_params.get("publish_transport", "tcp"),
+                context=self.context,
+                sndhwm=self.default_params.get("send_hwm", 1000),
             )
 
-        if savePath:
+        # sends and console prints happen on the hub thread, never the render thread
+        self.outbox = utils.OutputWriter(
+            maxsize=self.default_params.get("output_queue", 1000),
+            console=console,
+            console_rate=self.default_params.get("console_rate", 20),
+            loop=self.hub.loop,
+        )
+
+        # each distinct stimulus gets an id, with compact_events messages carry only that id
+        self.registry = utils.StimulusRegistry()
+        self.compact_events = compact_events
+
+        # text keeps the old timestamp_&_message lines, binary writes an eventlog (see eventlog.py)
+        logFormats = ["text", "binary"]
+        assert log_format in logFormats, f"{log_format} not in logFormats"
+        self.filestream = None
+        self.logwriter = None
+        self.eventlog = None
+        if savePath and log_format == "binary":
+            self.eventlog = eventlog.EventLogWriter(savePath, registry=self.registry)
+        elif savePath:
             self.filestream = utils.saving(savePath)
-        else:
-            self.filestream = None
+            self.logwriter = utils.LogWriter(self.filestream)
 
         match self.reportingMethod:
             case "onStim":
@@ -75,16 +248,121 @@ class StimulusBuddy(DirectObject.DirectObject):
         self.lastReturnedStim = None
 
         self.receipts = receipts
-        self.queue = []
+        self.memory_reporting = memory_reporting
+        self._queue = StimulusQueue(on_drop=self.queue_dropped)
+        # name -> textures.ArrayTex, least recently used first. only the newest
+        # array_texture_cache are kept (queued stimuli hold on to their own), a
+        # releaseTexture message lets one go early
+        self.array_textures = collections.OrderedDict()
+        self.array_texture_cache = self.default_params.get("array_texture_cache", 32)
+        self.tracer = profiling.StimulusTracer()
+
+        # free queue slots go out as credits with every ack (see flowcontrol.py), stimuli
+        # that arrive with no credit left are rejected. None leaves the queue unbounded
+        if queue_capacity is None:
+            queue_capacity = self.default_params.get("queue_capacity")
+        self.queue_capacity = queue_capacity
+        # stimulus -> stimulus id, until it finishes or is dropped
+        self._acked = utils.WeakIdentityMap()
+
+        # live rig metrics on their own port, published at metrics_rate hz
+        if metrics_rate:
+            self.metrics = profiling.RigMetrics(fps=self.default_params["fps"])
+            self.metrics_publisher = profiling.MetricsPublisher(
+                self.metrics,
+                utils.Publisher(
+                    port=str(self.default_params.get("metrics_port", 5011)),
+                    context=self.context,
+                ),
+                rate=metrics_rate,
+                every=self.hub.every,
+            )
+        else:
+            self.metrics = None
+
+        # per-frame layer kinematics, published as one array every telemetry_batch frames
+        self.telemetry = None
+        if telemetry_batch:
+            assert outputMethod == "zmq", "telemetry needs zmq output"
+            self.telemetry = profiling.Telemetry(
+                batch_size=telemetry_batch, on_batch=self.publish_telemetry
+            )
+
+        # pings go out on the publisher at clock_sync hz, echoes come back on pstim_comms
+        self.clock = None
+        if clock_sync:
+            assert (
+                outputMethod == "zmq" and pstim_comms
+            ), "clock_sync needs zmq output and pstim_comms"
+            self.clock = clocksync.ClockSync(
+                on_ping=self.send_clock_ping, interval=1 / clock_sync, every=self.hub.every
+            )
 
+        self.accept_timeline()
+
+        # these build stimuli and textures, they run on the hub's handler thread (in
+        # order) so a big protocol doesn't hold up acks, clock echoes and credits
+        self.offload_topics = {"stim", "protocol", "texture", "releaseTexture"}
         if pstim_comms:
-            self.subscriber = utils.Subscriber(**pstim_comms)
-            self.run_sub = tr.Thread(target=self.input)
-            self.run_sub.start()
+            self.subscribe(
+                self.topic_handlers(), offload=self.offload_topics, **pstim_comms
+            )
+            print(f"StimulusBuddy listening on {pstim_comms['port']}")
+        self.advertise_credits()
+
+    def subscribe(
+        self,
+        handlers,
+        port,
+        topic="",
+        ip=None,
+        transport="tcp",
+        allow_pickle=None,
+        offload=(),
+    ):
+        """
+        reads a socket on the comms hub, handlers maps topic -> fxn(data) (None for any)
+        pstim_comms can carry "transport": "shm" to read a same-host
+        shmring.ShmPublisher, and "allow_pickle": True for a trusted producer that still
+        sends pickles over tcp. offload topics run on the hub's handler thread
+        """
+        self._subscriptions.append(
+            self.hub.subscribe(
+                port,
+                handlers,
+                topic=topic,
+                ip=ip,
+                transport=transport,
+                allow_pickle=allow_pickle,
+                offload=offload,
+            )
+        )
+
+    def topic_handlers(self):
+        """
+        what comes in on pstim_comms, subclasses add their own topics
+        """
+        return {
+            "stim": self.receive_stimulus,
+            "protocol": self.receive_protocol,
+            "texture": self.receive_texture,
+            "releaseTexture": self.release_texture,
+            "clockEcho": self.receive_clock_echo,
+            "credits": self.advertise_credits,
+        }
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @queue.setter
+    def queue(self, items):
+        # experiments hand over whole lists, keep the same thread-safe queue
+        self._queue.replace(items)
 
     def pauseStatus(self, pause_status):
         if pause_status and not self._pauseStatus:
-            self.queue = [self.lastReturnedStim] + self.queue
+            self.queue.appendleft(self.lastReturnedStim)
             print("tried to add to queue")
         self._pauseStatus = pause_status
 
@@ -111,30 +389,93 @@ class StimulusBuddy(DirectObject.DirectObject):
             self._stimulus = newstimulus
             self._stimChange = True
 
+        if self._stimChange:
+            self.report_memory()
+
+    def report_memory(self):
+        if self.memory_reporting or self.metrics:
+            memory_totals = self.memory_report()["totals"]
+            if self.metrics:
+                self.metrics.memory_bytes = memory_totals["numpy"] + memory_totals["ram"]
+            if self.memory_reporting:
+                self.output(f"textureMemory: {memory_totals}")
+
+    @property
+    def frame_index(self):
+        return ClockObject.getGlobalClock().getFrameCount()
+
+    def accept_timeline(self):
+        """
+        the sequencer emits these as its timeline changes phase (see StimulusSequencing.emit),
+        each with the stimulus (or pause state) and the frame index it happened on
+        """
+        self.accept("pstim_stimulus_set", self.on_stimulus_set)
+        self.accept("pstim_motion_start", self.on_motion_start)
+        self.accept("pstim_motion_hold", self.on_motion_hold)
+        self.accept("pstim_stimulus_end", self.on_stimulus_end)
+        self.accept("pstim_pause", self.on_pause)
+
+    def on_stimulus_set(self, stimulus, frame):
+        self._stimulus = stimulus
+        self._motion = False
+        self.report_memory()
+        match self.reportingMethod:
+            case "onStim":
+                self.output(self.stimulus_message("onStim", stimulus), stimulus)
+            case "onMotion":
+                self.output(self.stimulus_message("stimChange", stimulus), stimulus)
+
+    def on_motion_start(self, stimulus, frame):
+        self._motion = True
+        if self.reportingMethod == "onMotion":
+            self.output(self.stimulus_message("motionOn", stimulus), stimulus)
+
+    def on_motion_hold(self, stimulus, frame):
+        self._motion = False
+        if self.reportingMethod == "onMotion":
+            self.output(self.stimulus_message("motionHold", stimulus), stimulus)
+
+    def on_stimulus_end(self, stimulus, frame):
+        self._motion = False
+        # nothing shows until the next stimulus_set, the aligning buddy waits for this
+        if self._stimulus is stimulus:
+            self._stimulus = None
+        self.ack_stimulus(stimulus, "finished")
+        if self.reportingMethod == "onMotion":
+            self.output(self.stimulus_message("stimEnd", stimulus), stimulus)
+
+    def on_pause(self, paused, frame):
+        self.pauseStatus(paused)
+        self.output(f"pause: {paused}: frame {frame}")
+
+    def frame_tick(self):
+        if self.metrics:
+            self.metrics.frame(len(self.queue))
+            self.metrics.dropped_messages = self.outbox.dropped
+            self.metrics.command_latency_ms = self.mailbox.max_latency
+
     def broadcaster(self):
         match self.reportingMethod:
             case "onStim":
                 msg = self._stimulus.stim_name
                 if self._lastmessage != msg and self._stimChange:
-                    if self._stimulus is not None:
-                        self.output(f"onStim: {self._stimulus.return_dict()}")
-                    else:
-                        self.output(f"onStim: {self._stimulus}")
+                    self.output(
+                        self.stimulus_message("onStim", self._stimulus), self._stimulus
+                    )
                     self._lastmessage = msg
                     # self.output(msg)
             case "onMotion":
                 msg = [self._motion, self._stimChange]
                 if self._lastmessage[0] != msg[0] and not self._stimChange:
-                    if self._stimulus is not None:
-                        self.output(f"motionOn: {self._stimulus.return_dict()}")
-                    else:
-                        self.output(f"motionOn: {self._stimulus}")
+                    self.output(
+                        self.stimulus_message("motionOn", self._stimulus), self._stimulus
+                    )
                     self._lastmessage = msg
                 if self._lastmessage[1] != msg[1]:
-                    if self._stimulus is not None:
-                        self.output(f"stimChange: {self._stimulus.return_dict()}")
-                    else:
-                        self.output(f"stimChange: {self._stimulus}")
+                    self.output(
+                        self.stimulus_message("stimChange", self._stimulus),
+                        self._stimulus,
+                    )
                     self._lastmessage = msg
             case "full":
                 self.output(
@@ -143,89 +484,456 @@ class StimulusBuddy(DirectObject.DirectObject):
             case _:
                 pass
 
-    def input(self):
-        print(f"StimulusBuddy listening on {self.subscriber.port}")
-        while self._running:
-            topic = self.subscriber.socket.recv_string()
-            data = self.subscriber.socket.recv_pyobj()
-            # print(topic)
-
-            match topic:
-                case "stim":
-                    try:
-                        if not isinstance(data["texture"], dict):
-                            input_texture_0 = utils.createTexture(data["texture"][0])
-                            input_texture_1 = utils.createTexture(data["texture"][1])
-
-                        else:
-                            input_texture = utils.createTexture(data["texture"])
-
-                    except Exception as e:
-                        print(e)
-                        print(f"failed to create texture {data}")
-
-                    try:
-                        if not isinstance(data["texture"], dict):
-                            input_stimulus = stimulus_details.BinocularStimulusDetails(
-                                texture=(input_texture_0, input_texture_1),
-                                **data["stimulus"],
-                            )
-                        else:
-                            input_stimulus = stimulus_details.MonocularStimulusDetails(
-                                texture=input_texture, **data["stimulus"]
-                            )
-
-                        self.queue.append(input_stimulus)
-                        if self.receipts:
-                            self.output(
-                                f"pstimReceipts: queueAddition: {input_stimulus.return_dict()}"
-                            )
-                        # print(f'added stimulus to queue: {input_stimulus}')
-                    except Exception as e:
-                        print(e)
-                        print(f"failed to initialize stimulus {data}")
-                        if self.receipts:
-                            self.output(f"pstimReceipts: ERROR: {e}")
-
-                case _:
-                    print(f"message {topic} not understood")
-
-    def output(self, msg):
+    def stimulus_message(self, prefix, stimulus):
+        """
+        event text for a stimulus: the full return_dict, or with compact_events just its
+        registry id and the frame index. parameters go out once, the first time an id is used
+        """
+        if stimulus is None:
+            return f"{prefix}: {stimulus}"
+        if not self.compact_events:
+            return f"{prefix}: {stimulus.return_dict()}"
+
+        stim_id, new = self.registry.register(stimulus)
+        if new:
+            self.output(f"stimRegistry: {stim_id}: {self.registry.lookup(stim_id)}")
+        return f"{prefix}: stim_id {stim_id}: frame {self.frame_index}"
+
+    def republish_registry(self):
+        """
+        sends every registered stimulus again, for subscribers that joined late
+        """
+        for stim_id, params in self.registry.items():
+            self.output(f"stimRegistry: {stim_id}: {params}")
+
+    def record_telemetry(self, layers, stimulus=None):
+        """
+        called once per frame by the sequencer with (x, y, angle, visible) for each layer
+        """
+        stim_id = -1
+        if isinstance(stimulus, stimulus_details.StimulusDetails):
+            stim_id, new = self.registry.register(stimulus)
+            if new:
+                # so telemetry subscribers can look the id up
+                self.output(f"stimRegistry: {stim_id}: {self.registry.lookup(stim_id)}")
+        self.telemetry.record(self.frame_index, layers, stim_id)
+
+    def publish_telemetry(self, batch):
+        self.hub.call(
+            functools.partial(
+                self.publisher.send_array,
+                "telemetry",
+                batch,
+                "telemetry",
+                columns=self.telemetry.columns,
+            )
+        )
+
+    @property
+    def credits(self) -> int:
+        """
+        free queue slots, -1 when the queue is unbounded
+        """
+        if self.queue_capacity is None:
+            return -1
+        return max(0, self.queue_capacity - len(self.queue))
+
+    def ack(self, stim_id, state):
+        """
+        publishes a flowcontrol ack, these go out with zmq output only
+        """
+        if self.outputMethod != "zmq":
+            return
+        message = flowcontrol.ack_message(stim_id, state, self.credits, self.frame_index)
+        self.outbox.put(
+            functools.partial(
+                self.publisher.send_message, "ack", message, flags=zmq.NOBLOCK
+            )
+        )
+
+    def ack_stimulus(self, stimulus, state):
+        if state in ("finished", "dropped"):
+            stim_id = self._acked.pop(stimulus)
+        else:
+            stim_id = self._acked.get(stimulus)
+        if stim_id is not None:
+            self.ack(stim_id, state)
+
+    def queue_dropped(self, stimuli):
+        """
+        stimuli thrown out of the queue (replaced, cleared) are acked as dropped, so the
+        producer stops counting them as waiting, and their traces go
+        """
+        for stimulus in stimuli:
+            self.ack_stimulus(stimulus, "dropped")
+            self.tracer.discard_stimulus(stimulus)
+
+    def advertise_credits(self, data=None):
+        self.ack(-1, "credits")
+
+    def send_clock_ping(self):
+        # runs on the hub thread, stamped right before it goes out
+        self.publisher.send_message("clockPing", self.clock.ping(), flags=zmq.NOBLOCK)
+
+    def receive_clock_echo(self, data):
+        if self.clock is None:
+            return
+        self.clock.receive_echo(data, data["received_ns"])
+        if data["id"] % 60 == 0:
+            self.output(f"clockSync: {self.clock.stats()}")
+
+    def make_texture(self, tex_dict):
+        """
+        a texture received as an array (by name) if we have one, otherwise a built in one
+        """
+        name = tex_dict.get("texture_name")
+        if name in self.array_textures:
+            self.array_textures.move_to_end(name)
+            return self.array_textures[name]
+        return utils.createTexture(tex_dict)
+
+    def receive_texture(self, data):
+        """
+        wraps a raw array message (Publisher.send_array) in an ArrayTex without copying it
+
+        the texture is kept by name so later stim/protocol messages can use it as their
+        texture_name, a "stimulus" dict in the header queues a monocular stimulus right away
+        (a bad priority rejects it before the texture is made)
+
+        past array_texture_cache textures the least recently used is evicted, send
+        {"name": ...} on releaseTexture to drop one sooner
+        """
+        if "stimulus" in data:
+            stim_id = -1 if data.get("id") is None else data["id"]
+            priority = self.message_priority(data, [stim_id])
+            if priority is None:
+                return
+        try:
+            texture = textures.ArrayTex(data["array"], texture_name=data["name"])
+        except Exception as e:
+            print(e)
+            print(f"failed to create array texture {data['name']}")
+            if self.receipts:
+                self.output(f"pstimReceipts: ERROR: {e}")
+            return
+        self.array_textures[data["name"]] = texture
+        self.array_textures.move_to_end(data["name"])
+        while len(self.array_textures) > self.array_texture_cache:
+            evicted, _ = self.array_textures.popitem(last=False)
+            if self.receipts:
+                self.output(f"pstimReceipts: textureEviction: {evicted}")
+
+        if self.receipts:
+            self.output(
+                f"pstimReceipts: textureAddition: {data['name']}: {texture.texture_size}"
+            )
+        if "stimulus" in data:
+            self.receive_stimulus(
+                {
+                    "stimulus": data["stimulus"],
+                    "texture": {"texture_name": data["name"]},
+                    "priority": priority,
+                    "id": data.get("id"),
+                }
+            )
+
+    def release_texture(self, data):
+        """
+        forgets an array texture by name, stimuli already queued with it still show it
+        """
+        texture = self.array_textures.pop(data["name"], None)
+        if self.receipts:
+            state = "textureRelease" if texture is not None else "textureUnknown"
+            self.output(f"pstimReceipts: {state}: {data['name']}")
+
+    def message_priority(self, data, ids):
+        """
+        the queue level a message asks for, None (with ids rejected) if there isn't one
+        """
+        priority = data.get("priority", StimulusQueue.NORMAL)
+        levels = range(StimulusQueue.URGENT + 1)
+        if not isinstance(priority, bool) and priority in levels:
+            return int(priority)
+        for stim_id in ids:
+            self.ack(stim_id, "rejected")
+        if self.receipts:
+            self.output(
+                f"pstimReceipts: ERROR: priority {priority!r} not in "
+                f"{StimulusQueue.NORMAL}..{StimulusQueue.URGENT}, {ids} rejected"
+            )
+        return None
+
+    def receive_stimulus(self, data):
+        """
+        builds and queues a stimulus from a return_dict style message, tracing each stage
+        """
+        stim_id = -1 if data.get("id") is None else data["id"]
+        priority = self.message_priority(data, [stim_id])
+        if priority is None:
+            return
+        if self.credits == 0:
+            self.ack(stim_id, "rejected")
+            if self.receipts:
+                self.output(f"pstimReceipts: ERROR: queue full, {data.get('id')} rejected")
+            return
+
+        trace_id = self.tracer.start(data.get("id"))
+        try:
+            if not isinstance(data["texture"], dict):
+                input_texture_0 = self.make_texture(data["texture"][0])
+                input_texture_1 = self.make_texture(data["texture"][1])
+
+            else:
+                input_texture = self.make_texture(data["texture"])
+            self.tracer.stamp(trace_id, "texture_created")
+
+        except Exception as e:
+            print(e)
+            print(f"failed to create texture {data}")
+            self.tracer.discard(trace_id)
+            self.ack(trace_id, "rejected")
+            if self.receipts:
+                self.output(f"pstimReceipts: ERROR: {e}")
+            return
+
+        try:
+            if not isinstance(data["texture"], dict):
+                input_stimulus = stimulus_details.BinocularStimulusDetails(
+                    texture=(input_texture_0, input_texture_1),
+                    **data["stimulus"],
+                )
+            else:
+                input_stimulus = stimulus_details.MonocularStimulusDetails(
+                    texture=input_texture, **data["stimulus"]
+                )
+
+            self.tracer.attach(trace_id, input_stimulus)
+            self.tracer.stamp(trace_id, "queued")
+            self._acked[input_stimulus] = trace_id
+            self.queue.append(input_stimulus, priority=priority)
+            self.ack(trace_id, "queued")
+            if self.receipts:
+                self.output(
+                    self.stimulus_message(
+                        f"pstimReceipts: queueAddition: {trace_id}", input_stimulus
+                    ),
+                    input_stimulus,
+                )
+            # print(f'added stimulus to queue: {input_stimulus}')
+        except Exception as e:
+            print(e)
+            print(f"failed to initialize stimulus {data}")
+            self.tracer.discard(trace_id)
+            self.ack(trace_id, "rejected")
+            if self.receipts:
+                self.output(f"pstimReceipts: ERROR: {e}")
+
+    def receive_protocol(self, data):
+        """
+        builds a whole protocol in one go and queues it atomically
+
+        data holds a shared "textures" table and an ordered "stimuli" list whose "texture"
+        entries index into that table (a pair of indices for binocular stimuli).
+        identical textures are only created once, if anything fails (or the protocol needs
+        more credits than there are) nothing is queued
+        """
+        priority = self.message_priority(
+            data, [stim.get("id", -1) for stim in data["stimuli"]]
+        )
+        if priority is None:
+            return
+        if 0 <= self.credits < len(data["stimuli"]):
+            for stim in data["stimuli"]:
+                self.ack(stim.get("id", -1), "rejected")
+            if self.receipts:
+                self.output(
+                    f"pstimReceipts: ERROR: queue full, protocol of "
+                    f"{len(data['stimuli'])} rejected with {self.credits} credits"
+                )
+            return
+
+        received = [self.tracer.start(stim.get("id")) for stim in data["stimuli"]]
+        try:
+            created = {}
+            texture_table = []
+            for tex_dict in data["textures"]:
+                key = repr(sorted(tex_dict.items()))
+                if key not in created:
+                    created[key] = self.make_texture(tex_dict)
+                texture_table.append(created[key])
+            for trace_id in received:
+                self.tracer.stamp(trace_id, "texture_created")
+
+            input_stimuli = []
+            for stim in data["stimuli"]:
+                if isinstance(stim["texture"], (list, tuple)):
+                    input_stimuli.append(
+                        stimulus_details.BinocularStimulusDetails(
+                            texture=tuple(texture_table[i] for i in stim["texture"]),
+                            **stim["stimulus"],
+                        )
+                    )
+                else:
+                    input_stimuli.append(
+                        stimulus_details.MonocularStimulusDetails(
+                            texture=texture_table[stim["texture"]], **stim["stimulus"]
+                        )
+                    )
+        except Exception as e:
+            print(e)
+            print(f"failed to initialize protocol")
+            for trace_id in received:
+                self.tracer.discard(trace_id)
+                self.ack(trace_id, "rejected")
+            if self.receipts:
+                self.output(f"pstimReceipts: ERROR: {e}")
+            return
+
+        for trace_id, input_stimulus in zip(received, input_stimuli):
+            self.tracer.attach(trace_id, input_stimulus)
+            self.tracer.stamp(trace_id, "queued")
+        for trace_id, input_stimulus in zip(received, input_stimuli):
+            self._acked[input_stimulus] = trace_id
+        self.queue.extend(input_stimuli, priority=priority)
+        for trace_id in received:
+            self.ack(trace_id, "queued")
+
+        if self.receipts:
+            self.output(
+                f"pstimReceipts: protocolAddition: {received[0] if received else None}: "
+                f"{len(input_stimuli)} stimuli, {len(created)} textures"
+            )
+
+    def trace(self, stimulus, stage):
+        self.tracer.stamp_stimulus(stimulus, stage)
+
+    def trace_displayed(self, stimulus):
+        """
+        called once the stimulus has been drawn, reports the latency breakdown
+        """
+        self.ack_stimulus(stimulus, "displayed")
+        self.tracer.stamp_stimulus(stimulus, "first_frame")
+        traced = self.tracer.finish(stimulus)
+        if traced is None:
+            return
+
+        trace_id, latencies = traced
+        if self.metrics:
+            self.metrics.latency(latencies["total"])
+        msg = f"pstimReceipts: displayed: {trace_id}: {latencies}"
+        if self.receipts:
+            self.output(msg, stimulus)
+        else:
+            self.save(str(dt.now()) + "_&_" + msg, stimulus)
+
+    def output(self, msg, stimulus=None):
+        now = str(dt.now())
+        time_ns = time.monotonic_ns()
+        remote_ns = self.clock.remote_time(time_ns) if self.clock else None
+        text = f"pandastim {now} {msg}"
+        if self.clock:
+            text += f" | t_ns: {time_ns} | remote_ns: {remote_ns}"
+        send = None
         match self.outputMethod:
-            case "print":
-                print(f"pandastim {str(dt.now())} {msg}")
             case "zmq":
-                self.publisher.socket.send_pyobj(f"pandastim {str(dt.now())} {msg}")
-                print(f"pandastim {str(dt.now())} {msg}")
+                if self.wire_format == "binary":
+                    send = functools.partial(
+                        self.publisher.send_message,
+                        "event",
+                        {
+                            "time": now,
+                            "time_ns": time_ns,
+                            "remote_ns": remote_ns,
+                            "message": msg,
+                        },
+                        flags=zmq.NOBLOCK,
+                    )
+                else:
+                    send = functools.partial(
+                        self.publisher.send_pyobj, text, flags=zmq.NOBLOCK
+                    )
             case _:
                 pass
+        self.outbox.put(send, text)
 
-        self.save(str(dt.now()) + "_&_" + msg)
+        self.save(now + "_&_" + msg, stimulus, time_ns, remote_ns)
 
-    def save(self, msg):
-        if self.filestream:
-            try:
-                stiminfo = self._stimulus.return_dict()
-            except:
-                stiminfo = None
+    def command_applied(self, name, arrival_ns, applied_ns):
+        self.output(
+            f"mailbox: {name}: frame {self.frame_index}: "
+            f"latency_ms {(applied_ns - arrival_ns) / 1e6:.3f}: "
+            f"arrival_ns {arrival_ns}: applied_ns {applied_ns}"
+        )
+
+    def output_stats(self):
+        """
+        counters from the output thread: sent, pending, dropped, send_failures, suppressed
+        """
+        return self.outbox.stats()
+
+    def save(self, msg, stimulus=None, time_ns=None, remote_ns=None):
+        if self.eventlog:
+            text = msg.split("_&_")[1]
+            self.log_event(
+                eventlog.event_name(text),
+                stimulus,
+                time_ns,
+                remote_ns,
+                flags=eventlog.event_flags(text),
+            )
+        elif self.logwriter:
             timestamp = str(dt.now())
+            line = f"\n{timestamp}_&_{msg.split('_&_')[1]}"
+            if self.clock:
+                line += f"_&_t_ns:{time_ns}_&_remote_ns:{remote_ns}"
+            # handed to the writer thread, flushed in batches off the render thread
+            self.logwriter.write(line)
 
-            self.filestream.write("\n")
-            self.filestream.write(f"{timestamp}_&_{msg.split('_&_')[1]}")
-            # self.filestream.write("\n")
-            # self.filestream.write(f"{timestamp}_&_{stiminfo}")
-            self.filestream.flush()
+    def log_event(self, event, stimulus=None, time_ns=None, remote_ns=None, flags=0):
+        """
+        one fixed size record in the binary eventlog, stimulus parameters go in its table once
+        """
+        if not self.eventlog:
+            return
+        stim_id = -1
+        if isinstance(stimulus, stimulus_details.StimulusDetails):
+            stim_id = self.eventlog.stimulus_id(stimulus)
+        if time_ns is None:
+            time_ns = time.monotonic_ns()
+        if remote_ns is None and self.clock:
+            remote_ns = self.clock.remote_time(time_ns)
+        self.eventlog.write(
+            event,
+            stim_id=stim_id,
+            frame=self.frame_index,
+            time_ns=time_ns,
+            remote_ns=remote_ns,
+            flags=flags,
+        )
+
+    def memory_report(self):
+        """
+        texture memory by class and by queued stimulus, in bytes
+        """
+        return textures.texture_registry.report(list(self.queue))
 
     def view_queue(self):
-        return self.queue
+        return self.queue.copy()
 
-    def append_queue(self, item):
-        self.queue.append(item)
+    def append_queue(self, item, priority=StimulusQueue.NORMAL):
+        self.queue.append(item, priority=priority)
 
     def pop_queue(self, index=0):
         item = self.queue.pop(index)
+        self.tracer.stamp_stimulus(item, "popped")
         return item
 
+    def preempt_pending(self):
+        # paused, nothing can be swapped in, the flag is left for after the unpause
+        if self._pauseStatus:
+            return False
+        return self.queue.take_preemption()
+
     def request_stimulus(self):
         if self._pauseStatus:
             return None
@@ -238,6 +946,29 @@ class StimulusBuddy(DirectObject.DirectObject):
     def proceed_alignment(self):
         self.output(f"pause")
 
+    def wrap_up(self):
+        """
+        closes this buddy's sockets on the comms hub, the last buddy out stops the hub
+        """
+        self._running = False
+        if self.telemetry:
+            self.telemetry.flush()
+        for subscription in self._subscriptions:
+            self.hub.close(subscription)
+        if self.metrics:
+            self.hub.close(self.metrics_publisher.handle)
+            self.hub.call(self.metrics_publisher.publisher.kill)
+        if self.clock:
+            self.hub.close(self.clock.handle)
+        self.outbox.close()
+        if self.outputMethod == "zmq":
+            self.hub.call(self.publisher.kill)
+        self.hub.release()
+        if self.logwriter:
+            self.logwriter.close()
+        if self.eventlog:
+            self.eventlog.close()
+
 
 class AligningStimBuddy(StimulusBuddy):
     """
@@ -256,46 +987,36 @@ class AligningStimBuddy(StimulusBuddy):
         self.requiresAlignment = False
         self.runningVolumes = runningVolumes
 
-        self.aSub = utils.Subscriber(port=alignmentComms["wt_output"])
-        self.aPub = utils.Publisher(port=alignmentComms["wt_input"])
-
-        self.alignmentThread = tr.Thread(target=self.msg_reception)
-        self.alignmentThread.start()
-
-    def msg_reception(self):
-        while self._running:
-            topic = self.aSub.socket.recv_string()
-            message = self.aSub.socket.recv_pyobj()
-
-            match topic:
-                case "alignment":
-
-                    match message.split("_"):
-                        case ["pause"]:
-                            messenger.send("pause")
-                            self.output(f"alignment: status: pause_request")
-                        case ["unpause"]:
-                            messenger.send("unpause")
-                            self.output(f"alignment: status: unpause_request")
-                        case ["movementAmount", moveAmt]:
-                            self.output(
-                                f"alignment: status: completed with {moveAmt} movement"
-                            )
-                            self.aligning = False
-                        case _:
-                            print(f"{message}: message not understood")
-
-                case _:
-                    print(f"{topic}: topic not understood")
+        self.aPub = utils.Publisher(port=alignmentComms["wt_input"], context=self.context)
+        # the scopeslip walky talky only speaks pickle, it runs on this machine
+        self.subscribe(
+            {"alignment": self.alignment_message},
+            alignmentComms["wt_output"],
+            allow_pickle=alignmentComms.get("allow_pickle", True),
+        )
+
+    def alignment_message(self, message):
+        match message.split("_"):
+            case ["pause"]:
+                self.mailbox.post(messenger.send, "pause", name="pause")
+                self.output(f"alignment: status: pause_request")
+            case ["unpause"]:
+                self.mailbox.post(messenger.send, "unpause", name="unpause")
+                self.output(f"alignment: status: unpause_request")
+            case ["movementAmount", moveAmt]:
+                self.output(f"alignment: status: completed with {moveAmt} movement")
+                self.aligning = False
+            case _:
+                print(f"{message}: message not understood")
 
     def proceed_alignment(self):
         self.output(f"alignment: status: started")
-        self.aPub.socket.send_string(f"stimbuddy", zmq.SNDMORE)
-        self.aPub.socket.send_pyobj(f"proceed")
+        self.hub.call(self.send_alignment, "proceed")
 
-    def wrap_up(self):
-        self._running = False
-        self.alignmentThread.join()
+    def send_alignment(self, message):
+        # hub thread only, aPub is also used from the move handler
+        self.aPub.socket.send_string(f"stimbuddy", zmq.SNDMORE)
+        self.aPub.socket.send_pyobj(message)
 
     def request_stimulus(self):
         if self._pauseStatus:
@@ -313,54 +1034,15 @@ class AligningStimBuddy(StimulusBuddy):
             self.lastReturnedStim = self.pop_queue()
             return self.lastReturnedStim
 
-    def input(self):
-        print(f"StimulusBuddy listening on {self.subscriber.port}")
-        while self._running:
-            topic = self.subscriber.socket.recv_string()
-            data = self.subscriber.socket.recv_pyobj()
-            # print(topic)
-
-            match topic:
-                case "stim":
-                    try:
-                        if not isinstance(data["texture"], dict):
-                            input_texture_0 = utils.createTexture(data["texture"][0])
-                            input_texture_1 = utils.createTexture(data["texture"][1])
-
-                        else:
-                            input_texture = utils.createTexture(data["texture"])
-
-                    except Exception as e:
-                        print(e)
-                        print(f"failed to create texture {data}")
-
-                    try:
-                        if not isinstance(data["texture"], dict):
-                            input_stimulus = stimulus_details.BinocularStimulusDetails(
-                                texture=(input_texture_0, input_texture_1),
-                                **data["stimulus"],
-                            )
-                        else:
-                            input_stimulus = stimulus_details.MonocularStimulusDetails(
-                                texture=input_texture, **data["stimulus"]
-                            )
-
-                        self.queue.append(input_stimulus)
-                        if self.receipts:
-                            self.output(
-                                f"pstimReceipts: queueAddition: {input_stimulus.return_dict()}"
-                            )
-                        # print(f'added stimulus to queue: {input_stimulus}')
-                    except Exception as e:
-                        print(e)
-                        print(f"failed to initialize stimulus {data}")
-                        if self.receipts:
-                            self.output(f"pstimReceipts: ERROR: {e}")
-                case "move":
-                    self.aPub.socket.send_string(f"stimbuddy", zmq.SNDMORE)
-                    self.aPub.socket.send_pyobj(["move", data])
-                case _:
-                    print(f"message {topic} not understood")
+    def topic_handlers(self):
+        handlers = super().topic_handlers()
+        handlers["move"] = self.forward_move
+        return handlers
+
+    def forward_move(self, data):
+        if isinstance(data, dict):
+            data = {k: v for k, v in data.items() if k != "received_ns"}
+        self.send_alignment(["move", data])
 
 
 class AlignmentTyrantBuddy(StimulusBuddy):
@@ -387,9 +1069,16 @@ class AlignmentTyrantBuddy(StimulusBuddy):
 class MultiSessionBuddy(AlignmentTyrantBuddy):
     """
     builds on tyrant -- this one is set up to stop and restart
+
+    between sessions it works through a schedule of steps (trailing frames, shutter
+    commands, the pause, alignment, re-queue) instead of sleeping. request_stimulus advances
+    the schedule each frame and returns None meanwhile, so the window keeps rendering a
+    blank screen. the alignment itself runs on a worker thread
     """
 
-    def __init__(self, pauseHours=4, repeats=10, um_steps=3, *args, **kwargs):
+    def __init__(
+        self, pauseHours=4, repeats=10, um_steps=3, progress_interval=60, *args, **kwargs
+    ):
         super().__init__(*args, **kwargs)
 
         self.baseQueue = None  # instantiate this to a copy of the queue the first time we do anything
@@ -399,74 +1088,131 @@ class MultiSessionBuddy(AlignmentTyrantBuddy):
         self.repeats = repeats  # experiment repeats
         self.n_um = um_steps
 
+        # (stage name, action, seconds to wait after it)
+        self.schedule = collections.deque()
+        self.stage = None
+        self._next_step = 0
+        self._worker = None
+        self.progress_interval = progress_interval  # seconds between progress outputs
+        self._last_progress = 0
+
     def request_stimulus(self):
         if self.oneoff == 0:
             self.baseQueue = self.queue.copy()
             self.oneoff += 1
 
+        if self.schedule:
+            self.advance_schedule()
+            return None
+
         if self._pauseStatus:
             return None
         elif len(self.queue) == 0:
             if self.repeats > 0:
                 self.repeats -= 1
-
-                ## minor sleep to get trailing frames
-                time.sleep(25)  # 25 seconds of trailing frames
-                self.wt.pub.socket.send(b"RESET")
-                time.sleep(1)
-                self.wt.pub.socket.send(b"s4 shutOff")
-                time.sleep(1)
-                self.wt.pub.socket.send(b"RUN")
-                ### self.wt.send() ### this is command for shuttering & shit
-                self.timeHolder(self.pauseDuration)
-                self.wt.pub.socket.send(b"s1 s3 shutOn")
-                time.sleep(1.5)
-                self.wt.pub.socket.send(b"RESET")
-                time.sleep(1.5)
-                self.wt.pub.socket.send(b"RUN")
-                time.sleep(1.5)
-
-                ### DO THE BIG ALIGNMENT DOODADS ###
-                self.output(f"doing the alignment things")
-                someMovementDictionary = {
-                    0: -self.n_um * 2,
-                    1: -self.n_um,
-                    2: 0,
-                    3: self.n_um,
-                    4: self.n_um * 2,
-                }
-                self.wt.pub.socket.send(b"RESET")
-                time.sleep(1)
-                self.compStack = self.wt.gather_stack(spacing=self.n_um, reps=10)
-                pa = planeAlignment.PlaneAlignment(
-                    target=self.target_image,
-                    stack=self.compStack,
-                    method="otsu",
-                )
-                self.myMatch = pa.match_calculator()
-                moveAmount = someMovementDictionary[self.myMatch]
-                self.wt.move_piezo_n(moveAmount)
-                self.output(f"alignment: status: completed with {moveAmount} movement")
-
-                self.wt.pub.socket.send(b"RESET")
-                time.sleep(1)
-                self.wt.pub.socket.send(b"s1 s3")
-                time.sleep(1)
-                self.wt.pub.socket.send(b"RUN")
-
-                ### DIRECTLY USE THE WALKYTALKY OBJECT PRESENT ###
-
-                ### DONE DOIN THE ALIGNMENT DOODADS & STUFFS ###
-
-                self.queue.extend(self.baseQueue)
-                self.lastReturnedStim = self.pop_queue()
-                return self.lastReturnedStim
-            else:
-                return None
+                self.start_intersession()
+            return None
         else:
             self.lastReturnedStim = self.pop_queue()
             return self.lastReturnedStim
 
+    def start_intersession(self):
+        send = self.wt.pub.socket.send
+        self.schedule.extend(
+            [
+                ("trailing_frames", None, 25),  # 25 seconds of trailing frames
+                ("shutter_off", lambda: send(b"RESET"), 1),
+                ("shutter_off", lambda: send(b"s4 shutOff"), 1),
+                ("pause", lambda: send(b"RUN"), self.pauseDuration * 60 * 60),
+                ("shutter_on", lambda: send(b"s1 s3 shutOn"), 1.5),
+                ("shutter_on", lambda: send(b"RESET"), 1.5),
+                ("shutter_on", lambda: send(b"RUN"), 1.5),
+                ("alignment", lambda: send(b"RESET"), 1),
+                ("alignment", self.start_alignment, 0),
+                ("resume", lambda: send(b"RESET"), 1),
+                ("resume", lambda: send(b"s1 s3"), 1),
+                ("resume", lambda: send(b"RUN"), 0),
+                ("requeue", self.requeue, 0),
+            ]
+        )
+        self._next_step = self._last_progress = time.monotonic()
+        self.output(
+            f"multiSession: started: {self.repeats} repeats left, "
+            f"next session in {self.time_to_next_session():.0f} s"
+        )
+        self.advance_schedule()
+
+    def advance_schedule(self):
+        """
+        runs every step that is due, a running alignment worker holds the schedule up
+        """
+        now = time.monotonic()
+        while self.schedule and now >= self._next_step:
+            if self._worker is not None and self._worker.is_alive():
+                break
+            stage, action, wait = self.schedule.popleft()
+            if stage != self.stage:
+                self.stage = stage
+                self.output(f"multiSession: stage: {stage}")
+            if action is not None:
+                action()
+            self._next_step = now + wait
+
+        if self.schedule and now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            self.output(
+                f"multiSession: progress: {self.stage}: "
+                f"next session in {self.time_to_next_session():.0f} s"
+            )
+
+    def time_to_next_session(self):
+        """
+        seconds left on the schedule (not counting however long the alignment takes)
+        """
+        remaining = max(0.0, self._next_step - time.monotonic())
+        return remaining + sum(wait for _, _, wait in self.schedule)
+
+    def start_alignment(self):
+        self.output(f"doing the alignment things")
+        self._worker = tr.Thread(target=self.run_alignment, daemon=True)
+        self._worker.start()
+
+    def run_alignment(self):
+        someMovementDictionary = {
+            0: -self.n_um * 2,
+            1: -self.n_um,
+            2: 0,
+            3: self.n_um,
+            4: self.n_um * 2,
+        }
+        try:
+            self.compStack = self.wt.gather_stack(spacing=self.n_um, reps=10)
+            pa = planeAlignment.PlaneAlignment(
+                target=self.target_image,
+                stack=self.compStack,
+                method="otsu",
+            )
+            self.myMatch = pa.match_calculator()
+            moveAmount = someMovementDictionary[self.myMatch]
+            self.wt.move_piezo_n(moveAmount)
+            self.output(f"alignment: status: completed with {moveAmount} movement")
+        except Exception as e:
+            self.output(f"alignment: status: failed: {e}")
+
+    def requeue(self):
+        self.stage = None
+        self.queue.extend(self.baseQueue)
+        self.output(f"multiSession: resumed: {self.repeats} repeats left")
+
+    def abort_sessions(self):
+        """
+        drops the rest of the schedule and any repeats, nothing more is queued
+        """
+        self.schedule.clear()
+        self.repeats = 0
+        self.stage = None
+        self.output(f"multiSession: aborted")
+
     @staticmethod
     def timeHolder(hours):
         """
@@ -480,18 +1226,23 @@ class MultiSessionBuddy(AlignmentTyrantBuddy):
 
 
 class GUIBuddy(StimulusBuddy):
-    def __init__(self, inputPort, *args, **kwargs):
+    def __init__(self, inputPort, *args, allow_pickle=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.gSub = utils.Subscriber(port=inputPort)
-
-        self.guiThread = tr.Thread(target=self.msg_reception)
-        self.guiThread.start()
-
-    def msg_reception(self):
-        while self._running:
-            topic = self.gSub.socket.recv_string()
-            message = self.gSub.socket.recv_pyobj()
-
-            someTex = utils.createTexture(message["texture"])
-            someStim = stimulus_details.MonocularStimulusDetails(texture=someTex)
-            messenger.send("directDriven", [someStim])
+        # allow_pickle for a gui that still pickles its messages over tcp
+        self.subscribe(
+            {None: self.msg_reception},
+            inputPort,
+            allow_pickle=allow_pickle,
+            offload={None},
+        )
+
+    def msg_reception(self, message):
+        someTex = utils.createTexture(message["texture"])
+        someStim = stimulus_details.MonocularStimulusDetails(texture=someTex)
+        self.mailbox.post(
+            messenger.send,
+            "directDriven",
+            [someStim],
+            name="directDriven",
+            arrival_ns=message.get("received_ns"),
+        )
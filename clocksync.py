@@ -0,0 +1,147 @@
+"""
+pandastim/clocksync.py
+
+ping/echo clock offset + drift estimation between pandastim and a remote process (improv,
+the imaging computer, ...) over the zmq channels the buddy already has
+
+    pandastim  --clockPing {id, t0}-------------->  remote
+    pandastim  <-clockEcho {id, t0, t1, t2}--------  remote   (clock_echo builds this)
+
+t0/t3 are pandastim's monotonic ns at send/receive, t1/t2 the remote clock at receive/send.
+each round trip gives offset = ((t1 - t0) + (t2 - t3)) / 2 and delay = (t3 - t0) - (t2 - t1),
+only the quickest round trips are trusted (their offset error is at most delay / 2) and a
+line through them gives the drift
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+def clock_echo(ping: dict, t1: int, clock=time.monotonic_ns) -> dict:
+    """
+    remote side: answer a clockPing, t1 is when it arrived -- both on the clock the remote
+    stamps its own data with
+    """
+    return {"id": ping["id"], "t0": ping["t0"], "t1": t1, "t2": clock()}
+
+
+class ClockSync:
+    """
+    keeps offset and drift estimates of a remote clock relative to time.monotonic_ns
+
+    on_ping is called every interval seconds (from its own thread, or through every(interval,
+    fxn) when given) and should get a ping (from ping()) out to the remote, echoes go back
+    into receive_echo
+    """
+
+    def __init__(
+        self,
+        on_ping=None,
+        interval=1.0,
+        window=64,
+        best_fraction=0.25,
+        drift_span=30.0,
+        every=None,
+    ):
+        self.on_ping = on_ping
+        self.interval = interval
+        self.best_fraction = best_fraction
+        # drift is only fit once the trusted samples cover this many seconds, over shorter
+        # spans round trip jitter dominates the slope
+        self.drift_span_ns = drift_span * 1e9
+
+        self.samples = collections.deque(maxlen=window)  # (local mid, offset, delay) ns
+        self._count = 0
+        self._lock = threading.Lock()
+
+        # remote = local + offset + drift * (local - reference)
+        self.reference = 0
+        self.offset = None
+        self.drift = 0.0
+        self.min_delay = None
+
+        self._stop = threading.Event()
+        self.thread = None
+        if on_ping is not None and every is not None:
+            self.handle = every(interval, on_ping)
+        elif on_ping is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.on_ping()
+            except Exception as e:
+                print(f"clock ping failed: {e}")
+
+    def ping(self) -> dict:
+        """
+        stamp right before sending, anything between here and the wire counts as delay
+        """
+        self._count += 1
+        return {"id": self._count, "t0": time.monotonic_ns()}
+
+    def receive_echo(self, echo: dict, t3=None):
+        if t3 is None:
+            t3 = time.monotonic_ns()
+        t0, t1, t2 = echo["t0"], echo["t1"], echo["t2"]
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0:
+            return
+        with self._lock:
+            self.samples.append(((t0 + t3) / 2, offset, delay))
+            self._estimate()
+
+    def _estimate(self):
+        samples = np.array(self.samples)
+        local, offsets, delays = samples.T
+
+        n_best = max(1, int(len(samples) * self.best_fraction))
+        best = np.argsort(delays)[:n_best]
+        self.min_delay = float(delays[best[0]])
+        self.reference = float(local[-1])
+
+        if n_best >= 4 and np.ptp(local[best]) >= self.drift_span_ns:
+            drift, offset = np.polyfit(local[best] - self.reference, offsets[best], 1)
+            self.drift, self.offset = float(drift), float(offset)
+        else:
+            self.drift, self.offset = 0.0, float(np.median(offsets[best]))
+
+    @property
+    def synced(self) -> bool:
+        return self.offset is not None
+
+    def remote_time(self, local_ns=None):
+        """
+        estimated remote clock (ns) at local_ns (time.monotonic_ns), None before any echo
+        """
+        if local_ns is None:
+            local_ns = time.monotonic_ns()
+        with self._lock:
+            if self.offset is None:
+                return None
+            return int(
+                local_ns + self.offset + self.drift * (local_ns - self.reference)
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "samples": len(self.samples),
+                "offset_ns": self.offset,
+                "drift_ppm": self.drift * 1e6,
+                "min_rtt_ms": self.min_delay / 1e6 if self.min_delay is not None else None,
+                # the offset can be off by at most half the quickest round trip
+                "uncertainty_ms": self.min_delay / 2e6
+                if self.min_delay is not None
+                else None,
+            }
+
+    def kill(self):
+        self._stop.set()
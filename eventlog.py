@@ -0,0 +1,251 @@
+"""
+pandastim/eventlog.py
+
+Structured binary event log, an alternative to the text logs from utils.saving
+
+layout:
+    header   magic, version, record size
+    records  append-only fixed size records (record_dtype), one per event
+    footer   json with the event type table, the stimulus parameter table and an index
+    trailer  footer offset, footer length, magic
+
+if a session dies before the footer is written the records are still readable,
+only the stimulus parameters are lost
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import atexit
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from pandastim import utils
+
+LOG_MAGIC = b"PSEL"
+FOOTER_MAGIC = b"PSEF"
+LOG_VERSION = 2
+
+header_struct = struct.Struct("<4sHH")
+trailer_struct = struct.Struct("<QQ4s")
+
+record_dtype = np.dtype(
+    [
+        ("time_ns", "<i8"),  # monotonic
+        ("wall_ns", "<i8"),  # time since epoch
+        ("frame", "<i8"),
+        ("stim_id", "<i4"),  # -1 when there is no stimulus
+        ("event", "<u2"),
+        ("flags", "<u2"),
+        ("remote_ns", "<i8"),  # estimated remote clock (see clocksync), -1 if not synced
+    ]
+)
+record_struct = struct.Struct("<qqqiHHq")
+assert record_struct.size == record_dtype.itemsize
+
+# older logs, version 1 had no remote_ns
+record_dtypes = {1: np.dtype(record_dtype.descr[:-1]), 2: record_dtype}
+
+# append only, codes are stored in the footer as well
+event_types = {
+    "other": 0,
+    "onStim": 1,
+    "motionOn": 2,
+    "stimChange": 3,
+    "queueAddition": 4,
+    "protocolAddition": 5,
+    "displayed": 6,
+    "pause": 7,
+    "alignment": 8,
+    "startup": 9,
+    "textureMemory": 10,
+    "stimRegistry": 11,
+    "clockSync": 12,
+    "mailbox": 13,
+    "motionHold": 14,
+    "stimEnd": 15,
+}
+
+
+# record flags: pause events carry the pause state
+PAUSED = 1
+UNPAUSED = 2
+
+
+def event_flags(msg: str) -> int:
+    """
+    flags for a buddy output message, "pause: True: frame 12" -> PAUSED
+    """
+    fields = [f.strip() for f in msg.split(":")]
+    if fields[0] == "pause" and len(fields) > 1:
+        return {"True": PAUSED, "False": UNPAUSED}.get(fields[1], 0)
+    return 0
+
+
+def event_name(msg: str) -> str:
+    """
+    event type from a buddy output message, receipts use their second field
+    """
+    fields = [f.strip() for f in msg.split(":")]
+    if fields[0] == "pstimReceipts" and len(fields) > 1:
+        return fields[1]
+    return fields[0]
+
+
+class EventLogWriter:
+    """
+    Writes fixed size event records through a background utils.LogWriter
+    stimulus parameters are kept once per distinct stimulus (in a utils.StimulusRegistry,
+    pass one in to share ids with published events) and written with the footer
+
+    write is called from the render thread and the comms hub, records are handed to the
+    writer and counted under one lock so the footer's record_count matches the file.
+    records the writer can't take (queue full, disk behind) are counted in dropped
+    """
+
+    def __init__(self, file_path, registry=None):
+        if "\\" in file_path:
+            file_path = file_path.replace("\\", "/")
+
+        base, ext = os.path.splitext(file_path)
+        newpath = file_path
+        val_offset = 0
+        while os.path.exists(newpath):
+            val_offset += 1
+            newpath = f"{base}_{val_offset}{ext}"
+        self.file_path = newpath
+        print(f"Saving events to {self.file_path}")
+
+        filestream = open(self.file_path, "wb")
+        filestream.write(header_struct.pack(LOG_MAGIC, LOG_VERSION, record_dtype.itemsize))
+        filestream.flush()
+        self.logwriter = utils.LogWriter(filestream)
+
+        self.record_count = 0
+        self.dropped = 0
+        self.registry = registry if registry is not None else utils.StimulusRegistry()
+        self._first_records = {}  # stim id -> first record index
+        self._lock = threading.Lock()
+        self._closed = False
+        # registered after the LogWriter's so it runs first and the footer makes it out
+        atexit.register(self.close)
+
+    def stimulus_id(self, stimulus) -> int:
+        return self.registry.register(stimulus)[0]
+
+    def write(self, event, stim_id=-1, frame=-1, time_ns=None, remote_ns=None, flags=0):
+        if time_ns is None:
+            time_ns = time.monotonic_ns()
+        if remote_ns is None:
+            remote_ns = -1
+        record = record_struct.pack(
+            time_ns,
+            time.time_ns(),
+            frame,
+            stim_id,
+            event_types.get(event, 0),
+            flags,
+            remote_ns,
+        )
+        with self._lock:
+            if self._closed:
+                return
+            if not self.logwriter.write(record):
+                self.dropped += 1
+                return
+            if stim_id >= 0:
+                self._first_records.setdefault(stim_id, self.record_count)
+            self.record_count += 1
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        footer = json.dumps(
+            {
+                "events": event_types,
+                "stimuli": dict(self.registry.items()),
+                "index": {
+                    "records_offset": header_struct.size,
+                    "record_count": self.record_count,
+                    "first_record": self._first_records,
+                },
+            },
+            default=str,
+        ).encode()
+        footer_offset = header_struct.size + self.record_count * record_dtype.itemsize
+        self.logwriter.write(
+            footer + trailer_struct.pack(footer_offset, len(footer), FOOTER_MAGIC)
+        )
+        self.logwriter.close()
+
+
+def read_event_log(file_path):
+    """
+    loads a session straight into a numpy structured array (memory mapped)
+
+    :return: records, stimulus parameter table {id: params}, event type table {name: code}
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        magic, version, record_size = header_struct.unpack(f.read(header_struct.size))
+        assert magic == LOG_MAGIC, f"{file_path} is not a pandastim event log"
+        assert version in record_dtypes, f"eventlog version {version} not understood"
+        dtype = record_dtypes[version]
+        assert record_size == dtype.itemsize, "record size mismatch"
+
+        footer_magic = None
+        if size >= header_struct.size + trailer_struct.size:
+            f.seek(size - trailer_struct.size)
+            footer_offset, footer_length, footer_magic = trailer_struct.unpack(
+                f.read(trailer_struct.size)
+            )
+        if footer_magic == FOOTER_MAGIC:
+            f.seek(footer_offset)
+            footer = json.loads(f.read(footer_length))
+            record_count = footer["index"]["record_count"]
+            stimuli = {int(k): v for k, v in footer["stimuli"].items()}
+            events = footer["events"]
+        else:
+            # no footer, session was cut short -- recover whatever records made it
+            record_count = (size - header_struct.size) // dtype.itemsize
+            stimuli = {}
+            events = event_types
+
+    records = np.memmap(
+        file_path,
+        dtype=dtype,
+        mode="r",
+        offset=header_struct.size,
+        shape=(record_count,),
+    )
+    return records, stimuli, events
+
+
+def to_dataframe(file_paths):
+    """
+    one or more sessions as a pandas DataFrame with event and stimulus names filled in
+    """
+    import pandas as pd
+
+    if isinstance(file_paths, (str, os.PathLike)):
+        file_paths = [file_paths]
+
+    frames = []
+    for session, file_path in enumerate(file_paths):
+        records, stimuli, events = read_event_log(file_path)
+        df = pd.DataFrame(np.asarray(records))
+        codes = {v: k for k, v in events.items()}
+        df["event"] = pd.Categorical(df["event"].map(codes))
+        stim_names = {
+            k: v.get("stimulus", {}).get("stim_name") if isinstance(v, dict) else None
+            for k, v in stimuli.items()
+        }
+        df["stim_name"] = df["stim_id"].map(stim_names)
+        df["session"] = session
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
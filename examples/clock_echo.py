@@ -0,0 +1,28 @@
+"""
+pandastim/examples/clock_echo.py
+
+remote side of the buddy clock sync (StimulusBuddy(clock_sync=...)): answers each clockPing
+with a clockEcho stamped on this machine's clock. run it next to (or inside) whatever
+stamps the imaging data, using the same clock for both
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import time
+
+from pandastim import clocksync, utils
+
+pandastim_ip = r"tcp://localhost:"
+publish_port = "5010"  # publish_port in the pandastim params file
+echo_port = "5006"  # the port in the buddy's pstim_comms
+
+pings = utils.Subscriber(port=publish_port, topic="clockPing", ip=pandastim_ip)
+echoes = utils.Publisher(port=echo_port)
+
+try:
+    while True:
+        topic, ping = pings.recv_message()
+        received = time.monotonic_ns()
+        echoes.send_message("clockEcho", clocksync.clock_echo(ping, received))
+except KeyboardInterrupt:
+    pings.kill()
+    echoes.kill()
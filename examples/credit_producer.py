@@ -0,0 +1,57 @@
+"""
+pandastim/examples/credit_producer.py
+
+remote producer using credit based flow control (flowcontrol.py): keeps depth stimuli waiting
+in the buddy queue, never more than the buddy has room for, and tops up as acks come back
+
+run against a buddy with zmq output, e.g. StimulusBuddy(outputMethod="zmq",
+pstim_comms={"port": "5006"}, queue_capacity=8)
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import functools
+
+from pandastim import flowcontrol, utils
+
+pandastim_ip = r"tcp://localhost:"
+publish_port = "5010"  # publish_port in the pandastim params file
+stim_port = "5006"  # the port in the buddy's pstim_comms
+depth = 2  # enough to cover texture creation on the buddy side
+
+stimuli = iter(
+    {
+        "stimulus": {
+            "stim_name": f"forward_{angle}",
+            "angle": angle,
+            "velocity": 0.05,
+            "stationary_time": 2,
+            "duration": 5,
+        },
+        "texture": {"texture_size": (1024, 1024), "texture_name": "grating_gray"},
+    }
+    for angle in range(0, 360, 15)
+)
+
+acks = utils.Subscriber(port=publish_port, topic="ack", ip=pandastim_ip)
+publisher = utils.Publisher(port=stim_port)
+producer = flowcontrol.CreditProducer(
+    functools.partial(publisher.send_message, "stim"), depth=depth
+)
+
+try:
+    while True:
+        if producer.credits is None:
+            publisher.send_message("credits", {})
+        if not acks.socket.poll(500):
+            continue
+        topic, ack = acks.recv_message()
+        producer.receive_ack(ack)
+        if ack["state"] != "credits":
+            print(ack["id"], ack["state"], producer.stats())
+        producer.fill(stimuli)
+        if not (producer.unacked or producer.waiting or producer.showing):
+            break
+except KeyboardInterrupt:
+    pass
+acks.kill()
+publisher.kill()
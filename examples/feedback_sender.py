@@ -0,0 +1,30 @@
+"""
+pandastim/examples/feedback_sender.py
+
+stand-in for a tracking process driving a ClosedLoopStimulus: sends a slowly oscillating
+gain faster than the frame rate, the stimulus only ever sees the newest sample
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import itertools
+import time
+
+import numpy as np
+
+from pandastim import utils
+
+feedback_port = "5012"  # feedback_port in the pandastim params file
+rate = 200  # hz, tracking usually runs faster than the display
+
+publisher = utils.Publisher(port=feedback_port)
+
+try:
+    for sample_id in itertools.count():
+        gain = 1 + 0.5 * np.sin(2 * np.pi * 0.2 * sample_id / rate)
+        publisher.send_latest(
+            "feedback",
+            {"gain": float(gain), "id": sample_id, "time_ns": time.monotonic_ns()},
+        )
+        time.sleep(1 / rate)
+except KeyboardInterrupt:
+    publisher.kill()
@@ -0,0 +1,51 @@
+"""
+pandastim/examples/metrics_reader.py
+
+example reader for the live rig metrics a StimulusBuddy publishes when started with metrics_rate
+
+    python metrics_reader.py          # prints each snapshot
+    python metrics_reader.py plot     # live plot of fps, queue depth and drops
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import sys
+
+from pandastim import utils
+
+metrics_port = "5011"  # matches metrics_port in the params file
+
+subscriber = utils.Subscriber(port=metrics_port, topic="metrics")
+
+plotting = len(sys.argv) > 1 and sys.argv[1] == "plot"
+if plotting:
+    import matplotlib.pyplot as plt
+
+    history = {"fps": [], "queue_depth": [], "recent_drops": []}
+    fig, axes = plt.subplots(len(history), 1, sharex=True)
+    plt.ion()
+
+try:
+    while True:
+        topic, snapshot = subscriber.recv_message()
+
+        if not plotting:
+            print(
+                f"frame {snapshot['frame']} | fps {snapshot['fps']:.1f} | "
+                f"max frame {snapshot['max_frame_ms']:.1f} ms | "
+                f"drops {snapshot['recent_drops']} ({snapshot['total_drops']} total) | "
+                f"queue {snapshot['queue_depth']} | "
+                f"latency {snapshot['stim_latency_ms']} ms | "
+                f"memory {snapshot['memory_bytes'] / 1e6:.1f} MB | "
+                f"dropped messages {snapshot['dropped_messages']}"
+            )
+            continue
+
+        for ax, (key, values) in zip(axes, history.items()):
+            values.append(snapshot[key])
+            del values[:-600]
+            ax.clear()
+            ax.plot(values)
+            ax.set_ylabel(key)
+        plt.pause(0.01)
+except KeyboardInterrupt:
+    subscriber.kill()
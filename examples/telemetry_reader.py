@@ -0,0 +1,32 @@
+"""
+pandastim/examples/telemetry_reader.py
+
+example reader for the per-frame telemetry a StimulusBuddy publishes when started with
+telemetry_batch: each message is a (frames, columns) float64 array received without copying
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import numpy as np
+
+from pandastim import utils
+
+publish_port = "5010"  # publish_port in the params file
+
+subscriber = utils.Subscriber(port=publish_port, topic="telemetry")
+
+try:
+    while True:
+        topic, data = subscriber.recv_message()
+        batch = data["array"]
+        columns = {name: n for n, name in enumerate(data["columns"])}
+
+        frames = batch[:, columns["frame"]]
+        intervals = np.diff(batch[:, columns["time_ns"]]) / 1e6
+        print(
+            f"frames {int(frames[0])}-{int(frames[-1])} | "
+            f"mean interval {intervals.mean() if len(intervals) else 0:.2f} ms | "
+            f"layer 0 x {batch[-1, columns['x_0']]:.3f} "
+            f"angle {batch[-1, columns['angle_0']]:.1f}"
+        )
+except KeyboardInterrupt:
+    subscriber.kill()
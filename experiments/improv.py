@@ -13,7 +13,13 @@ from pandastim.stimuli import stimulus, stimulus_details
 
 def pandastim_wrapper(alignment_comms):
     # handles communication from improv
-    pstim_comms = {"topic": "stim", "port": "5006", "ip": r"tcp://10.65.82.43:"}
+    # improv still sends pickles, tcp only decodes them when asked to
+    pstim_comms = {
+        "topic": "stim",
+        "port": "5006",
+        "ip": r"tcp://10.65.82.43:",
+        "allow_pickle": True,
+    }
     
 
     # paramspath = (
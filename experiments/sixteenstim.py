@@ -18,7 +18,13 @@ def pstimWrapper(alignmentPorts):
     mySavePath = r"C:\data\pstim_stimuli\matt_output.txt"
     # mySavePath = None
     # handles communication from improv
-    pstim_comms = {"topic": "stim", "port": "5006", "ip": r"tcp://10.122.170.169:"}
+    # improv still sends pickles, tcp only decodes them when asked to
+    pstim_comms = {
+        "topic": "stim",
+        "port": "5006",
+        "ip": r"tcp://10.122.170.169:",
+        "allow_pickle": True,
+    }
     paramspath = (
         Path(sys.executable)
         .parents[0]
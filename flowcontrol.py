@@ -0,0 +1,152 @@
+"""
+pandastim/flowcontrol.py
+
+credit based flow control between a remote producer and a StimulusBuddy
+
+the buddy acknowledges every stimulus it receives on the "ack" topic, each ack carries the
+number of free queue slots (credits) left after it:
+
+    producer  --stim {id, ...}-------------->  buddy
+    producer  <-ack {id, "queued", credits}---  buddy   (or "rejected" when out of credits)
+    producer  <-ack {id, "displayed", credits}  buddy   first frame drawn
+    producer  <-ack {id, "finished", credits}-  buddy   stimulus cleared
+    producer  <-ack {id, "dropped", credits}--  buddy   taken out of the queue unshown
+    producer  --credits {}------------------->  buddy   asks for {id: -1, "credits", credits}
+
+credits of -1 mean the buddy queue is unbounded (no queue_capacity). CreditProducer keeps
+track of this on the producer side so it only sends what the buddy has room for, and keeps
+no more than depth stimuli waiting -- enough to cover texture preparation, no more
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import collections
+import itertools
+import threading
+import time
+
+ack_states = ("credits", "queued", "rejected", "displayed", "finished", "dropped")
+
+
+def ack_message(stim_id, state, credits, frame=-1) -> dict:
+    assert state in ack_states, f"{state} not in ack_states"
+    return {
+        "id": stim_id,
+        "state": state,
+        "credits": credits,
+        "frame": frame,
+        "time_ns": time.monotonic_ns(),
+    }
+
+
+class CreditProducer:
+    """
+    producer side bookkeeping
+
+    send is fxn(stim_dict) that gets a stim message to the buddy, e.g.
+    functools.partial(publisher.send_message, "stim"), acks from the buddy go into
+    receive_ack. submit only sends while there is credit, fill tops the buddy queue up from
+    an iterable of stim dicts
+    """
+
+    def __init__(self, send, depth=None, history=1024):
+        self.send = send
+        self.depth = depth  # stimuli waiting in the buddy queue to aim for, None for credits
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.credits = None  # last advertised, None until the buddy has told us
+        self.unacked = set()  # sent, no queued/rejected ack yet
+        self.waiting = set()  # queued, not displayed yet
+        self.showing = set()  # displayed, not finished yet
+        self.rejected = 0
+        self.dropped = 0
+
+        self._sent_ns = {}
+        self.latencies = collections.deque(maxlen=history)  # (id, state, ms since sent)
+
+    def receive_ack(self, ack: dict):
+        stim_id, state = ack["id"], ack["state"]
+        with self._lock:
+            match state:
+                case "queued":
+                    self.unacked.discard(stim_id)
+                    self.waiting.add(stim_id)
+                case "rejected":
+                    self.unacked.discard(stim_id)
+                    self._sent_ns.pop(stim_id, None)
+                    self.rejected += 1
+                case "displayed":
+                    self.waiting.discard(stim_id)
+                    self.showing.add(stim_id)
+                case "finished":
+                    self.waiting.discard(stim_id)
+                    self.showing.discard(stim_id)
+                case "dropped":
+                    self.unacked.discard(stim_id)
+                    self.waiting.discard(stim_id)
+                    self.showing.discard(stim_id)
+                    self._sent_ns.pop(stim_id, None)
+                    self.dropped += 1
+            # credits were counted after this ack, anything still unacked is not in them
+            self.credits = ack["credits"]
+
+            sent_ns = self._sent_ns.get(stim_id)
+            if sent_ns is not None and state != "credits":
+                latency = (time.monotonic_ns() - sent_ns) / 1e6
+                self.latencies.append((stim_id, state, latency))
+                if state == "finished":
+                    del self._sent_ns[stim_id]
+
+    @property
+    def available(self) -> int:
+        """
+        how many more stimuli can go out right now (inf when the buddy queue is unbounded
+        and there is no depth)
+        """
+        with self._lock:
+            if self.credits is None:
+                return 0
+            free = float("inf") if self.credits < 0 else self.credits - len(self.unacked)
+            if self.depth is not None:
+                free = min(free, self.depth - len(self.waiting) - len(self.unacked))
+            return max(0, free)
+
+    def submit(self, stim: dict, stim_id=None):
+        """
+        sends stim if there is credit for it
+
+        :return: its id, or None when there was no credit (nothing is sent)
+        """
+        if not self.available:
+            return None
+        if stim_id is None:
+            stim_id = next(self._ids)
+        with self._lock:
+            self.unacked.add(stim_id)
+            self._sent_ns[stim_id] = time.monotonic_ns()
+        self.send({**stim, "id": stim_id})
+        return stim_id
+
+    def fill(self, stimuli) -> list:
+        """
+        sends from an iterator of stim dicts until out of credit, returns the ids sent
+        pass the same iterator again later to carry on where it left off
+        """
+        sent = []
+        while self.available:
+            stim = next(stimuli, None)
+            if stim is None:
+                break
+            sent.append(self.submit(stim))
+        return sent
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "credits": self.credits,
+                "unacked": len(self.unacked),
+                "waiting": len(self.waiting),
+                "showing": len(self.showing),
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,441 @@
+"""
+pandastim/profiling.py
+
+Lightweight timing helpers for the panda3d task loop and the stimulus buddies
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import functools
+import itertools
+import json
+import threading
+import time
+from datetime import datetime as dt
+
+import numpy as np
+
+from pandastim import utils
+
+
+class TaskProfiler:
+    """
+    Low overhead in-process profiler for task loop functions
+
+    wrap any callable with `wrap` and each call is timed into a preallocated buffer.
+    once per interval the buffers are summarized (calls, mean, p99, max in ms) and
+    dumped to a file and/or published -- cheap enough to leave running on a rig
+    """
+
+    def __init__(
+        self, interval=1.0, capacity=4096, savePath=None, publisher=None, outbox=None
+    ):
+        """
+        :param interval: seconds between summaries
+        :param capacity: samples kept per wrapped function per interval
+        :param savePath: optional path, summaries are appended as json lines
+        :param publisher: optional utils.Publisher (or shmring.ShmPublisher) to send
+            summaries out on
+        :param outbox: utils.OutputWriter that owns the publisher's thread (the buddy's),
+            sends go through it so the socket is never used from the render thread
+        """
+        self.interval_ns = int(interval * 1e9)
+        self.capacity = capacity
+        self.publisher = publisher
+        self.outbox = outbox
+
+        if savePath:
+            self.logwriter = utils.LogWriter(open(savePath, "a"))
+        else:
+            self.logwriter = None
+
+        self._samples = {}
+        self._counts = {}
+        self._last_report = time.perf_counter_ns()
+        self.last_summary = {}
+
+    def wrap(self, name, fxn):
+        """
+        returns fxn wrapped in a timer, results are stored under name
+        """
+        samples = np.zeros(self.capacity, dtype=np.int64)
+        self._samples[name] = samples
+        self._counts[name] = 0
+
+        counts = self._counts
+        capacity = self.capacity
+        clock = time.perf_counter_ns
+
+        @functools.wraps(fxn)
+        def timed(*args, **kwargs):
+            t0 = clock()
+            try:
+                return fxn(*args, **kwargs)
+            finally:
+                n = counts[name]
+                samples[n % capacity] = clock() - t0
+                counts[name] = n + 1
+
+        return timed
+
+    def summarize(self):
+        """
+        per function calls, mean, p99 and max (ms) since the last summary, resets the counts
+        """
+        summary = {}
+        for name, samples in self._samples.items():
+            n = self._counts[name]
+            if n == 0:
+                continue
+            data = samples[: min(n, self.capacity)] / 1e6
+            summary[name] = {
+                "calls": n,
+                "mean": float(data.mean()),
+                "p99": float(np.percentile(data, 99)),
+                "max": float(data.max()),
+            }
+            self._counts[name] = 0
+        return summary
+
+    def report(self):
+        self.last_summary = self.summarize()
+        if not self.last_summary:
+            return
+
+        if self.logwriter:
+            self.logwriter.write(
+                json.dumps({"time": str(dt.now()), "tasks": self.last_summary}) + "\n"
+            )
+
+        if self.publisher:
+            # same single-frame format as the buddy outputs
+            send = functools.partial(
+                self.publisher.send_pyobj,
+                f"pandastim {str(dt.now())} profile: {self.last_summary}",
+            )
+            if self.outbox is not None:
+                self.outbox.put(send)
+            else:
+                send()
+
+    def report_task(self, report_task):
+        now = time.perf_counter_ns()
+        if now - self._last_report >= self.interval_ns:
+            self._last_report = now
+            self.report()
+        return report_task.cont
+
+    def kill(self):
+        if self.logwriter:
+            self.logwriter.close()
+
+
+class StimulusTracer:
+    """
+    Follows externally received stimuli through the pipeline
+
+    each stimulus gets a correlation id on receipt and every stage it passes through is
+    stamped with monotonic nanoseconds, from zmq receive to the first displayed frame.
+    traces that won't finish are discarded: on rejects and queue drops by the buddy, and
+    when an attached stimulus is collected without being shown
+    """
+
+    stages = (
+        "received",
+        "texture_created",
+        "queued",
+        "popped",
+        "set_stimulus",
+        "first_frame",
+    )
+
+    def __init__(self):
+        # producers number their stimuli from 0 up, ids made up here for stimuli sent
+        # without one count down from -2 so the two never meet (-1 is "no id" in acks)
+        self._ids = itertools.count(-2, -1)
+        self._traces = {}  # correlation id -> {stage: ns}
+        # stimulus -> correlation id
+        self._stimuli = utils.WeakIdentityMap(on_collect=self.discard)
+
+    def start(self, cid=None):
+        """
+        opens a trace stamped as received, producer supplied ids are kept if given,
+        otherwise a negative one is made up
+        """
+        if cid is None:
+            cid = next(self._ids)
+        self._traces[cid] = {"received": time.monotonic_ns()}
+        return cid
+
+    def stamp(self, cid, stage):
+        try:
+            self._traces[cid][stage] = time.monotonic_ns()
+        except KeyError:
+            pass
+
+    def attach(self, cid, stimulus):
+        self._stimuli[stimulus] = cid
+
+    def lookup(self, stimulus):
+        return self._stimuli.get(stimulus)
+
+    def discard(self, cid):
+        """
+        drops a trace that won't finish
+        """
+        self._traces.pop(cid, None)
+
+    def discard_stimulus(self, stimulus):
+        cid = self._stimuli.pop(stimulus)
+        if cid is not None:
+            self.discard(cid)
+        return cid
+
+    def stamp_stimulus(self, stimulus, stage):
+        cid = self.lookup(stimulus)
+        if cid is not None:
+            self.stamp(cid, stage)
+        return cid
+
+    def breakdown(self, cid):
+        """
+        ms spent between each recorded stage plus the total from receipt
+        """
+        trace = self._traces[cid]
+        recorded = [s for s in self.stages if s in trace]
+        latencies = {
+            f"{a}->{b}": (trace[b] - trace[a]) / 1e6
+            for a, b in zip(recorded[:-1], recorded[1:])
+        }
+        latencies["total"] = (trace[recorded[-1]] - trace[recorded[0]]) / 1e6
+        return latencies
+
+    def finish(self, stimulus):
+        """
+        closes out the trace for a displayed stimulus
+
+        :return: (correlation id, latency breakdown) or None if the stimulus wasnt traced
+        """
+        cid = self._stimuli.pop(stimulus)
+        if cid is None or cid not in self._traces:
+            return None
+        latencies = self.breakdown(cid)
+        del self._traces[cid]
+        return cid, latencies
+
+
+class RigMetrics:
+    """
+    Rolling rig health counters for live monitoring
+
+    everything is preallocated and written only from the render thread, readers take
+    a snapshot without locking so publishing never holds up a frame
+    """
+
+    def __init__(self, fps=60, history=600):
+        """
+        :param fps: target frame rate, frames longer than 1.5 intervals count as drops
+        :param history: number of frames kept for the rolling fps and drop counts
+        """
+        self.history = history
+        self.drop_threshold_ns = int(1.5e9 / fps)
+
+        self.frame_intervals = np.zeros(history, dtype=np.int64)
+        self.frame_drops = np.zeros(history, dtype=np.uint8)
+        self.latencies = np.full(64, np.nan)
+
+        self.frame_count = 0
+        self.drop_count = 0
+        self.latency_count = 0
+        self.queue_depth = 0
+        self.memory_bytes = 0
+        self.dropped_messages = 0
+        self.command_latency_ms = 0.0
+        self._last_frame = 0
+
+    def frame(self, queue_depth):
+        """
+        call once per frame from the render thread
+        """
+        now = time.monotonic_ns()
+        if self._last_frame:
+            interval = now - self._last_frame
+            idx = self.frame_count % self.history
+            self.frame_intervals[idx] = interval
+            dropped = interval > self.drop_threshold_ns
+            self.frame_drops[idx] = dropped
+            self.drop_count += dropped
+            self.frame_count += 1
+        self._last_frame = now
+        self.queue_depth = queue_depth
+
+    def latency(self, ms):
+        self.latencies[self.latency_count % len(self.latencies)] = ms
+        self.latency_count += 1
+
+    def snapshot(self):
+        n = min(self.frame_count, self.history)
+        intervals = self.frame_intervals[:n]
+        mean_interval = intervals.mean() if n else 0
+        latencies = self.latencies[~np.isnan(self.latencies)]
+        return {
+            "time_ns": time.monotonic_ns(),
+            "frame": self.frame_count,
+            "fps": float(1e9 / mean_interval) if mean_interval else 0.0,
+            "max_frame_ms": float(intervals.max() / 1e6) if n else 0.0,
+            "recent_drops": int(self.frame_drops[:n].sum()),
+            "total_drops": int(self.drop_count),
+            "queue_depth": self.queue_depth,
+            "stim_latency_ms": float(latencies.mean()) if len(latencies) else None,
+            "memory_bytes": self.memory_bytes,
+            "dropped_messages": self.dropped_messages,
+            "command_latency_ms": self.command_latency_ms,
+        }
+
+
+class MetricsPublisher:
+    """
+    Publishes RigMetrics snapshots at a fixed rate from its own thread, or through a
+    scheduler (every(period, fxn), e.g. the buddy comms hub) when one is given
+    """
+
+    def __init__(self, metrics, publisher, rate=2.0, topic="metrics", every=None):
+        self.metrics = metrics
+        self.publisher = publisher
+        self.period = 1 / rate
+        self.topic = topic
+
+        self._stop = threading.Event()
+        self.thread = None
+        if every is not None:
+            self.handle = every(self.period, self.publish)
+        else:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self._stop.wait(self.period):
+            self.publish()
+
+    def publish(self):
+        # the binary wire format, readers off tcp never have to load a pickle
+        self.publisher.send_message(self.topic, self.metrics.snapshot())
+
+    def kill(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.publisher.kill()
+
+
+class Telemetry:
+    """
+    Per-frame stimulus kinematics recorded into a preallocated buffer, handed off in batches
+
+    one row per frame: frame, time_ns, stim_id, then x, y, angle, visible for each layer
+    (nan where a layer isn't there). every batch_size frames the rows go to on_batch as a
+    copy, so recording carries straight on in the same buffer
+    """
+
+    layer_fields = ("x", "y", "angle", "visible")
+
+    def __init__(self, batch_size=60, max_layers=4, on_batch=None):
+        self.max_layers = max_layers
+        self.on_batch = on_batch
+        self.columns = ["frame", "time_ns", "stim_id"] + [
+            f"{field}_{n}" for n in range(max_layers) for field in self.layer_fields
+        ]
+        self.buffer = np.full((batch_size, len(self.columns)), np.nan)
+        self.count = 0
+        self.batches = 0
+
+    def record(self, frame, layers, stim_id=-1, time_ns=None):
+        """
+        :param layers: (x, y, angle, visible) per layer, anything past max_layers is dropped
+        """
+        if time_ns is None:
+            time_ns = time.monotonic_ns()
+        row = self.buffer[self.count]
+        row[:] = np.nan
+        row[:3] = frame, time_ns, stim_id
+        width = len(self.layer_fields)
+        for n, layer in enumerate(layers[: self.max_layers]):
+            row[3 + n * width : 3 + (n + 1) * width] = layer
+
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.count and self.on_batch is not None:
+            self.on_batch(self.buffer[: self.count].copy())
+            self.batches += 1
+        self.count = 0
+
+
+class FeedbackLag:
+    """
+    Input -> display lag of a closed loop feedback channel, one row per displayed frame
+
+    applied is called when a feedback sample takes effect, displayed once the frame is out.
+    every frame is measured against the newest sample in effect, so a stalled tracker shows
+    up as growing lag. sent_ns is the sender's monotonic clock (same machine) and falls back
+    to the receive time. rows go to a csv through a LogWriter when file_path is given
+    """
+
+    columns = (
+        "frame",
+        "sample_id",
+        "sent_ns",
+        "received_ns",
+        "applied_ns",
+        "displayed_ns",
+    )
+
+    def __init__(self, file_path=None, history=1024):
+        self.latest = None  # (sample_id, sent_ns, received_ns, applied_ns)
+        self.lags = np.full(history, np.nan)  # ms, sent -> displayed
+        self.count = 0
+        self.samples = 0
+
+        self.logwriter = None
+        if file_path:
+            filestream = utils.saving(file_path)
+            filestream.write("\n" + ",".join(self.columns) + "\n")
+            self.logwriter = utils.LogWriter(filestream)
+
+    def applied(self, sample_id, sent_ns=None, received_ns=None, applied_ns=None):
+        if applied_ns is None:
+            applied_ns = time.monotonic_ns()
+        if received_ns is None:
+            received_ns = applied_ns
+        if sent_ns is None:
+            sent_ns = received_ns
+        self.latest = (sample_id, sent_ns, received_ns, applied_ns)
+        self.samples += 1
+
+    def displayed(self, frame, displayed_ns=None):
+        if self.latest is None:
+            return
+        if displayed_ns is None:
+            displayed_ns = time.monotonic_ns()
+        sample_id, sent_ns, received_ns, applied_ns = self.latest
+        self.lags[self.count % len(self.lags)] = (displayed_ns - sent_ns) / 1e6
+        self.count += 1
+        if self.logwriter:
+            self.logwriter.write(
+                f"{frame},{sample_id},{sent_ns},{received_ns},{applied_ns},{displayed_ns}\n"
+            )
+
+    def stats(self) -> dict:
+        lags = self.lags[~np.isnan(self.lags)]
+        return {
+            "frames": self.count,
+            "samples": self.samples,
+            "mean_ms": float(lags.mean()) if len(lags) else None,
+            "p99_ms": float(np.percentile(lags, 99)) if len(lags) else None,
+            "max_ms": float(lags.max()) if len(lags) else None,
+        }
+
+    def close(self):
+        if self.logwriter:
+            self.logwriter.close()
@@ -0,0 +1,435 @@
+"""
+pandastim/replay.py
+
+rebuilds what was on screen from a session log, either buddy text log (utils.saving) or
+binary eventlog (eventlog.py)
+
+    timeline = replay.load_session("session.txt")
+    samples = timeline.positions(rate=1000)  # analytic, vectorized over the session
+    for t, frame in replay.render(timeline, rate=30, start=60, end=120):
+        ...  # offscreen re-render, frame is h x w x 3
+
+positions follow the sequencer's own motion rules: a layer sits still until
+stationary_time, then moves by -t * velocity (t from stimulus onset, twice that for
+binocular sides), stops at hold_after and is cleared at duration. stimuli are found from
+onStim/stimChange events (with their parameters inline, or through stimRegistry with
+compact_events) and end at stimEnd, their duration, an unpause (which clears the cards)
+or the next stimulus, whichever comes first. every layer is drawn at its angle plus the
+rotation_offset param, as set_monocular/set_binocular do
+
+closed loop gain (ClosedLoopStimulus) and masked stimuli aren't in the logs, those
+segments replay open loop / blank
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import ast
+import json
+import re
+from datetime import datetime as dt
+from pathlib import Path
+
+import numpy as np
+
+from pandastim import eventlog
+
+onset_events = ("onStim", "stimChange")
+end_events = ("stimEnd",)
+max_layers = 2
+# older onMotion logs repeat stimChange within a frame or two of the real one
+duplicate_window = 0.1  # s
+
+_compact = re.compile(r"stim_id (\d+): frame (-?\d+)")
+_numpy_scalar = re.compile(r"np\.\w+\(([^()]*)\)")
+_nan = re.compile(r"\bnan\b")
+
+
+def parse_params(text):
+    """
+    a logged return_dict (its repr) back to a dict, nan comes back as nan. None if it
+    doesn't parse
+    """
+    text = _nan.sub("None", _numpy_scalar.sub(r"\1", text.strip()))
+    try:
+        params = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return None
+    if not isinstance(params, dict) or "stimulus" not in params:
+        return None
+    stim = params["stimulus"]
+    if stim.get("hold_after", 0) is None:
+        stim["hold_after"] = np.nan
+    elif isinstance(stim.get("hold_after"), (list, tuple)):
+        stim["hold_after"] = tuple(
+            np.nan if h is None else h for h in stim["hold_after"]
+        )
+    return params
+
+
+class Timeline:
+    """
+    one segment per stimulus shown: onset and end (seconds from session start), its
+    parameters, and per layer kinematics as (segments, max_layers) arrays for vectorized
+    evaluation. pauses are (start, end) rows, a stimulus still up at the end of a pause
+    ends there (unpause clears the cards, the buddy queues it again)
+    """
+
+    def __init__(self, onsets, ends, params, pauses=(), duration=None, start_wall=None):
+        order = np.argsort(onsets, kind="stable")
+        self.onsets = np.asarray(onsets, dtype=float)[order]
+        logged_ends = np.asarray(ends, dtype=float)[order]
+        self.params = [params[i] for i in order]
+        self.pauses = np.asarray(pauses, dtype=float).reshape(-1, 2)
+        self.start_wall = start_wall
+
+        n = len(self.onsets)
+        shape = (n, max_layers)
+        self.layers = np.zeros(n, dtype=int)
+        self.angle = np.full(shape, np.nan)
+        self.velocity = np.zeros(shape)  # texture units / s, binocular sides doubled
+        self.stationary = np.zeros(shape)
+        self.stop = np.full(shape, np.inf)  # duration, inf for -1
+        self.hold = np.full(shape, np.inf)  # hold_after, inf for nan
+        for i, segment in enumerate(self.params):
+            self._fill(i, segment)
+
+        # ends at the logged end, the next onset or when its longest layer finishes
+        next_onsets = np.append(self.onsets[1:], np.inf)
+        in_use = np.arange(max_layers) < self.layers[:, None]
+        longest = np.where(in_use, self.stop, -np.inf).max(1, initial=-np.inf)
+        finish = np.where(self.layers > 0, self.onsets + longest, np.inf)
+        self.ends = np.fmin(np.fmin(logged_ends, next_onsets), finish)
+        # and at the first unpause after its onset
+        unpauses = np.sort(self.pauses[:, 1])
+        after = np.searchsorted(unpauses, self.onsets, side="right")
+        unpaused = np.append(unpauses, np.inf)[after]
+        self.ends = np.fmin(self.ends, unpaused)
+
+        if duration is None:
+            duration = float(self.onsets[-1]) if n else 0.0
+        self.duration = duration
+        # still going when the log stops
+        running = np.isinf(self.ends)
+        self.ends[running] = np.fmax(duration, self.onsets[running])
+
+    def _fill(self, i, segment):
+        if not segment:
+            return
+        stim = segment["stimulus"]
+        binocular = isinstance(stim.get("velocity"), (list, tuple))
+        fields = ("angle", "velocity", "stationary_time", "duration", "hold_after")
+        defaults = {"stationary_time": 0, "duration": -1, "hold_after": np.nan}
+        try:
+            values = {f: stim[f] if f in stim else defaults[f] for f in fields}
+        except KeyError:
+            return
+        if not binocular:
+            values = {f: (v,) for f, v in values.items()}
+        count = min(len(values["velocity"]), max_layers)
+        self.layers[i] = count
+        for layer in range(count):
+            duration = values["duration"][layer]
+            hold = values["hold_after"][layer]
+            self.angle[i, layer] = values["angle"][layer]
+            # binocular sides move twice as fast, see move_binocular
+            speed = 2 if binocular else 1
+            self.velocity[i, layer] = values["velocity"][layer] * speed
+            self.stationary[i, layer] = values["stationary_time"][layer]
+            self.stop[i, layer] = np.inf if duration == -1 else duration
+            self.hold[i, layer] = np.inf if hold is None or np.isnan(hold) else hold
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def segment_at(self, times):
+        """
+        segment index shown at each time, -1 where nothing was
+        """
+        times = np.asarray(times, dtype=float)
+        segment = np.searchsorted(self.onsets, times, side="right") - 1
+        valid = segment >= 0
+        valid[valid] &= times[valid] < self.ends[segment[valid]]
+        return np.where(valid, segment, -1)
+
+    def positions(self, rate=60.0, start=0.0, end=None, times=None, hold_onfinish=True):
+        """
+        analytic per layer state sampled at rate hz (or at the given times, seconds from
+        session start), evaluated for all samples at once
+
+        :return: dict of arrays -- time, segment, then offset_n (texture shift from its
+            start position), angle_n and visible_n for each layer n
+        """
+        if times is None:
+            end = self.duration if end is None else end
+            times = np.arange(start, end, 1 / rate)
+        times = np.asarray(times, dtype=float)
+        segment = self.segment_at(times)
+        shown = segment >= 0
+        index = np.where(shown, segment, 0)
+        local = times - self.onsets[index] if len(self) else np.zeros_like(times)
+
+        samples = {"time": times, "segment": segment}
+        for layer in range(max_layers):
+            if not len(self):
+                samples[f"offset_{layer}"] = np.full(len(times), np.nan)
+                samples[f"angle_{layer}"] = np.full(len(times), np.nan)
+                samples[f"visible_{layer}"] = np.zeros(len(times), dtype=bool)
+                continue
+            present = shown & (self.layers[index] > layer)
+            velocity = self.velocity[index, layer]
+            stationary = self.stationary[index, layer]
+            stop = self.stop[index, layer]
+            moving_end = np.fmin(stop, self.hold[index, layer])
+
+            still = (local <= stationary) | (moving_end <= stationary)
+            offset = np.where(still, 0.0, -np.fmin(local, moving_end) * velocity)
+            visible = present.copy()
+            if not hold_onfinish:
+                visible &= local < stop
+
+            samples[f"offset_{layer}"] = np.where(present, offset, np.nan)
+            angle = self.angle[index, layer]
+            samples[f"angle_{layer}"] = np.where(present, angle, np.nan)
+            samples[f"visible_{layer}"] = visible
+        return samples
+
+    def to_dataframe(self, **kwargs):
+        """
+        positions(**kwargs) as a pandas DataFrame with stimulus names filled in
+        """
+        import pandas as pd
+
+        df = pd.DataFrame(self.positions(**kwargs))
+        names = [(p or {}).get("stimulus", {}).get("stim_name") for p in self.params]
+        names = np.array(names + [None], dtype=object)  # segment -1 is nothing shown
+        df["stim_name"] = names[df["segment"].to_numpy()]
+        return df
+
+    def segments(self):
+        """
+        (onset, end, params) per stimulus shown
+        """
+        return list(zip(self.onsets, self.ends, self.params))
+
+
+def parse_text_log(file_path) -> Timeline:
+    """
+    buddy text log: a timestamp line, then one "timestamp_&_message" line per event
+    (with _&_t_ns:..._&_remote_ns:... when clock sync was on, t_ns is then used for
+    timing)
+    """
+    registry = {}
+    events = []  # (seconds, wall seconds, name, params)
+    start_wall = None
+    with open(file_path) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("_&_")
+            if len(fields) < 2:
+                if start_wall is None:
+                    start_wall = _timestamp(fields[0].split("_")[-1])
+                continue
+            wall = _timestamp(fields[0])
+            if wall is None:
+                continue
+            msg = fields[1]
+            t_ns = None
+            for extra in fields[2:]:
+                if extra.startswith("t_ns:") and extra[5:].isdigit():
+                    t_ns = int(extra[5:])
+
+            name = eventlog.event_name(msg)
+            body = msg.split(":", 1)[1] if ":" in msg else ""
+            if name == "stimRegistry":
+                stim_id, params = body.split(":", 1)
+                registry[int(stim_id)] = parse_params(params)
+                continue
+            if name in onset_events:
+                compact = _compact.search(body)
+                if compact:
+                    params = registry.get(int(compact[1]))
+                else:
+                    params = parse_params(body)
+                events.append((t_ns, wall, name, params))
+            elif name in end_events:
+                events.append((t_ns, wall, name, None))
+            elif name == "pause":
+                events.append((t_ns, wall, name, body.split(":")[0].strip()))
+
+    if start_wall is None and events:
+        start_wall = events[0][1]
+    # monotonic times if every event has one, wall clock otherwise
+    if events and all(e[0] is not None for e in events):
+        zero = events[0][0] - (events[0][1] - start_wall).total_seconds() * 1e9
+        times = [(e[0] - zero) / 1e9 for e in events]
+    else:
+        times = [(e[1] - start_wall).total_seconds() for e in events]
+    names = [e[2] for e in events]
+    values = [e[3] for e in events]
+    return _build(times, names, values, start_wall)
+
+
+def parse_event_log(file_path) -> Timeline:
+    """
+    binary eventlog: onsets and ends straight from the records, parameters from its
+    stimulus table, pause state from the record flags (logs before flags were written
+    have no pauses)
+    """
+    records, stimuli, events = eventlog.read_event_log(file_path)
+    if not len(records):
+        return Timeline([], [], [])
+    codes = {v: k for k, v in events.items()}
+    times = (records["time_ns"] - records["time_ns"][0]) / 1e9
+
+    wanted = [events[name] for name in onset_events + end_events if name in events]
+    keep = np.isin(records["event"], wanted)
+    if "pause" in events:
+        keep |= (records["event"] == events["pause"]) & (records["flags"] > 0)
+    pause_states = {eventlog.PAUSED: "True", eventlog.UNPAUSED: "False"}
+    names = [codes[int(c)] for c in records["event"][keep]]
+    return _build(
+        times[keep].tolist(),
+        names,
+        [
+            pause_states.get(int(f)) if name == "pause" else stimuli.get(int(s))
+            for name, s, f in zip(
+                names, records["stim_id"][keep], records["flags"][keep]
+            )
+        ],
+        dt.fromtimestamp(records["wall_ns"][0] / 1e9),
+        duration=float(times[-1]),
+    )
+
+
+def _timestamp(text):
+    try:
+        return dt.fromisoformat(text.strip())
+    except ValueError:
+        return None
+
+
+def _build(times, names, values, start_wall, duration=None):
+    onsets, ends, params, pauses = [], [], [], []
+    paused_at = None
+    for t, name, value in zip(times, names, values):
+        if name in onset_events:
+            if params and value == params[-1] and t - onsets[-1] < duplicate_window:
+                continue
+            onsets.append(t)
+            ends.append(np.inf)
+            params.append(value)
+        elif name in end_events and ends:
+            ends[-1] = min(ends[-1], t)
+        elif name == "pause":
+            if value == "True" and paused_at is None:
+                paused_at = t
+            elif value == "False" and paused_at is not None:
+                pauses.append((paused_at, t))
+                paused_at = None
+    if duration is None and times:
+        duration = max(times)
+    return Timeline(
+        onsets, ends, params, pauses, duration=duration, start_wall=start_wall
+    )
+
+
+def load_session(file_path) -> Timeline:
+    """
+    text or binary log, told apart by the eventlog magic
+    """
+    with open(file_path, "rb") as f:
+        magic = f.read(len(eventlog.LOG_MAGIC))
+    if magic == eventlog.LOG_MAGIC:
+        return parse_event_log(file_path)
+    return parse_text_log(file_path)
+
+
+def render(
+    timeline,
+    rate=30.0,
+    start=0.0,
+    end=None,
+    window_size=(512, 512),
+    params_path=None,
+):
+    """
+    re-renders the session to an offscreen buffer, yields (time, h x w x 3 uint8 frame)
+
+    monocular layers are drawn as the sequencer draws them, binocular sides as
+    left/right halves without the strip mask. textures are rebuilt from their logged
+    parameters (array textures weren't logged, those layers come out blank)
+    """
+    from panda3d.core import CardMaker, TextureStage, loadPrcFileData
+
+    from pandastim import utils
+
+    loadPrcFileData("", "window-type offscreen\naudio-library-name null")
+    loadPrcFileData("", f"win-size {window_size[0]} {window_size[1]}")
+    from direct.showbase.ShowBase import ShowBase
+
+    if params_path is None:
+        params_path = Path(__file__).parent.joinpath(
+            "resources", "params", "default_params.json"
+        )
+    with open(params_path) as json_file:
+        params = json.load(json_file)
+    scale = np.sqrt(params["scale"])
+    rotation_offset = params["rotation_offset"]
+    center_x, center_y = params["center"]
+
+    base = ShowBase()
+    base.setBackgroundColor((0, 0, 0, 1))
+    stage = TextureStage("replay")
+    frames = [(-1, 1, -1, 1)], [(-1, 0, -1, 1), (0, 1, -1, 1)]
+    textures = {}
+    cards = []
+    shown = None
+
+    def texture(tex_dict):
+        key = repr(sorted(tex_dict.items()))
+        if key not in textures:
+            try:
+                textures[key] = utils.createTexture(tex_dict).texture
+            except Exception:
+                textures[key] = None
+        return textures[key]
+
+    # the sequencer rotates monocular and binocular textures alike
+    def show(segment):
+        for card in cards:
+            card.removeNode()
+        cards.clear()
+        if segment < 0 or not timeline.params[segment]:
+            return
+        tex_dicts = timeline.params[segment]["texture"]
+        binocular = isinstance(tex_dicts, (list, tuple))
+        tex_dicts = tex_dicts if binocular else [tex_dicts]
+        for layer, frame in enumerate(frames[binocular]):
+            cardmaker = CardMaker(f"replay_{layer}")
+            cardmaker.setFrame(*frame)
+            card = base.aspect2d.attachNewNode(cardmaker.generate())
+            tex = texture(tex_dicts[layer])
+            if tex is not None:
+                card.setTexture(stage, tex)
+            if binocular:
+                card.setTexScale(stage, 1 / scale)
+            else:
+                card.setScale(scale)
+            card.setTexRotate(stage, timeline.angle[segment, layer] + rotation_offset)
+            cards.append(card)
+
+    samples = timeline.positions(rate=rate, start=start, end=end)
+    for n, t in enumerate(samples["time"]):
+        segment = samples["segment"][n]
+        if segment != shown:
+            show(segment)
+            shown = segment
+        for layer, card in enumerate(cards):
+            card.setTexPos(stage, samples[f"offset_{layer}"][n] + center_x, center_y, 0)
+            if samples[f"visible_{layer}"][n]:
+                card.show()
+            else:
+                card.hide()
+        base.graphicsEngine.renderFrame()
+        screenshot = base.win.getScreenshot()
+        image = np.frombuffer(screenshot.getRamImageAs("RGB"), np.uint8)
+        yield t, image.reshape(screenshot.getYSize(), screenshot.getXSize(), 3)[::-1]
+    base.destroy()
@@ -0,0 +1,361 @@
+"""
+pandastim/shmring.py
+
+same-host transport: a multiprocessing.shared_memory ring buffer with a udp doorbell, an
+alternative to tcp loopback when improv and pandastim share a workstation
+
+messages are the same topic + payload (+ array) frames the zmq path sends, so ShmPublisher and
+ShmSubscriber are drop-in for utils.Publisher/Subscriber. one publisher writes a ring, any
+number of subscribers read it, each with its own cursor:
+
+    header   magic, capacity, write position (total bytes ever written), doorbell ports
+    data     records of [u32 length][u16 frame count]([u32 frame length][frame])...
+
+like a zmq PUB nothing blocks the publisher. a subscriber that falls half a ring behind (a
+message is at most half the ring, past that the publisher could be writing over it) skips
+past everything waiting and counts the drop. subscribers register a udp port in
+the header and the publisher sends one byte to each after every write, so readers sleep on a
+socket instead of spinning. a missed doorbell only costs the reader its wait timeout
+
+a publisher marks its ring closed when it goes away, subscribers then pick up the next ring
+made under the same name
+
+the ring is named after the port (pandastim_<port>), so pstim_comms/publish settings keep
+using port numbers. both ends must be on the same machine
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import pickle
+import select
+import socket
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pandastim import utils
+
+RING_MAGIC = b"PSRB"
+CLOSED_MAGIC = b"PSRX"
+default_capacity = 4 * 1024 * 1024  # bytes
+
+max_doorbells = 16
+header_struct = struct.Struct(f"<4sIQ{max_doorbells}H")
+position_struct = struct.Struct("<Q")
+position_offset = 8  # write position, after magic and capacity
+doorbell_offset = 16
+record_struct = struct.Struct("<IH")
+frame_struct = struct.Struct("<I")
+WRAP = 0xFFFFFFFF  # record length marking the rest of the ring as unused
+
+
+def ring_name(port) -> str:
+    return f"pandastim_{port}"
+
+
+def attach(name):
+    """
+    opens an existing ring without handing it to the resource tracker, before 3.13 every
+    attach is tracked and the ring would be unlinked from under the publisher when the
+    subscriber exits
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class ShmPublisher:
+    """
+    writer side, same interface as utils.Publisher
+    the ring is created (replacing a stale one left by a crashed session) and unlinked on kill
+
+    flags are taken for drop-in use with the zmq calls and ignored, a ring write never
+    blocks (it always behaves like zmq.NOBLOCK)
+    """
+
+    def __init__(self, port="1234", capacity=default_capacity, **kwargs):
+        self.port = port
+        self.name = ring_name(port)
+        try:
+            self.shm = shared_memory.SharedMemory(
+                name=self.name, create=True, size=header_struct.size + capacity
+            )
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.buf[:4] = CLOSED_MAGIC
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(
+                name=self.name, create=True, size=header_struct.size + capacity
+            )
+        self.buffer = self.shm.buf
+        self.capacity = capacity
+        self.position = 0
+        header_struct.pack_into(
+            self.buffer, 0, RING_MAGIC, capacity, 0, *([0] * max_doorbells)
+        )
+
+        self.doorbell = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.doorbell.setblocking(False)
+
+    def send_message(self, topic, data, binary=True, flags=0):
+        """
+        sends a topic + payload message, binary uses the wire format, otherwise pickle
+        """
+        payload = utils.encode_message(topic, data) if binary else pickle.dumps(data)
+        self.send_multipart([topic.encode(), payload])
+
+    def send_pyobj(self, obj, flags=0):
+        """
+        a single pickled frame like zmq's send_pyobj, read back with
+        ShmSubscriber.recv_pyobj
+        """
+        self.send_multipart([pickle.dumps(obj)])
+
+    def send_array(self, topic, array, name, flags=0, **extra):
+        """
+        sends an array as a small header plus its raw buffer (see utils.Publisher.send_array)
+        """
+        array = np.ascontiguousarray(array)
+        header = {"name": name, "shape": list(array.shape), "dtype": str(array.dtype), **extra}
+        self.send_multipart(
+            [topic.encode(), utils.encode_message(topic, header), memoryview(array).cast("B")]
+        )
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        size = record_struct.size + sum(frame_struct.size + len(f) for f in frames)
+        assert size <= self.capacity // 2, f"{size} byte message does not fit the ring"
+
+        offset = self.position % self.capacity
+        if offset + size > self.capacity:
+            # no record straddles the end, mark the tail unused and start over at 0
+            if self.capacity - offset >= record_struct.size:
+                record_struct.pack_into(self.buffer, header_struct.size + offset, WRAP, 0)
+            self.position += self.capacity - offset
+            offset = 0
+
+        at = header_struct.size + offset
+        record_struct.pack_into(self.buffer, at, size, len(frames))
+        at += record_struct.size
+        for frame in frames:
+            frame_struct.pack_into(self.buffer, at, len(frame))
+            at += frame_struct.size
+            self.buffer[at : at + len(frame)] = frame
+            at += len(frame)
+
+        # the position is published last, readers never look past it
+        self.position += size
+        position_struct.pack_into(self.buffer, position_offset, self.position)
+        self.ring()
+
+    def ring(self):
+        ports = struct.unpack_from(f"<{max_doorbells}H", self.buffer, doorbell_offset)
+        for port in ports:
+            if port:
+                try:
+                    self.doorbell.sendto(b"\0", ("127.0.0.1", port))
+                except OSError:
+                    pass
+
+    def kill(self):
+        self.buffer[:4] = CLOSED_MAGIC
+        self.ring()
+        self.doorbell.close()
+        self.buffer = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmSubscriber:
+    """
+    reader side, same interface as utils.Subscriber (topic is a prefix filter, as in zmq)
+
+    like a zmq SUB it can be made before the publisher exists and only sees messages sent
+    after it attached. recv_message blocks, poll/drain don't. doorbell is the udp socket to
+    wait on when driving it from an event loop. the ring is local, so pickles are read
+    by default like on ipc (allow_pickle=False to refuse them)
+    """
+
+    def __init__(self, port="1234", topic="", timeout=0.1, allow_pickle=True, **kwargs):
+        self.port = port
+        self.name = ring_name(port)
+        self.topic = topic.encode()
+        self.timeout = timeout
+        self.allow_pickle = allow_pickle
+        self.dropped = 0
+
+        self.doorbell = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.doorbell.bind(("127.0.0.1", 0))
+        self.doorbell.setblocking(False)
+        self.doorbell_port = self.doorbell.getsockname()[1]
+
+        self.shm = None
+        self.buffer = None
+        self._attach()
+
+    def _attach(self):
+        try:
+            shm = attach(self.name)
+        except FileNotFoundError:
+            return False
+        magic, capacity, position = header_struct.unpack_from(shm.buf, 0)[:3]
+        if magic != RING_MAGIC:
+            shm.close()
+            return False
+
+        self.shm, self.buffer = shm, shm.buf
+        self.capacity = capacity
+        self.lag_limit = capacity // 2
+        self.position = position
+        self._register()
+        return True
+
+    def _register(self):
+        ports = struct.unpack_from(f"<{max_doorbells}H", self.buffer, doorbell_offset)
+        if self.doorbell_port in ports:
+            return
+        for slot, port in enumerate(ports):
+            if not port:
+                struct.pack_into(
+                    "<H", self.buffer, doorbell_offset + 2 * slot, self.doorbell_port
+                )
+                return
+        print(f"{self.name} has no free doorbell, falling back to polling")
+
+    def _write_position(self):
+        return position_struct.unpack_from(self.buffer, position_offset)[0]
+
+    def poll(self):
+        """
+        next frames on the ring matching the topic, None when caught up
+        """
+        if self.shm is None and not self._attach():
+            return None
+
+        while True:
+            if self.buffer[:4] != RING_MAGIC:
+                # the publisher went away, look for the ring its successor makes
+                self._reattach()
+                return None
+            write_position = self._write_position()
+            if write_position == self.position:
+                return None
+            if write_position - self.position > self.lag_limit:
+                self._skip(write_position)
+                continue
+
+            offset = self.position % self.capacity
+            at = header_struct.size + offset
+            if self.capacity - offset < record_struct.size:
+                self.position += self.capacity - offset
+                continue
+            size, count = record_struct.unpack_from(self.buffer, at)
+            if size == WRAP:
+                self.position += self.capacity - offset
+                continue
+
+            at += record_struct.size
+            frames = []
+            for _ in range(count):
+                (length,) = frame_struct.unpack_from(self.buffer, at)
+                at += frame_struct.size
+                frames.append(bytes(self.buffer[at : at + length]))
+                at += length
+
+            # the publisher may have lapped us while copying, then the copy is garbage
+            if self._write_position() - self.position > self.lag_limit:
+                self._skip(self._write_position())
+                continue
+            self.position += size
+            if frames[0].startswith(self.topic):
+                return frames
+
+    def _skip(self, write_position):
+        self.dropped += 1
+        self.position = write_position
+
+    def _reattach(self):
+        self.buffer = None
+        self.shm.close()
+        self.shm = None
+        self._attach()
+
+    def drain(self):
+        """
+        every matching message waiting on the ring
+        """
+        messages = []
+        while (frames := self.poll()) is not None:
+            messages.append(frames)
+        return messages
+
+    def clear_doorbell(self):
+        try:
+            while self.doorbell.recv(64):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def recv_message(self):
+        """
+        receives a topic + payload message, blocks until one arrives
+        """
+        while (frames := self.poll()) is None:
+            select.select([self.doorbell], [], [], self.timeout)
+            self.clear_doorbell()
+        return utils.decode_frames(frames, allow_pickle=self.allow_pickle)
+
+    def recv_pyobj(self):
+        """
+        receives a single pickled frame (ShmPublisher.send_pyobj), blocks until one
+        arrives. the ring is local to this machine, the same trust as recv_pyobj on ipc
+        """
+        if not self.allow_pickle:
+            raise utils.WireFormatError("recv_pyobj needs allow_pickle")
+        while (frames := self.poll()) is None:
+            select.select([self.doorbell], [], [], self.timeout)
+            self.clear_doorbell()
+        return pickle.loads(frames[0])
+
+    def kill(self):
+        if self.shm is not None:
+            ports = struct.unpack_from(f"<{max_doorbells}H", self.buffer, doorbell_offset)
+            if self.doorbell_port in ports:
+                slot = ports.index(self.doorbell_port)
+                struct.pack_into("<H", self.buffer, doorbell_offset + 2 * slot, 0)
+            self.buffer = None
+            self.shm.close()
+        self.doorbell.close()
+
+
+def make_publisher(port, transport="tcp", context=None, sndhwm=None, capacity=None):
+    """
+    utils.Publisher for tcp, ShmPublisher for shm
+    """
+    if transport == "shm":
+        return ShmPublisher(port=port, capacity=capacity or default_capacity)
+    assert transport == "tcp", f"{transport} not in transports"
+    return utils.Publisher(port=port, context=context, sndhwm=sndhwm)
+
+
+def make_subscriber(
+    port, topic="", ip=None, context=None, transport="tcp", allow_pickle=None
+):
+    """
+    utils.Subscriber for tcp, ShmSubscriber for shm (ip is ignored, the ring is local)
+    allow_pickle None keeps each one's default: off for tcp, on for the ring
+    """
+    if transport == "shm":
+        return ShmSubscriber(
+            port=port, topic=topic, allow_pickle=allow_pickle is not False
+        )
+    assert transport == "tcp", f"{transport} not in transports"
+    return utils.Subscriber(
+        port=port, topic=topic, ip=ip, context=context, allow_pickle=allow_pickle
+    )
@@ -10,6 +10,10 @@ Example Classes given as TexMoving and BinocularMoving -- use a sequencer for ex
 
 Part of pandastim package: https://github.com/mattdloring/pandastim
 """
+import time
+
+_import_start = time.perf_counter()
+
 import json
 import os
 import sys
@@ -26,8 +30,10 @@ from panda3d.core import (CardMaker, ClockObject, ColorBlendAttrib, Transparency
                           PStatClient, Texture, TextureStage, TransformState,
                           WindowProperties)
 
-from pandastim import utils
-from pandastim.stimuli import stimulus_details
+from pandastim import profiling, utils
+from pandastim.stimuli import stimulus_details, textures
+
+_import_seconds = time.perf_counter() - _import_start
 
 
 class StimulusSequencing(ShowBase):
@@ -41,23 +47,51 @@ class StimulusSequencing(ShowBase):
     """
 
     def __init__(self, stimuli=None, params_path="./resources/params/improv_params.json", buddy=None):
+        init_start = time.perf_counter()
         super().__init__()
+        window_seconds = time.perf_counter() - init_start
 
         self.stimuli = stimuli
+        self.buddy = buddy
+
+        params_start = time.perf_counter()
+        self.load_params(params_path)
+        self.startup_report = {
+            "import": _import_seconds,
+            "params": time.perf_counter() - params_start,
+        }
+
+        self.profiler = None
+        if self.default_params.get("task_profiler", False):
+            self.enable_profiler()
 
         # if we have a stimbuddy start a task running
-        self.buddy = buddy
+        self._awaiting_frame = None
+        self._phase = None
         if self.buddy:
             self.taskMgr.add(self.buddy_task, "buddy")
-
-        self.load_params(params_path)
+            # commands from other threads are applied here, before anything else in the frame
+            self.taskMgr.add(self.mailbox_task, "mailbox", sort=-10)
+        # igLoop renders at sort 50, this runs once the frame is out
+        self.taskMgr.add(self.trace_task, "trace", sort=60)
+        if self.buddy and self.buddy.telemetry:
+            self.taskMgr.add(self.telemetry_task, "telemetry", sort=55)
+
+        window_start = time.perf_counter()
         self.format_window()
+        self.startup_report["window"] = window_seconds + time.perf_counter() - window_start
         self.enable_params()
+        self._init_done = time.perf_counter()
 
         self.current_stimulus = None
         self.running = True
 
     def set_stimulus(self):
+        if self.current_stimulus is not None:
+            self._awaiting_frame = self.current_stimulus
+            if self.buddy:
+                self.buddy.trace(self.current_stimulus, "set_stimulus")
+
         # match stimulus to stimulus details type
         match self.current_stimulus:
             case stimulus_details.MonocularStimulusDetails():
@@ -73,6 +107,27 @@ class StimulusSequencing(ShowBase):
                     f"{self.current_stimulus.__class__} -- Stimulus type not understood"
                 )
 
+        if self.current_stimulus is not None:
+            self._phase = None
+            self.enter_phase("stimulus_set")
+
+    def emit(self, event, value):
+        """
+        timeline events go out on the messenger as "pstim_<event>" with the value and the
+        frame index they happened on -- buddies accept these instead of polling every frame
+        """
+        self.messenger.send(
+            f"pstim_{event}", [value, ClockObject.getGlobalClock().getFrameCount()]
+        )
+
+    def enter_phase(self, phase):
+        """
+        stimulus_set -> motion_start -> motion_hold -> stimulus_end, emitted on change
+        """
+        if phase != self._phase:
+            self._phase = phase
+            self.emit(phase, self.current_stimulus)
+
     def set_monocular(self):
         cardmaker = CardMaker("stimcard")
         cardmaker.setFrameFullscreenQuad()
@@ -108,8 +163,12 @@ class StimulusSequencing(ShowBase):
             not np.isnan(self.current_stimulus.hold_after)
             and move_monocular_task.time >= self.current_stimulus.hold_after
         ):
-            pass
+            # a stimulus that never moved doesn't hold either
+            if self._phase == "motion_start":
+                self.enter_phase("motion_hold")
         else:
+            if self.current_stimulus.velocity != 0:
+                self.enter_phase("motion_start")
             self.new_position = (
                 -move_monocular_task.time
             ) * self.current_stimulus.velocity
@@ -179,6 +238,9 @@ class StimulusSequencing(ShowBase):
 
         # ADD TEXTURE STAGES TO CARDS
         self.left_mask.setRamImage(self.left_mask_array)
+        textures.texture_registry.register_mask(
+            "left_mask", self.left_mask, self.left_mask_array
+        )
         self.left_card.setTexture(self.left_texture_stage, tex_1)
 
         # Multiply the texture stages together
@@ -194,6 +256,9 @@ class StimulusSequencing(ShowBase):
 
         # ADD TEXTURE STAGES TO CARDS
         self.right_mask.setRamImage(self.right_mask_array)
+        textures.texture_registry.register_mask(
+            "right_mask", self.right_mask, self.right_mask_array
+        )
         self.right_card.setTexture(self.right_texture_stage, tex_2)
 
         # Multiply the texture stages together
@@ -236,6 +301,8 @@ class StimulusSequencing(ShowBase):
         self.taskMgr.add(self.move_binocular, "move_binocular")
 
     def move_binocular(self, move_binocular_task):
+        moving = False
+
         ### LEFT SIDE ###
         if move_binocular_task.time <= self.current_stimulus.stationary_time[0]:
             new_position_left = 0
@@ -251,6 +318,7 @@ class StimulusSequencing(ShowBase):
         ):
             new_position_left = self.new_position[0]
         else:
+            moving = moving or self.current_stimulus.velocity[0] != 0
             new_position_left = (
                 -move_binocular_task.time * self.current_stimulus.velocity[0] * 2
             )
@@ -276,6 +344,7 @@ class StimulusSequencing(ShowBase):
         ):
             new_position_right = self.new_position[1]
         else:
+            moving = moving or self.current_stimulus.velocity[1] != 0
             new_position_right = (
                 -move_binocular_task.time * self.current_stimulus.velocity[1] * 2
             )
@@ -287,6 +356,10 @@ class StimulusSequencing(ShowBase):
             )  # u, v, w
 
         self.new_position = new_position_left, new_position_right
+        if moving:
+            self.enter_phase("motion_start")
+        elif self._phase == "motion_start":
+            self.enter_phase("motion_hold")
 
         if move_binocular_task.time >= max(
             self.current_stimulus.duration[0], self.current_stimulus.duration[1]
@@ -333,6 +406,7 @@ class StimulusSequencing(ShowBase):
 
             ## ADD TEXTURE STAGES TO CARDS ##
             mask.setRamImage(mask_array)
+            textures.texture_registry.register_mask(f"mask_{n}", mask, mask_array)
             card.setTexture(texture_stage, tex)
 
             ## Multiply the texture stages together ##
@@ -373,7 +447,7 @@ class StimulusSequencing(ShowBase):
             self.clear_cards()
             return move_mask_task.done
 
-
+        moving = False
         for n, masked_stim in enumerate(self.current_stimulus.masked_stim_details):
             card = self.masked_stims[n]['card']
             texture_stage = self.masked_stims[n]['texture_stage']
@@ -396,6 +470,7 @@ class StimulusSequencing(ShowBase):
                     self.masked_stims[n]['finished'] = True
 
             else:
+                moving = moving or masked_stim.velocity != 0
                 new_position = (
                         -move_mask_task.time * masked_stim.velocity
                 )
@@ -406,6 +481,10 @@ class StimulusSequencing(ShowBase):
                     0,
                     )  # u, v, w
 
+        if moving:
+            self.enter_phase("motion_start")
+        elif self._phase == "motion_start":
+            self.enter_phase("motion_hold")
         return move_mask_task.cont
 
     def clear_cards(self):
@@ -430,6 +509,8 @@ class StimulusSequencing(ShowBase):
             self.taskMgr.remove("move_monocular")
             self.taskMgr.remove("move_binocular")
             self.taskMgr.remove("move_masks")
+            if self._phase not in (None, "stimulus_end"):
+                self.enter_phase("stimulus_end")
             self.current_stimulus = None
 
     def trs_transform(self):
@@ -456,9 +537,12 @@ class StimulusSequencing(ShowBase):
     def set_transforms(self):
         match self.current_stimulus:
             case stimulus_details.MonocularStimulusDetails():
+                # same rotation as set_monocular gives the card
                 self.card.setTexRotate(
                     self.texture_stage,
-                    self.current_stimulus.angle + self.angle_rotation,
+                    self.current_stimulus.angle
+                    + self.rotation_offset
+                    + self.angle_rotation,
                 )
                 self.card.setTexPos(self.texture_stage, self.center_x, self.center_y, 0)
 
@@ -495,11 +579,83 @@ class StimulusSequencing(ShowBase):
                 )
 
     def buddy_task(self, buddytask):
-        self.buddy.position(self.new_position)
-        self.buddy.stimulus(self.current_stimulus)
-        self.buddy.broadcaster()
+        # the buddy hears about stimuli/motion through the timeline events (emit), only
+        # metrics and "full" reporting still need a look every frame
+        if self.buddy.metrics:
+            self.buddy.frame_tick()
+        if self.buddy.reportingMethod == "full":
+            self.buddy.position(self.new_position)
+            self.buddy.stimulus(self.current_stimulus)
+            self.buddy.broadcaster()
         return buddytask.cont
 
+    def mailbox_task(self, mailboxtask):
+        self.buddy.mailbox.drain()
+        return mailboxtask.cont
+
+    def layer_states(self):
+        """
+        (x, y, angle, visible) of each card on screen, as the texture transforms have them
+        """
+        match self.current_stimulus:
+            case stimulus_details.MonocularStimulusDetails():
+                layers = [("card", "texture_stage")]
+            case stimulus_details.BinocularStimulusDetails():
+                layers = [
+                    ("left_card", "left_texture_stage"),
+                    ("right_card", "right_texture_stage"),
+                ]
+            case stimulus_details.MaskedStimulusDetailsPack():
+                return [
+                    self.layer_state(m["card"], m["texture_stage"])
+                    for m in self.masked_stims.values()
+                ]
+            case _:
+                return []
+        return [
+            self.layer_state(getattr(self, card), getattr(self, stage))
+            for card, stage in layers
+            if hasattr(self, card)
+        ]
+
+    @staticmethod
+    def layer_state(card, texture_stage):
+        x, y, _ = card.getTexPos(texture_stage)
+        visible = card.hasParent() and not card.isHidden()
+        return x, y, card.getTexRotate(texture_stage), visible
+
+    def telemetry_task(self, telemetrytask):
+        self.buddy.record_telemetry(self.layer_states(), self.current_stimulus)
+        return telemetrytask.cont
+
+    def trace_task(self, tracetask):
+        if self._awaiting_frame is not None:
+            if "first_texture" not in self.startup_report:
+                self.report_startup()
+            if self.buddy:
+                self.buddy.trace_displayed(self._awaiting_frame)
+            self._awaiting_frame = None
+        return tracetask.cont
+
+    def report_startup(self):
+        """
+        breaks down time-to-first-frame: imports, params, window creation, first texture
+        warns if the total goes over the startup_budget param (seconds)
+        """
+        self.startup_report["first_texture"] = time.perf_counter() - self._init_done
+        self.startup_report["time_to_first_frame"] = time.perf_counter() - _import_start
+        report = {k: round(v, 4) for k, v in self.startup_report.items()}
+
+        logging.info(f"startup: {report}")
+        if self.buddy:
+            self.buddy.output(f"startup: {report}")
+
+        budget = self.default_params.get("startup_budget")
+        if budget and self.startup_report["time_to_first_frame"] > budget:
+            logging.warning(
+                f"time to first frame {report['time_to_first_frame']} s is over the {budget} s budget"
+            )
+
     def load_params(self, params_path):
         if params_path == "default":
             default_params_path = (
@@ -538,9 +694,61 @@ class StimulusSequencing(ShowBase):
                 "projecting_fish": False,
                 "hold_onfinish": True,
                 "publish_port": 5010,
-                "scale" : 8
+                "scale" : 8,
+                "task_profiler": False,
+                "profiler_path": None,
+                "metrics_port": 5011,
+                "startup_budget": 10,
+                "send_hwm": 1000,
+                "output_queue": 1000,
+                "console_rate": 20,
+                "publish_transport": "tcp",
+                "queue_capacity": None,
+                "feedback_port": 5012,
+                "array_texture_cache": 32,
             }
 
+    def enable_profiler(self):
+        """
+        wraps the movement tasks and buddy calls in low overhead timers
+        summaries go to profiler_path and/or out on the buddy publisher (via its outbox)
+        """
+        publisher = getattr(self.buddy, "publisher", None)
+        self.profiler = profiling.TaskProfiler(
+            savePath=self.default_params.get("profiler_path"),
+            publisher=publisher,
+            outbox=getattr(self.buddy, "outbox", None),
+        )
+
+        for task_name in ["buddy_task", "move_monocular", "move_binocular", "move_masks"]:
+            setattr(
+                self, task_name, self.profiler.wrap(task_name, getattr(self, task_name))
+            )
+
+        if self.buddy:
+            # position/stimulus/broadcaster only run with "full" reporting, otherwise
+            # the buddy works from the timeline event handlers
+            for call_name in [
+                "on_stimulus_set",
+                "on_motion_start",
+                "on_motion_hold",
+                "on_stimulus_end",
+                "on_pause",
+                "position",
+                "stimulus",
+                "broadcaster",
+                "request_stimulus",
+            ]:
+                setattr(
+                    self.buddy,
+                    call_name,
+                    self.profiler.wrap(call_name, getattr(self.buddy, call_name)),
+                )
+            # the messenger holds the handlers it was given, hand it the wrapped ones
+            self.buddy.accept_timeline()
+
+        self.taskMgr.add(self.profiler.report_task, "profiler_report", sort=100)
+
     def enable_params(self):
         self.scale = np.sqrt(self.default_params["scale"])
         self.center_x = self.default_params["center"][0]
@@ -653,6 +861,8 @@ class SequencingWithPause(StimulusSequencing):
             self.buddy.proceed_alignment()
 
     def pause(self):
+        if not self.paused:
+            self.emit("pause", True)
         self.paused = True
         if not self.current_stimulus:
             self.buddy.proceed_alignment()
@@ -660,16 +870,10 @@ class SequencingWithPause(StimulusSequencing):
     def unpause(self):
         if self.paused:
             self.paused = False
+            self.emit("pause", False)
             self.clear_cards()
             self.set_stimulus()
 
-    def buddy_task(self, buddytask):
-        self.buddy.pauseStatus(self.paused)
-        self.buddy.position(self.new_position)
-        self.buddy.stimulus(self.current_stimulus)
-        self.buddy.broadcaster()
-        return buddytask.cont
-
 
 class ExternalStimulus(SequencingWithPause):
     """
@@ -696,6 +900,14 @@ class ExternalStimulus(SequencingWithPause):
 
     def buddy_task(self, buddytask):
         super().buddy_task(buddytask)
+        if self.buddy.preempt_pending():
+            # urgent stimulus pushed, swap it in on this frame
+            urgent_stimulus = self.buddy.request_stimulus()
+            if urgent_stimulus:
+                self.clear_cards()
+                self.current_stimulus = urgent_stimulus
+                self.set_stimulus()
+
         if not self.next_stimulus:
             # only run this if we do not have a next stimulus
             self.next_stimulus = self.buddy.request_stimulus()
@@ -708,6 +920,155 @@ class ExternalStimulus(SequencingWithPause):
 
         return buddytask.cont
 
+
+class ClosedLoopStimulus(StimulusSequencing):
+    """
+    this one is steered every frame by a feedback process (tail tracking, ...)
+
+    feedback comes in on its own port as single frame messages (Publisher.send_latest) on a
+    CONFLATE socket, so only the newest sample is ever waiting. each frame the newest sample
+    is applied before anything moves, it can carry any of:
+        gain      multiplies the stimulus velocity (kept across stimuli)
+        velocity  replaces the stimulus velocity until the next stimulus
+        angle     replaces the stimulus angle until the next stimulus
+        id        sample id for the lag log
+        time_ns   sender's time.monotonic_ns, lag is measured from here (same machine)
+    position is integrated frame by frame so changes take effect without jumps. monocular
+    stimuli are steered, binocular and masked ones play open loop
+
+    stimuli play in order, then come from the buddy queue if there is a buddy. the
+    input -> display lag of every frame is kept in self.lag (profiling.FeedbackLag) and
+    written to lag_path if given. the feedback socket and lag log are closed with the
+    window (destroy)
+    """
+
+    def __init__(
+        self,
+        stimuli=None,
+        *args,
+        feedback_port=None,
+        feedback_ip=None,
+        lag_path=None,
+        **kwargs,
+    ):
+        import zmq
+
+        super().__init__(stimuli, *args, **kwargs)
+
+        if feedback_port is None:
+            feedback_port = self.default_params.get("feedback_port", 5012)
+        self.feedback = utils.Subscriber(
+            port=feedback_port,
+            ip=feedback_ip,
+            context=zmq.Context.instance(),
+            conflate=True,
+        )
+
+        self.gain = 1.0
+        self.velocity = None
+        self.angle = None
+        self._last_time = 0
+        self.lag = profiling.FeedbackLag(lag_path)
+
+        # after the mailbox (-10), before the movement tasks (0)
+        self.taskMgr.add(self.feedback_task, "feedback", sort=-5)
+        # igLoop renders at sort 50, the frame is out by here
+        self.taskMgr.add(self.lag_task, "feedback_lag", sort=61)
+
+        self.curr_id = 0
+        self.current_stimulus = self.stimuli[0] if self.stimuli else None
+        self.set_stimulus()
+
+    def feedback_task(self, feedbacktask):
+        try:
+            sample = self.feedback.recv_latest()
+            if sample is not None:
+                self.apply_feedback(sample, time.monotonic_ns())
+        except Exception as e:
+            print(f"failed to apply feedback: {e}")
+        return feedbacktask.cont
+
+    def close_feedback(self):
+        if self.feedback is not None:
+            self.taskMgr.remove("feedback")
+            self.taskMgr.remove("feedback_lag")
+            self.feedback.kill()
+            self.feedback = None
+            self.lag.close()
+
+    def destroy(self):
+        # showbase calls this on exit (and it may be called again)
+        self.close_feedback()
+        super().destroy()
+
+    def apply_feedback(self, sample, received_ns=None):
+        if "gain" in sample:
+            self.gain = sample["gain"]
+        if "velocity" in sample:
+            self.velocity = sample["velocity"]
+        if "angle" in sample:
+            self.angle = sample["angle"]
+            monocular = stimulus_details.MonocularStimulusDetails
+            if isinstance(self.current_stimulus, monocular):
+                self.card.setTexRotate(
+                    self.texture_stage,
+                    self.angle + self.default_params["rotation_offset"],
+                )
+        self.lag.applied(sample.get("id", -1), sample.get("time_ns"), received_ns)
+
+    def lag_task(self, lagtask):
+        self.lag.displayed(ClockObject.getGlobalClock().getFrameCount())
+        return lagtask.cont
+
+    def set_monocular(self):
+        self.velocity = self.current_stimulus.velocity
+        self.angle = None
+        self.new_position = 0
+        self._last_time = 0
+        super().set_monocular()
+
+    def move_monocular(self, move_monocular_task):
+        t = move_monocular_task.time
+        dt = t - self._last_time
+        self._last_time = t
+        if t <= self.current_stimulus.stationary_time:
+            pass
+        elif t >= self.current_stimulus.duration != -1:
+            self.clear_cards()
+            self.new_position = 0
+            return move_monocular_task.done
+        elif (
+            not np.isnan(self.current_stimulus.hold_after)
+            and t >= self.current_stimulus.hold_after
+        ):
+            if self._phase == "motion_start":
+                self.enter_phase("motion_hold")
+        else:
+            if self.velocity * self.gain != 0:
+                self.enter_phase("motion_start")
+            self.new_position -= dt * self.velocity * self.gain
+            self.card.setTexPos(
+                self.texture_stage, self.new_position + self.center_x, self.center_y, 0
+            )
+        return move_monocular_task.cont
+
+    def clear_cards(self):
+        super().clear_cards()
+        self.curr_id += 1
+        if self.stimuli and self.curr_id < len(self.stimuli):
+            self.current_stimulus = self.stimuli[self.curr_id]
+            self.set_stimulus()
+
+    def buddy_task(self, buddytask):
+        super().buddy_task(buddytask)
+        if self.current_stimulus is None:
+            next_stimulus = self.buddy.request_stimulus()
+            if next_stimulus:
+                self.current_stimulus = next_stimulus
+                self.set_stimulus()
+        return buddytask.cont
+
+
 ### TEX MOVING AND BINOCULAR MOVING FOR EXAMPLES ON HOW TO MOVE ###
 class TexMoving(ShowBase):
     """
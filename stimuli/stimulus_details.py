@@ -5,11 +5,21 @@ defines strict parameters for stimuli to follow according to defined type -- fak
 
 Part of pandastim package: https://github.com/mattdloring/pandastim
 """
-from dataclasses import dataclass
+import functools
+from dataclasses import dataclass, field
 
 import numpy as np
 
 from pandastim import utils
+from pandastim.stimuli import textures
+
+
+@functools.lru_cache(maxsize=None)
+def default_texture(side=0):
+    """
+    shared default grating, built the first time a stimulus needs it rather than on import
+    """
+    return textures.GratingGrayTex()
 
 
 @dataclass(frozen=True)
@@ -132,8 +142,6 @@ class MonocularStimulusDetails(StimulusDetails):
     ex: 2 s statonary and 10 s duration runs a total of 10 seconds
     """
 
-    from pandastim.stimuli import textures
-
     # required
     angle: int = 0
     velocity: float = 0.0
@@ -144,7 +152,7 @@ class MonocularStimulusDetails(StimulusDetails):
     hold_after: float = np.nan
 
     # default texture is a grating, because why not
-    texture: textures.TextureBase = textures.GratingGrayTex()
+    texture: textures.TextureBase = field(default_factory=default_texture)
     stim_name: str = f"wholefield-stimulus_{velocity}_{angle}"
 
     # default master for monocular stimuli -- can be passed in local usages
@@ -180,8 +188,6 @@ class BinocularStimulusDetails(StimulusDetails):
     but may look wonk
     """
 
-    from pandastim.stimuli import textures
-
     # required
     angle: tuple = (0, 0)
     velocity: tuple = (0.0, 0.0)
@@ -194,9 +200,8 @@ class BinocularStimulusDetails(StimulusDetails):
     position: tuple = (0, 0)
     strip_angle: int = 0
 
-    texture: tuple = (
-        textures.GratingGrayTex(),
-        textures.GratingGrayTex(),
+    texture: tuple = field(
+        default_factory=lambda: (default_texture(0), default_texture(1))
     )
     stim_name: str = f"binocular-stimulus_{velocity}_{angle}"
 
@@ -235,8 +240,6 @@ class MaskedStimulusDetails(StimulusDetails):
     Contains details about a given stimulus that can be layered
     """
 
-    from pandastim.stimuli import textures
-
     # required
     angle: int = 0
     velocity: float = 0.0
@@ -249,7 +252,7 @@ class MaskedStimulusDetails(StimulusDetails):
     position: tuple = (0, 0)
     masking: tuple = (0,0,0,0) # what of axis to mask, xmin, xmax, ymin, ymax, this default is wholefield
     transparency: float = 1.
-    texture: textures.TextureBase = textures.GratingGrayTex()
+    texture: textures.TextureBase = field(default_factory=default_texture)
 
     stim_name: str = f"masked-stimulus_{velocity}_{angle}"
 
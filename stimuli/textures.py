@@ -16,18 +16,11 @@ https://www.panda3d.org/reference/python/classpanda3d_1_1core_1_1Texture.html#a8
 # TODO: add length/width parameters to the gratings texture 
 # TODO: add ellipses texture (will probably be similar to gray circle tex, with adjustments for major/minor axes?)
 
-try:
-    import cv2
-except Exception as e:
-    # shortcut for making circles on some textures
-    print("error importing cv2", e)
-try:
-    import matplotlib.pyplot as plt
-except Exception as e:
-    # need this to view the textures
-    print("error import matplotlib", e)
+# cv2 (CalibrationTriangles) and matplotlib (view) are imported where used, they are
+# slow to import and most sessions never touch them
 
 import math
+import weakref
 from abc import ABC, abstractmethod
 
 import numpy as np
@@ -36,6 +29,110 @@ from panda3d.core import Texture
 from pandastim import utils
 
 
+class TextureRegistry:
+    """
+    Keeps track of every live texture so memory use can be accounted for
+
+    TextureBase instances register themselves (weakly, they drop out once collected),
+    mask textures made in the stimulus classes are registered by name and replaced
+    when a new mask of that name is made
+    """
+
+    def __init__(self):
+        self._textures = weakref.WeakSet()
+        self._masks = {}
+
+    def register(self, texture):
+        self._textures.add(texture)
+
+    def register_mask(self, name, texture, mask_array):
+        self._masks[name] = (texture, mask_array)
+
+    def release_mask(self, name):
+        self._masks.pop(name, None)
+
+    @staticmethod
+    def texture_bytes(texture, texture_array):
+        """
+        bytes held as numpy, as a panda3d ram image, and estimated on the gpu
+        """
+        numpy_bytes = texture_array.nbytes if texture_array is not None else 0
+        ram_bytes = texture.getRamImageSize() if texture.hasRamImage() else 0
+        try:
+            gpu_bytes = texture.estimateTextureMemory()
+        except AttributeError:
+            gpu_bytes = texture.getExpectedRamImageSize()
+        return {"numpy": numpy_bytes, "ram": ram_bytes, "gpu": gpu_bytes}
+
+    @staticmethod
+    def stimulus_textures(stimulus):
+        """
+        all TextureBase objects referenced by a stimulus details object
+        """
+        if hasattr(stimulus, "masked_stim_details"):
+            return [m.texture for m in stimulus.masked_stim_details]
+        texture = getattr(stimulus, "texture", None)
+        if texture is None:
+            return []
+        if isinstance(texture, tuple):
+            return list(texture)
+        return [texture]
+
+    def report(self, stimuli=None):
+        """
+        memory held by textures, broken down by texture class and by stimulus
+
+        :param stimuli: optional sequence of (queued) stimuli to break down
+        :return: dict of by_class, masks, by_stimulus and totals, all in bytes
+        """
+        empty = {"count": 0, "numpy": 0, "ram": 0, "gpu": 0}
+        totals = dict(empty)
+        by_class = {}
+        sizes = {}
+
+        for tex in list(self._textures):
+            size = self.texture_bytes(tex.texture, tex.texture_array)
+            sizes[id(tex)] = size
+            class_totals = by_class.setdefault(type(tex).__name__, dict(empty))
+            class_totals["count"] += 1
+            for k, v in size.items():
+                class_totals[k] += v
+                totals[k] += v
+            totals["count"] += 1
+
+        masks = dict(empty)
+        for texture, mask_array in list(self._masks.values()):
+            size = self.texture_bytes(texture, mask_array)
+            masks["count"] += 1
+            for k, v in size.items():
+                masks[k] += v
+                totals[k] += v
+            totals["count"] += 1
+
+        by_stimulus = []
+        for stimulus in stimuli or []:
+            stim_totals = {"stim_name": getattr(stimulus, "stim_name", None)}
+            stim_totals.update(empty)
+            for tex in self.stimulus_textures(stimulus):
+                size = sizes.get(id(tex)) or self.texture_bytes(
+                    tex.texture, tex.texture_array
+                )
+                stim_totals["count"] += 1
+                for k, v in size.items():
+                    stim_totals[k] += v
+            by_stimulus.append(stim_totals)
+
+        return {
+            "by_class": by_class,
+            "masks": masks,
+            "by_stimulus": by_stimulus,
+            "totals": totals,
+        }
+
+
+texture_registry = TextureRegistry()
+
+
 class TextureBase(ABC):
     """
     Base texture class: subclass this for specific textures
@@ -75,6 +172,8 @@ class TextureBase(ABC):
             )
             self.texture.setRamImageAs(self.texture_array, "RGB")
 
+        texture_registry.register(self)
+
     @abstractmethod
     def create_texture(self) -> None:
         """
@@ -94,6 +193,8 @@ class TextureBase(ABC):
         """
         Plot the texture using matplotlib. Useful for debugging.
         """
+        import matplotlib.pyplot as plt
+
         plt.imshow(self.texture_array, vmin=0, vmax=255)
         if self.texture_array.ndim == 2:
             plt.set_cmap("gray")
@@ -572,6 +673,9 @@ class CalibrationTriangles(TextureBase):
         super().__init__(texture_name=texture_name, *args, **kwargs)
 
     def create_texture(self) -> np.array:
+        # shortcut for making circles
+        import cv2
+
         self.midx = self.texture_size[0] // 2
         self.midy = self.texture_size[1] // 2
 
@@ -711,4 +815,26 @@ class CallibrationDots(TextureBase):
         return (
             f"{type(self).__name__} size:{self.texture_size} center:{self.circle_center} radius:{self.circle_radius} num of circles:{self.num_circles}"
             f"bg:{self.bg_intensity} fg:{self.fg_intensity}"
-        )
\ No newline at end of file
+        )
+
+
+class ArrayTex(TextureBase):
+    """
+    Texture from an existing uint8 array: (h, w) grayscale or (h, w, 3) rgb
+    the array is used as given (no python side copy), panda copies it once into the texture
+    """
+
+    def __init__(self, texture_array, *args, texture_name="array_tex", **kwargs):
+        # asarray is a no-op for uint8 arrays, e.g. ones wrapped around a zmq buffer
+        self.texture_array = np.asarray(texture_array, dtype=np.uint8)
+        assert self.texture_array.ndim in (2, 3), "array must be (h, w) or (h, w, 3)"
+        height, width = self.texture_array.shape[:2]
+        super().__init__(
+            *args, texture_size=(width, height), texture_name=texture_name, **kwargs
+        )
+
+    def create_texture(self) -> np.array:
+        return self.texture_array
+
+    def __str__(self) -> str:
+        return f"{type(self).__name__} {self.texture_name} size:{self.texture_size}"
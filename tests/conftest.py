@@ -0,0 +1,14 @@
+"""
+pandastim/tests/conftest.py
+
+the tests import pandastim as a package, this makes a checkout importable without
+installing it (the clone has to be named pandastim, as in the readme)
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import sys
+from pathlib import Path
+
+root = Path(__file__).parents[1]
+if root.name == "pandastim" and str(root.parent) not in sys.path:
+    sys.path.insert(0, str(root.parent))
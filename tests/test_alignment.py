@@ -0,0 +1,54 @@
+"""
+pandastim/tests/test_alignment.py
+
+an AligningStimBuddy paused for alignment goes ahead once the showing stimulus ends
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import threading
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("panda3d")
+
+from pandastim.buddies import stimulus_buddies  # noqa: E402
+from pandastim.stimuli import stimulus_details  # noqa: E402
+
+default_params_path = Path(__file__).parents[1].joinpath(
+    "resources", "params", "default_params.json"
+)
+
+
+def test_alignment_after_stimulus_end():
+    buddy = stimulus_buddies.AligningStimBuddy(
+        alignmentComms={"wt_input": "5961", "wt_output": "5962"},
+        default_params_path=default_params_path,
+        receipts=False,
+        console=False,
+    )
+    sent = []
+    proceeded = threading.Event()
+
+    def send_alignment(message):
+        sent.append(message)
+        proceeded.set()
+
+    buddy.send_alignment = send_alignment
+    try:
+        stimulus = stimulus_details.MonocularStimulusDetails(angle=90, duration=5)
+        buddy.lastReturnedStim = stimulus
+        buddy.on_stimulus_set(stimulus, 0)
+        buddy.on_pause(True, 1)
+
+        # still showing, alignment waits for it to end
+        assert buddy.request_stimulus() is None
+        assert not buddy.aligning
+
+        buddy.on_stimulus_end(stimulus, 2)
+        assert buddy.request_stimulus() is None
+        assert buddy.aligning
+        assert proceeded.wait(2)
+        assert sent == ["proceed"]
+    finally:
+        buddy.wrap_up()
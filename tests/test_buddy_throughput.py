@@ -0,0 +1,19 @@
+"""
+pandastim/tests/test_buddy_throughput.py
+
+smoke test of benchmarks/buddy_throughput.py: a real buddy takes in stimuli off the hub
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import pytest
+
+pytest.importorskip("panda3d")
+
+from pandastim.benchmarks import buddy_throughput  # noqa: E402
+
+
+def test_inproc_throughput():
+    result = buddy_throughput.run("inproc", rate=100, seconds=0.5, texture_size=16)
+    assert result["sent"] == 50
+    assert result["queued"] > 0
+    assert (result["latency_ms"] >= 0).all()
@@ -0,0 +1,131 @@
+"""
+pandastim/tests/test_comms.py
+
+comms hub dispatch (offloaded handlers, pickle opt in, shm rings) and conflated feedback
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import asyncio
+import threading
+import time
+
+from pandastim import shmring, utils
+from pandastim.buddies import comms
+
+
+def test_offloaded_handlers():
+    hub = comms.CommsHub.instance()
+    publisher = utils.Publisher(port="*", context=hub.context)
+    port = publisher.socket.last_endpoint.decode().rsplit(":", 1)[1]
+
+    calls = []
+    done = threading.Event()
+
+    def slow(data):
+        time.sleep(0.2)
+        calls.append(("slow", data["n"], threading.current_thread().name))
+
+    def fast(data):
+        calls.append(("fast", data["n"], threading.current_thread().name))
+        if data["n"] == 2:
+            done.set()
+
+    handle = hub.subscribe(port, {"slow": slow, "fast": fast}, offload={"slow"})
+    try:
+        time.sleep(0.2)  # slow joiner
+        for n in range(3):
+            publisher.send_message("slow", {"n": n})
+            publisher.send_message("fast", {"n": n})
+        assert done.wait(2)
+        # the loop got through every fast message while the first slow one still ran
+        assert [c[:2] for c in calls] == [("fast", 0), ("fast", 1), ("fast", 2)]
+        deadline = time.monotonic() + 2
+        while len(calls) < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [c[1] for c in calls if c[0] == "slow"] == [0, 1, 2]
+        assert {c[2] for c in calls if c[0] == "slow"} == {
+            "pandastim-handlers_0"
+        }
+        assert {c[2] for c in calls if c[0] == "fast"} == {"pandastim-comms"}
+    finally:
+        hub.close(handle)
+        publisher.socket.close(linger=0)
+        hub.release()
+
+
+def test_conflated_feedback():
+    publisher = utils.Publisher(port="*")
+    port = publisher.socket.last_endpoint.decode().rsplit(":", 1)[1]
+    feedback = utils.Subscriber(port=port, conflate=True)
+    try:
+        assert feedback.recv_latest() is None
+        time.sleep(0.2)  # slow joiner
+        for n in range(50):
+            publisher.send_latest("feedback", {"gain": float(n), "id": n})
+        time.sleep(0.2)  # all of them delivered
+        sample = feedback.recv_latest(timeout=1000)
+        # only the newest sample waits, and after it nothing
+        assert sample == {"gain": 49.0, "id": 49}
+        assert feedback.recv_latest(timeout=50) is None
+    finally:
+        feedback.kill()
+        publisher.kill()
+
+
+def test_pickles_over_tcp_need_opt_in():
+    hub = comms.CommsHub.instance()
+    publisher = utils.Publisher(port="*", context=hub.context)
+    port = publisher.socket.last_endpoint.decode().rsplit(":", 1)[1]
+
+    received = {"refused": [], "allowed": []}
+    arrived = threading.Event()
+
+    def allowed(data):
+        received["allowed"].append(data)
+        arrived.set()
+
+    handles = [
+        hub.subscribe(port, {"stim": received["refused"].append}),
+        hub.subscribe(port, {"stim": allowed}, allow_pickle=True),
+    ]
+    try:
+        time.sleep(0.2)  # slow joiner
+        # what a legacy producer (improv) sends: topic + pickled dict
+        stim = {"id": 7, "stimulus": {"angle": 90}}
+        publisher.send_message("stim", stim, binary=False)
+        assert arrived.wait(2)
+        time.sleep(0.1)
+        assert received["allowed"][0]["id"] == 7
+        assert received["allowed"][0]["stimulus"] == {"angle": 90}
+        assert received["refused"] == []
+    finally:
+        for handle in handles:
+            hub.close(handle)
+        publisher.socket.close(linger=0)
+        hub.release()
+
+
+def test_shm_subscription():
+    hub = comms.CommsHub.instance()
+    # the ring's doorbell needs add_reader, the windows default loop doesn't have it
+    assert isinstance(hub.loop, asyncio.SelectorEventLoop)
+    publisher = shmring.ShmPublisher(port="5963", capacity=64 * 1024)
+    received = []
+    arrived = threading.Event()
+
+    def stim(data):
+        received.append(data["n"])
+        if data["n"] == 9:
+            arrived.set()
+
+    handle = hub.subscribe("5963", {"stim": stim}, transport="shm")
+    try:
+        time.sleep(0.2)  # the subscriber attaches and registers its doorbell
+        for n in range(10):
+            publisher.send_message("stim", {"n": n})
+        assert arrived.wait(2)
+        assert received == list(range(10))
+    finally:
+        hub.close(handle)
+        publisher.kill()
+        hub.release()
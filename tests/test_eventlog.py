@@ -0,0 +1,70 @@
+"""
+pandastim/tests/test_eventlog.py
+
+binary event log and stimulus registry used from several threads at once
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import threading
+
+import numpy as np
+
+from pandastim import eventlog, utils
+
+
+def test_concurrent_writes(tmp_path):
+    writer = eventlog.EventLogWriter(str(tmp_path / "session.pstim"))
+    threads, per_thread = 8, 2000
+
+    def write(n):
+        for frame in range(per_thread):
+            writer.write("motionOn", stim_id=n, frame=frame)
+
+    workers = [threading.Thread(target=write, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    writer.close()
+    writer.write("late", frame=-2)  # after close, dropped
+
+    records, stimuli, events = eventlog.read_event_log(writer.file_path)
+    # a burst past the writer's queue is dropped rather than blocking, but counted
+    assert len(records) == writer.record_count
+    assert writer.record_count + writer.dropped == threads * per_thread
+    for n in range(threads):
+        # each thread's records are whole and in the order it wrote them
+        frames = records["frame"][records["stim_id"] == n]
+        assert (np.diff(frames) > 0).all()
+    assert (records["event"] == events["motionOn"]).all()
+
+
+class Params:
+    def __init__(self, n):
+        self.n = n
+
+    def return_dict(self):
+        return {"stimulus": {"stim_name": f"stim_{self.n}"}}
+
+
+def test_concurrent_registry():
+    registry = utils.StimulusRegistry()
+    stimuli = [Params(n % 50) for n in range(4000)]
+    ids = [[] for _ in range(8)]
+    barrier = threading.Barrier(len(ids))
+
+    def register(out):
+        barrier.wait()
+        out.extend(registry.register(stimulus)[0] for stimulus in stimuli)
+
+    workers = [threading.Thread(target=register, args=(out,)) for out in ids]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # every thread saw the same ids, and each distinct stimulus got exactly one
+    assert all(out == ids[0] for out in ids)
+    assert sorted(registry.params) == list(range(50))
+    for stimulus, stim_id in zip(stimuli, ids[0]):
+        assert registry.lookup(stim_id) == stimulus.return_dict()
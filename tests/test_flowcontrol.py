@@ -0,0 +1,60 @@
+"""
+pandastim/tests/test_flowcontrol.py
+
+producer side credit bookkeeping (flowcontrol.CreditProducer) against scripted acks
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import gc
+
+from pandastim import flowcontrol, utils
+
+
+def producer(depth=None, credits=4):
+    sent = []
+    credit_producer = flowcontrol.CreditProducer(sent.append, depth=depth)
+    credit_producer.receive_ack(flowcontrol.ack_message(-1, "credits", credits))
+    return credit_producer, sent
+
+
+def test_credits_limit_sends():
+    credit_producer, sent = producer(credits=2)
+    ids = credit_producer.fill(iter([{"n": n} for n in range(5)]))
+    assert ids == [0, 1] and len(sent) == 2
+    assert credit_producer.submit({"n": 5}) is None
+
+
+def test_dropped_stimuli_free_the_depth():
+    credit_producer, sent = producer(depth=2, credits=8)
+    first, second = credit_producer.fill(iter([{}, {}, {}]))
+    for stim_id, credits in ((first, 7), (second, 6)):
+        credit_producer.receive_ack(flowcontrol.ack_message(stim_id, "queued", credits))
+    assert credit_producer.available == 0
+
+    # the buddy queue was replaced, neither stimulus will ever finish
+    for stim_id in (first, second):
+        credit_producer.receive_ack(flowcontrol.ack_message(stim_id, "dropped", 8))
+    assert credit_producer.available == 2
+    assert credit_producer.stats()["dropped"] == 2
+    assert not credit_producer.waiting and not credit_producer._sent_ns
+
+
+def test_weak_identity_map():
+    class Stimulus:
+        def __eq__(self, other):
+            return True  # like frozen dataclasses with the same parameters
+
+        def __hash__(self):
+            return 0
+
+    a, b = Stimulus(), Stimulus()
+    acked = utils.WeakIdentityMap()
+    acked[a] = 1
+    acked[b] = 2
+    assert acked[a] == 1 and acked.get(b) == 2 and len(acked) == 2
+    assert acked.pop(a) == 1 and a not in acked
+
+    del b
+    gc.collect()
+    assert len(acked) == 0
+    assert acked.get(Stimulus()) is None
@@ -0,0 +1,71 @@
+"""
+pandastim/tests/test_lazy_imports.py
+
+cv2 and matplotlib are only imported by the functions that use them, importing pandastim
+modules must not pull them in (each module is imported in a fresh interpreter)
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+heavy = ("cv2", "matplotlib")
+
+# records every attempt to import a heavy module, so an eager import is caught even
+# where the module isn't installed (or is imported inside a try)
+probe = """
+import importlib.abc, sys
+
+attempts = []
+
+class Probe(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in {heavy!r}:
+            attempts.append(name)
+        return None
+
+sys.meta_path.insert(0, Probe())
+import pandastim.{module}
+loaded = [name for name in {heavy!r} if name in sys.modules]
+assert not attempts and not loaded, (attempts, loaded)
+"""
+
+
+def import_alone(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run(
+        [sys.executable, "-c", probe.format(module=module, heavy=heavy)],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "utils",
+        "eventlog",
+        "replay",
+        "flowcontrol",
+        "shmring",
+        "clocksync",
+        "profiling",
+        "buddies.comms",
+    ],
+)
+def test_no_heavy_imports(module):
+    result = import_alone(module)
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.parametrize(
+    "module", ["stimuli.textures", "stimuli.stimulus_details", "stimuli.stimulus"]
+)
+def test_no_heavy_imports_with_panda(module):
+    pytest.importorskip("panda3d")
+    result = import_alone(module)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,56 @@
+"""
+pandastim/tests/test_log_writer.py
+
+utils.LogWriter never blocks its caller, late and overflowing writes are counted
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import io
+import threading
+
+from pandastim import utils
+
+
+def test_write_after_close(tmp_path):
+    path = tmp_path / "log.txt"
+    writer = utils.LogWriter(open(path, "w"))
+    for n in range(10):
+        writer.write(f"{n}\n")
+    writer.close()
+    writer.write("late\n")
+
+    assert path.read_text().splitlines() == [str(n) for n in range(10)]
+    assert writer.closed_drops == 1
+    assert writer.dropped == 0
+
+
+class StalledStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, data):
+        self.release.wait()
+        return super().write(data)
+
+
+def test_full_queue_drops():
+    stream = StalledStream()
+    writer = utils.LogWriter(stream, maxsize=8)
+    done = threading.Event()
+
+    def write():
+        for n in range(100):
+            writer.write(f"{n}\n")
+        done.set()
+
+    threading.Thread(target=write, daemon=True).start()
+    # the disk is stuck, the writes still return
+    assert done.wait(2)
+    assert writer.dropped > 0
+
+    stream.release.set()
+    written = []
+    stream.close = lambda: written.append(stream.getvalue())
+    writer.close()
+    assert len(written[0].splitlines()) == 100 - writer.dropped
@@ -0,0 +1,54 @@
+"""
+pandastim/tests/test_output_writer.py
+
+utils.OutputWriter sends everything put before close and drops (and counts) the rest
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import asyncio
+import threading
+
+from pandastim import utils
+
+
+def test_thread_writer():
+    sent = []
+    writer = utils.OutputWriter(console=False)
+    for n in range(100):
+        writer.put(lambda n=n: sent.append(n))
+    writer.close()
+    writer.put(lambda: sent.append("late"))
+
+    assert sent == list(range(100))
+    assert writer.stats()["sent"] == 100
+    assert writer.stats()["closed_drops"] == 1
+
+
+def test_loop_writer():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    sent = []
+    writer = utils.OutputWriter(console=False, loop=loop)
+    for n in range(100):
+        writer.put(lambda n=n: sent.append(n))
+    writer.close()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    # the hub is gone, a late put must not touch the closed loop
+    writer.put(lambda: sent.append("late"))
+
+    assert sent == list(range(100))
+    assert writer.stats()["closed_drops"] == 1
+
+
+def test_loop_closed_before_writer():
+    loop = asyncio.new_event_loop()
+    loop.close()
+    writer = utils.OutputWriter(console=False, loop=loop)
+    writer.put(lambda: None)
+    assert writer.stats()["closed_drops"] == 1
+    assert writer.stats()["pending"] == 0
+    writer.close()
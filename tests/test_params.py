@@ -0,0 +1,21 @@
+"""
+pandastim/tests/test_params.py
+
+every shipped params file carries every setting default_params.json has
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import json
+from pathlib import Path
+
+import pytest
+
+params_dir = Path(__file__).parents[1].joinpath("resources", "params")
+
+
+@pytest.mark.parametrize("path", sorted(params_dir.glob("*.json")), ids=lambda p: p.name)
+def test_params_complete(path):
+    defaults = json.loads(params_dir.joinpath("default_params.json").read_text())
+    params = json.loads(path.read_text())
+    assert set(defaults) <= set(params)
+    assert params["array_texture_cache"] > 0
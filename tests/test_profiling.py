@@ -0,0 +1,90 @@
+"""
+pandastim/tests/test_profiling.py
+
+StimulusTracer keeps stimuli apart by identity and lets go of traces that won't finish
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import dataclasses
+import gc
+
+from pandastim import profiling, utils
+
+
+@dataclasses.dataclass(frozen=True)
+class Stimulus:
+    stim_name: str = "wholefield_forward"
+    angle: float = 90
+
+
+def test_equal_stimuli_traced_apart():
+    tracer = profiling.StimulusTracer()
+    first, second = Stimulus(), Stimulus()  # a protocol repeating a stimulus
+    for cid, stimulus in ((10, first), (11, second)):
+        tracer.start(cid)
+        tracer.attach(cid, stimulus)
+        tracer.stamp(cid, "queued")
+
+    assert tracer.lookup(first) == 10
+    assert tracer.lookup(second) == 11
+    cid, latencies = tracer.finish(second)
+    assert cid == 11 and latencies["total"] >= 0
+    assert tracer.lookup(first) == 10
+    assert tracer.finish(second) is None
+
+
+def test_made_up_ids_stay_apart():
+    tracer = profiling.StimulusTracer()
+    producer, anonymous = Stimulus(), Stimulus(angle=0)
+    tracer.attach(tracer.start(0), producer)  # the producer's first id
+    tracer.attach(tracer.start(), anonymous)  # sent without one
+
+    assert tracer.lookup(anonymous) not in (0, -1)
+    produced_id, _ = tracer.finish(producer)
+    made_up_id, _ = tracer.finish(anonymous)
+    assert produced_id == 0 and made_up_id < -1
+
+
+def test_discarded_traces():
+    tracer = profiling.StimulusTracer()
+    rejected = tracer.start()  # failed before there was a stimulus
+    tracer.discard(rejected)
+
+    dropped = Stimulus()
+    tracer.attach(tracer.start(), dropped)
+    assert tracer.discard_stimulus(dropped) is not None
+    assert tracer.discard_stimulus(dropped) is None
+    assert tracer.finish(dropped) is None
+
+    collected = Stimulus()
+    tracer.attach(tracer.start(), collected)
+    del collected
+    gc.collect()
+    assert len(tracer._stimuli) == 0
+    assert tracer._traces == {}
+
+
+class Frames:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, topic, data):
+        self.sent.append([topic.encode(), utils.encode_message(topic, data)])
+
+
+def test_metrics_in_wire_format():
+    metrics = profiling.RigMetrics(fps=60)
+    for _ in range(5):
+        metrics.frame(queue_depth=3)
+    frames = Frames()
+    publisher = profiling.MetricsPublisher(metrics, frames, every=lambda *args: None)
+    publisher.publish()
+
+    topic, payload = frames.sent[0]
+    assert topic == b"metrics"
+    # no pickle, a tcp reader decodes it without allow_pickle
+    snapshot = utils.decode_message(payload)
+    assert snapshot["frame"] == 4  # intervals, the first frame only starts the clock
+    assert snapshot["queue_depth"] == 3
+    assert snapshot["stim_latency_ms"] is None
+    assert set(snapshot) == set(metrics.snapshot())
@@ -0,0 +1,159 @@
+"""
+pandastim/tests/test_replay.py
+
+replay.Timeline.positions against the sequencer's motion rules on synthetic logs
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from pandastim import eventlog, replay
+
+fps = 60
+session_start = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def monocular(
+    name, velocity=0.05, stationary_time=2, duration=10, hold_after=np.nan
+):
+    return {
+        "stimulus": {
+            "stim_name": name,
+            "angle": 90,
+            "velocity": velocity,
+            "stationary_time": stationary_time,
+            "duration": duration,
+            "hold_after": hold_after,
+        },
+        "texture": {"texture_size": (1024, 1024), "texture_name": "grating_gray"},
+    }
+
+
+def write_text_log(path, events):
+    """
+    events as (seconds, message), written the way StimulusBuddy.save does
+    """
+    with open(path, "w") as f:
+        f.write(str(session_start))
+        for t, msg in events:
+            f.write(f"\n{session_start + timedelta(seconds=t)}_&_{msg}")
+    return path
+
+
+def move_monocular(stimulus, times):
+    """
+    StimulusSequencing.move_monocular stepped frame by frame: texture offset per frame,
+    nan once the cards are cleared
+    """
+    position = 0.0
+    offsets = []
+    for t in times:
+        if t <= stimulus["stationary_time"]:
+            pass
+        elif t >= stimulus["duration"] != -1:
+            offsets.extend([np.nan] * (len(times) - len(offsets)))
+            break
+        elif not np.isnan(stimulus["hold_after"]) and t >= stimulus["hold_after"]:
+            pass
+        else:
+            position = -t * stimulus["velocity"]
+        offsets.append(position)
+    return np.array(offsets)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        monocular("plain"),
+        monocular("held", hold_after=6.0),
+        monocular("still", velocity=0.0),
+        monocular("endless", duration=-1),
+        monocular("no_wait", stationary_time=0, velocity=-0.1),
+    ],
+)
+def test_monocular_positions(tmp_path, params):
+    onset = 1.0
+    path = write_text_log(
+        tmp_path / "session.txt",
+        [(onset, f"stimChange: {params}"), (onset + 12, f"stimEnd: {params}")],
+    )
+    timeline = replay.load_session(path)
+
+    local = np.arange(1, 11 * fps) / fps  # task.time of every frame
+    expected = move_monocular(params["stimulus"], local)
+    samples = timeline.positions(times=onset + local)
+
+    shown = ~np.isnan(expected)
+    assert np.array_equal(samples["segment"] >= 0, shown)
+    # the sequencer holds its last frame's position, the analytic one the exact time
+    tolerance = abs(params["stimulus"]["velocity"]) / fps + 1e-12
+    offsets = samples["offset_0"][shown]
+    assert np.allclose(offsets, expected[shown], atol=tolerance, rtol=0)
+    assert (samples["angle_0"][shown] == 90).all()
+    assert not samples["visible_1"].any()
+
+
+def test_stimulus_ends(tmp_path):
+    first, second = monocular("first", duration=30), monocular("second", duration=4)
+    path = write_text_log(
+        tmp_path / "session.txt",
+        [
+            (0.0, f"stimChange: {first}"),
+            (0.016, f"stimChange: {first}"),  # repeated within a frame, one segment
+            (5.0, f"stimEnd: {first}"),
+            (6.0, f"stimChange: {second}"),
+            (20.0, "pause: True: frame 1200"),
+            (21.0, f"stimChange: {first}"),
+            (25.0, "pause: True: frame 1500"),
+            (27.0, "pause: False: frame 1620"),
+        ],
+    )
+    timeline = replay.load_session(path)
+    assert len(timeline) == 3
+    # logged end, its own duration, then the unpause clears it
+    assert np.allclose(timeline.ends, [5.0, 10.0, 27.0])
+    assert np.allclose(timeline.pauses, [[20.0, 27.0]])
+    assert list(timeline.segment_at([4.9, 5.1, 9.9, 10.1, 26.9, 27.1])) == [
+        0, -1, 1, -1, 2, -1
+    ]
+
+
+class Stimulus:
+    def __init__(self, params):
+        self.params = params
+
+    def return_dict(self):
+        return self.params
+
+
+def test_event_log(tmp_path):
+    writer = eventlog.EventLogWriter(str(tmp_path / "session.pstim"))
+    params = monocular("logged", duration=-1)
+    stim_id = writer.stimulus_id(Stimulus(params))
+    t0 = 10**12
+    for t, event, flags in [
+        (0.0, "startup", 0),
+        (1.0, "stimChange", 0),
+        (3.0, "pause", eventlog.PAUSED),
+        (4.0, "pause", eventlog.UNPAUSED),
+        (9.0, "other", 0),
+    ]:
+        writer.write(
+            event,
+            stim_id=stim_id if event == "stimChange" else -1,
+            time_ns=t0 + int(t * 1e9),
+            flags=flags,
+        )
+    writer.close()
+
+    timeline = replay.load_session(writer.file_path)
+    assert len(timeline) == 1
+    assert timeline.params[0]["stimulus"]["stim_name"] == "logged"
+    assert np.allclose(timeline.pauses, [[3.0, 4.0]])
+    assert timeline.ends[0] == pytest.approx(4.0)
+    samples = timeline.positions(times=[2.0, 3.5, 5.0])
+    assert list(samples["segment"]) == [0, 0, -1]
+    assert samples["offset_0"][1] == pytest.approx(-3.5 * 0.05 + 1.0 * 0.05)
@@ -0,0 +1,42 @@
+"""
+pandastim/tests/test_stimulus_queue.py
+
+StimulusQueue pops in play order, like list.pop on its flattened levels
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import pytest
+
+pytest.importorskip("panda3d")
+
+from pandastim.buddies.stimulus_buddies import StimulusQueue  # noqa: E402
+
+
+def make_queue():
+    queue = StimulusQueue()
+    queue.append("normal_0")
+    queue.append("urgent_0", priority=StimulusQueue.URGENT)
+    queue.append("high_0", priority=StimulusQueue.HIGH)
+    queue.append("normal_1")
+    queue.append("high_1", priority=StimulusQueue.HIGH)  # appended last
+    return queue
+
+
+def test_pop_ends():
+    queue = make_queue()
+    assert queue.pop(0) == "urgent_0"
+    # the back of the lowest level, not the last appended
+    assert queue.pop(-1) == "normal_1"
+    assert queue.pop(-1) == "normal_0"
+    assert queue.pop(-1) == "high_1"
+    assert queue.pop() == "high_0"
+    with pytest.raises(IndexError):
+        queue.pop(-1)
+
+
+@pytest.mark.parametrize("index", [1, 2, -2, -4])
+def test_pop_matches_flattened(index):
+    queue = make_queue()
+    flattened = ["urgent_0", "high_0", "high_1", "normal_0", "normal_1"]
+    assert queue.pop(index) == flattened.pop(index)
+    assert list(queue) == flattened
@@ -0,0 +1,210 @@
+"""
+pandastim/tests/test_wire_format.py
+
+round trips through the binary wire format (utils.encode_message/decode_message)
+
+Part of pandastim package: https://github.com/mattdloring/pandastim
+"""
+import math
+import pickle
+
+import numpy as np
+import pytest
+
+from pandastim import utils
+
+monocular_stim = {
+    "stimulus": {
+        "stim_name": "wholefield_forward",
+        "angle": 90,
+        "velocity": 0.05,
+        "stationary_time": 5,
+        "duration": 20,
+        "hold_after": 12.5,
+    },
+    "texture": {
+        "texture_size": (1024, 1024),
+        "texture_name": "grating_gray",
+        "frequency": 32,
+    },
+    "priority": 1,
+    "id": 7,
+}
+
+binocular_stim = {
+    "stimulus": {
+        "stim_name": "binocular_converging",
+        "angle": (90, 270),
+        "velocity": (0.05, 0.05),
+        "stationary_time": (5, 5),
+        "duration": (20, 20),
+        "strip_width": 8,
+        "position": (0, 0),
+        "strip_angle": 0,
+    },
+    "texture": [
+        {"texture_size": (1024, 1024), "texture_name": "grating_gray"},
+        {"texture_size": (512, 512), "texture_name": "sin_gray", "frequency": 16},
+    ],
+}
+
+
+def is_pickled(frame) -> bool:
+    return bool(utils.wire_header.unpack_from(frame, 0)[3] & utils.WIRE_PICKLED)
+
+
+def retyped(frame, topic) -> bytes:
+    """
+    the same frame with its header message type swapped for topic's
+    """
+    magic, version, _, flags, length = utils.wire_header.unpack_from(frame, 0)
+    header = utils.wire_header.pack(
+        magic, version, utils.wire_types[topic], flags, length
+    )
+    return header + frame[utils.wire_header.size :]
+
+
+@pytest.mark.parametrize(
+    "topic, data",
+    [
+        ("stim", monocular_stim),
+        ("stim", binocular_stim),
+        ("protocol", {"textures": [{"texture_name": "grating_gray"}], "stimuli": []}),
+        ("move", 3),
+        ("event", {"time": "2024-01-01 12:00:00", "message": "motionOn: x"}),
+        ("ack", {"id": 3, "state": "queued", "credits": -1, "frame": 10}),
+        ("feedback", {"gain": 1.5, "id": 2, "time_ns": 2**40}),
+        ("unregistered", {"key": [None, True, False, -(2**40), 1.25, "x", b"\x00"]}),
+    ],
+)
+def test_round_trip(topic, data):
+    frame = utils.encode_message(topic, data)
+    assert not is_pickled(frame)
+    assert utils.decode_message(frame) == data
+
+
+def test_types_kept():
+    data = {"tuple": (1, 2), "list": [1, 2], "nested": {"inner": ((1,), [2])}}
+    decoded = utils.decode_message(utils.encode_message("move", data))
+    assert type(decoded["tuple"]) is tuple
+    assert type(decoded["list"]) is list
+    assert decoded["nested"]["inner"] == ((1,), [2])
+
+
+def test_numpy_values():
+    data = {"angle": np.int64(90), "velocity": np.float32(0.5), "on": np.bool_(True)}
+    decoded = utils.decode_message(utils.encode_message("move", data))
+    assert decoded == {"angle": 90, "velocity": 0.5, "on": True}
+
+
+def test_nan_round_trips():
+    stim = {**monocular_stim, "stimulus": {"stim_name": "s", "hold_after": np.nan}}
+    decoded = utils.decode_message(utils.encode_message("stim", stim))
+    assert math.isnan(decoded["stimulus"]["hold_after"])
+
+
+@pytest.mark.parametrize("n", [0xFFFF, 0x10000, 70000])
+def test_long_containers(n):
+    data = {"list": list(range(n)), "tuple": tuple(range(n)), "dict": {}}
+    data["dict"] = {f"k{i}": i for i in range(n)}
+    frame = utils.encode_message("move", data)
+    assert not is_pickled(frame)
+    assert utils.decode_message(frame) == data
+
+
+def test_long_bytes_and_str():
+    data = {"bytes": bytes(200_000), "text": "x" * 200_000}
+    assert utils.decode_message(utils.encode_message("move", data)) == data
+
+
+def test_untyped_falls_back_to_pickle():
+    data = {"array": np.arange(3)}
+    frame = utils.encode_message("move", data)
+    assert is_pickled(frame)
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame)
+    assert np.array_equal(utils.decode_message(frame, allow_pickle=True)["array"], [0, 1, 2])
+
+
+def test_non_str_keys_are_not_stringified():
+    data = {1: "one", (2, 3): "pair"}
+    frame = utils.encode_message("move", data)
+    assert is_pickled(frame)
+    assert utils.decode_message(frame, allow_pickle=True) == data
+
+
+def test_plain_pickle_needs_allow_pickle():
+    frame = pickle.dumps({"stimulus": {}})
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame)
+    assert utils.decode_message(frame, allow_pickle=True) == {"stimulus": {}}
+
+
+def test_pickled_frames_rejected_by_default():
+    topic, payload = b"stim", utils.encode_message("move", {"array": np.zeros(2)})
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_frames([topic, payload])
+    topic, data = utils.decode_frames([topic, payload], allow_pickle=True)
+    assert topic == "stim" and np.array_equal(data["array"], [0, 0])
+
+
+def test_schema_on_encode():
+    # missing texture: encoded, but not as a typed stim message
+    assert is_pickled(utils.encode_message("stim", {"stimulus": {}}))
+    # field types are left to the receiver
+    bad = {**monocular_stim, "stimulus": {"stim_name": 3}}
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(utils.encode_message("stim", bad))
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"stimulus": {}},  # no texture
+        {"stimulus": [], "texture": {}},  # wrong type
+        {"stimulus": {"angle": "up"}, "texture": {}},  # field deep in the message
+        {"stimulus": {}, "texture": [{"texture_name": 3}]},
+        {"stimulus": {}, "texture": {}, "priority": "high"},
+        "not a dict",
+    ],
+)
+def test_schema_on_decode(data):
+    # typed under an unregistered topic, then relabelled as stim
+    frame = retyped(utils.encode_message("unregistered", data), "stim")
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame)
+
+
+def test_malformed_frames():
+    frame = utils.encode_message("stim", monocular_stim)
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame[:-3])  # truncated
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame + b"\x00")  # trailing bytes
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(frame[:4])  # not even a header
+    unknown_type = bytearray(utils.encode_message("move", 3))
+    unknown_type[utils.wire_header.size] = ord("Z")
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(bytes(unknown_type))
+    newer = bytearray(frame)
+    newer[2] = utils.WIRE_VERSION + 1
+    with pytest.raises(utils.WireFormatError):
+        utils.decode_message(bytes(newer))
+
+
+def test_array_frames():
+    array = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    header = {"name": "noise", "shape": list(array.shape), "dtype": str(array.dtype)}
+    frames = [b"texture", utils.encode_message("texture", header), array.tobytes()]
+    topic, data = utils.decode_frames(frames)
+    assert topic == "texture" and data["name"] == "noise"
+    assert np.array_equal(data["array"], array)
+
+
+def test_pickle_allowed_by_address():
+    assert not utils.pickle_allowed("tcp://10.0.0.1:5006")
+    assert utils.pickle_allowed("ipc:///tmp/pandastim")
+    assert utils.pickle_allowed("inproc://pandastim")
+    assert utils.pickle_allowed("tcp://localhost:5006", allow_pickle=True)
+    assert not utils.pickle_allowed("ipc:///tmp/pandastim", allow_pickle=False)
@@ -5,12 +5,19 @@ Helper functions used in multiple classes in stimulu/textures
 
 Part of pandastim package: https://github.com/mattdloring/pandastim
 """
+import atexit
+import collections
+import json
 import os
+import pickle
+import queue
+import struct
+import threading
+import time
+import weakref
 from datetime import datetime as dt
 
 import numpy as np
-import zmq
-from scipy import signal
 
 
 def sin_byte(X: np.array, freq: int = 1) -> np.array:
@@ -28,7 +35,8 @@ def grating_byte(X: np.array, freq: int = 1) -> np.array:
     """
     Unsigned 8 bit representation of a grating (square wave)
     """
-    grating_float = signal.square(X * freq)
+    # same as scipy.signal.square with a 50% duty cycle, without importing scipy
+    grating_float = np.where(np.mod(X * freq, 2 * np.pi) < np.pi, 1.0, -1.0)
 
     # from 0-255
     grating_transformed = (grating_float + 1) * 127.5
@@ -98,6 +106,207 @@ def saving(file_path: str, append=False, *other_info) -> object:
     return filestream
 
 
+class LogWriter:
+    """
+    Writes to a filestream from a background thread so disk i/o stays off the render loop
+
+    writes go through a bounded queue and are flushed in batches, whenever flush_size
+    writes have built up or flush_interval seconds have passed. close (also run at exit)
+    drains the queue and does a final flush. a write never blocks the caller: with the
+    queue full it is dropped, after close it is dropped, both are counted
+    """
+
+    _close = object()
+
+    def __init__(self, filestream, maxsize=10000, flush_interval=0.5, flush_size=256):
+        self.filestream = filestream
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        self._lock = threading.Lock()
+        self.dropped = 0  # queue full, the disk fell behind
+        self.closed_drops = 0  # written after close
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, data) -> bool:
+        """
+        :return: whether data was queued for the file
+        """
+        with self._lock:
+            if self._closed:
+                self.closed_drops += 1
+                return False
+            try:
+                self._queue.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            return True
+
+    def run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+
+            # take everything already waiting as one batch
+            batch = [] if item is None else [item]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is self._close:
+                    running = False
+                    continue
+                self.filestream.write(item)
+                pending += 1
+
+            now = time.monotonic()
+            if pending and (
+                pending >= self.flush_size
+                or now - last_flush >= self.flush_interval
+                or not running
+            ):
+                self.filestream.flush()
+                pending = 0
+                last_flush = now
+
+        self.filestream.flush()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(self._close)
+        self.thread.join()
+        self.filestream.close()
+
+
+class OutputWriter:
+    """
+    Sends (and prints) outbound messages off the render thread, so a slow or missing
+    subscriber or a slow console can't hold up the render loop
+
+    put hands over a send callable and/or console text. pending messages sit in a bounded
+    deque, when it is full the oldest are dropped. console lines are limited to
+    console_rate per second (None for no limit), the rest are counted and skipped.
+    with an asyncio loop (the buddy comms hub) the deque is drained on that loop,
+    otherwise on a thread of its own. anything put after close is counted and dropped
+    """
+
+    def __init__(self, maxsize=1000, console=True, console_rate=20, loop=None):
+        self.console = console
+        self.console_rate = console_rate
+        self.loop = loop
+
+        self._pending = collections.deque(maxlen=maxsize)
+        self._wake = threading.Event()
+        self._running = True
+        self._scheduled = False
+
+        self.sent = 0
+        self.dropped = 0  # pushed out of the deque before they were sent
+        self.send_failures = 0  # refused by the socket
+        self.suppressed = 0  # console lines over console_rate
+        self.closed_drops = 0  # put after close, nothing is left to send them
+
+        self._window_start = time.monotonic()
+        self._printed = 0
+        self._skipped = 0
+
+        self.thread = None
+        if loop is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, send=None, text=None):
+        if not self._running:
+            self.closed_drops += 1
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append((send, text if self.console else None))
+        if self.loop is None:
+            self._wake.set()
+        elif not self._scheduled:
+            self._scheduled = True
+            try:
+                self.loop.call_soon_threadsafe(self.drain)
+            except RuntimeError:
+                # the loop closed under us
+                self._pending.clear()
+                self.closed_drops += 1
+
+    def run(self):
+        while self._running or self._pending:
+            self._wake.wait(0.5)
+            self._wake.clear()
+            self.drain()
+
+    def drain(self):
+        self._scheduled = False
+        while self._pending:
+            send, text = self._pending.popleft()
+            if send is not None:
+                try:
+                    send()
+                    self.sent += 1
+                except Exception:
+                    self.send_failures += 1
+
+            if text is None:
+                continue
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                if self._skipped:
+                    print(f"pandastim {dt.now()} ({self._skipped} console lines skipped)")
+                self._window_start = now
+                self._printed = 0
+                self._skipped = 0
+            if self.console_rate is None or self._printed < self.console_rate:
+                print(text)
+                self._printed += 1
+            else:
+                self._skipped += 1
+                self.suppressed += 1
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "pending": len(self._pending),
+            "dropped": self.dropped,
+            "send_failures": self.send_failures,
+            "suppressed": self.suppressed,
+            "closed_drops": self.closed_drops,
+        }
+
+    def close(self):
+        if not self._running:
+            return
+        self._running = False
+        if self.thread is not None:
+            self._wake.set()
+            self.thread.join()
+        elif not self.loop.is_closed():
+            done = threading.Event()
+            self.loop.call_soon_threadsafe(lambda: (self.drain(), done.set()))
+            done.wait(1)
+
+
 def create_tex(input_tex_dict: dict):
     """
     this one works with the tex_ flag header
@@ -253,39 +462,592 @@ def packageLiteStim(stimDetails):
             print(f"{type(stimDetails).__name__} stimulus type not understood")
 
 
+# compact wire format for stim/move/event messages
+#   fixed header: magic, version, message type, flags, payload length
+#   payload: one typed value, dicts/lists/tuples nest typed values
+# pickle stays as a fallback, decode_message tells them apart by the magic. pickles only
+# decode where the receiver opted in (allow_pickle), anything else is a WireFormatError
+WIRE_MAGIC = b"PS"
+WIRE_VERSION = 1
+WIRE_PICKLED = 1  # header flag, payload is a pickle
+
+wire_header = struct.Struct("<2sBBBxI")
+wire_types = {
+    "stim": 1,
+    "move": 2,
+    "event": 3,
+    "protocol": 4,
+    "texture": 5,
+    "clockPing": 6,
+    "clockEcho": 7,
+    "ack": 8,
+    "credits": 9,
+    "feedback": 10,
+}
+wire_schemas = {
+    "stim": {"stimulus": dict, "texture": (dict, list, tuple)},
+    "protocol": {"textures": list, "stimuli": list},
+    "move": {},
+    "event": {"message": str},
+    "texture": {"name": str, "shape": (list, tuple), "dtype": str},
+    "clockPing": {"id": int, "t0": int},
+    "clockEcho": {"id": int, "t0": int, "t1": int, "t2": int},
+    "ack": {"id": int, "state": str, "credits": int},
+    "credits": {},
+    "feedback": {},
+}
+
+# value types of known fields, checked wherever they turn up in a schema'd message
+_number = (int, float, np.integer, np.floating)
+_per_layer = _number + (list, tuple)  # one value, or one per binocular side
+wire_fields = {
+    "stim_name": str,
+    "angle": _per_layer,
+    "velocity": _per_layer,
+    "stationary_time": _per_layer,
+    "duration": _per_layer,
+    "hold_after": _per_layer + (type(None),),
+    "texture_name": str,
+    "texture_size": (int, list, tuple),
+    "frequency": _per_layer,
+    "priority": int,
+    "id": (int, type(None)),
+    "name": str,
+    "dtype": str,
+    "shape": (list, tuple),
+    "message": str,
+    "state": str,
+    "credits": int,
+    "frame": int,
+    "gain": _number,
+}
+
+# dict keys found in stimulus/texture dicts go over as a single byte (0x80 | index)
+# append only -- reordering breaks decoding of older messages
+wire_keys = (
+    "stimulus",
+    "texture",
+    "stim_name",
+    "angle",
+    "velocity",
+    "stationary_time",
+    "duration",
+    "hold_after",
+    "strip_width",
+    "position",
+    "strip_angle",
+    "masking",
+    "transparency",
+    "texture_size",
+    "texture_name",
+    "frequency",
+    "light_value",
+    "dark_value",
+    "color",
+    "circle_center",
+    "circle_radius",
+    "bg_intensity",
+    "fg_intensity",
+    "spacing",
+    "value",
+    "phase",
+    "period",
+    "message",
+    "time",
+    "priority",
+    "id",
+    "textures",
+    "stimuli",
+    "name",
+    "shape",
+    "dtype",
+    "t0",
+    "t1",
+    "t2",
+    "time_ns",
+    "remote_ns",
+    "columns",
+    "state",
+    "credits",
+    "frame",
+    "gain",
+)
+_wire_key_ids = {k: bytes([0x80 | n]) for n, k in enumerate(wire_keys)}
+
+_int32 = struct.Struct("<i")
+_int = struct.Struct("<q")
+_float = struct.Struct("<d")
+_len32 = struct.Struct("<I")
+_len16 = struct.Struct("<H")
+
+
+class WireFormatError(ValueError):
+    """
+    a message that doesn't decode: malformed, failing its schema, or a pickle where
+    pickles aren't allowed
+    """
+
+
+def _container(kind: bytes, n: int) -> bytes:
+    # lower case kinds carry a u16 length, upper case a u32 one for longer containers
+    if n < 0x10000:
+        return kind + _len16.pack(n)
+    return kind.upper() + _len32.pack(n)
+
+
+def _encode_value(value, out: bytearray):
+    if value is None:
+        out += b"N"
+    elif isinstance(value, (bool, np.bool_)):
+        out += b"?" + (b"\x01" if value else b"\x00")
+    elif isinstance(value, (int, np.integer)):
+        if -(2**31) <= value < 2**31:
+            out += b"i" + _int32.pack(int(value))
+        else:
+            out += b"q" + _int.pack(int(value))
+    elif isinstance(value, (float, np.floating)):
+        out += b"d" + _float.pack(float(value))
+    elif isinstance(value, str):
+        encoded = value.encode()
+        out += b"s" + _len32.pack(len(encoded)) + encoded
+    elif isinstance(value, bytes):
+        out += b"b" + _len32.pack(len(value)) + value
+    elif isinstance(value, (tuple, list)):
+        out += _container(b"t" if isinstance(value, tuple) else b"l", len(value))
+        for v in value:
+            _encode_value(v, out)
+    elif isinstance(value, dict):
+        out += _container(b"m", len(value))
+        for k, v in value.items():
+            if k in _wire_key_ids:
+                out += _wire_key_ids[k]
+            else:
+                if not isinstance(k, str):
+                    raise TypeError(f"dict key {k!r} is not a str")
+                key = k.encode()
+                if len(key) >= 0x80:
+                    raise TypeError(f"dict key {k} too long for the wire format")
+                out += bytes([len(key)]) + key
+            _encode_value(v, out)
+    else:
+        raise TypeError(f"{type(value).__name__} has no wire type")
+
+
+def _decode_value(buffer, offset):
+    kind = bytes(buffer[offset : offset + 1])
+    offset += 1
+    match kind:
+        case b"N":
+            return None, offset
+        case b"?":
+            return buffer[offset] == 1, offset + 1
+        case b"i":
+            return _int32.unpack_from(buffer, offset)[0], offset + _int32.size
+        case b"q":
+            return _int.unpack_from(buffer, offset)[0], offset + _int.size
+        case b"d":
+            return _float.unpack_from(buffer, offset)[0], offset + _float.size
+        case b"s" | b"b":
+            (n,) = _len32.unpack_from(buffer, offset)
+            offset += _len32.size
+            raw = bytes(buffer[offset : offset + n])
+            return (raw.decode() if kind == b"s" else raw), offset + n
+        case b"t" | b"l" | b"T" | b"L":
+            length = _len16 if kind.islower() else _len32
+            (n,) = length.unpack_from(buffer, offset)
+            offset += length.size
+            values = []
+            for _ in range(n):
+                v, offset = _decode_value(buffer, offset)
+                values.append(v)
+            return (tuple(values) if kind in b"tT" else values), offset
+        case b"m" | b"M":
+            length = _len16 if kind == b"m" else _len32
+            (n,) = length.unpack_from(buffer, offset)
+            offset += length.size
+            values = {}
+            for _ in range(n):
+                key_len = buffer[offset]
+                if key_len & 0x80:
+                    key = wire_keys[key_len & 0x7F]
+                    offset += 1
+                else:
+                    key = bytes(buffer[offset + 1 : offset + 1 + key_len]).decode()
+                    offset += 1 + key_len
+                values[key], offset = _decode_value(buffer, offset)
+            return values, offset
+        case _:
+            raise WireFormatError(f"unknown wire type {kind}")
+
+
+def _check_schema(topic, data, fields=True):
+    """
+    the topic's required keys and their types, then (on decode) every known field's type
+    """
+    schema = wire_schemas.get(topic)
+    if schema is None:
+        return
+    if schema and not isinstance(data, dict):
+        raise WireFormatError(f"{topic} message must be a dict")
+    for key, expected in schema.items():
+        if key not in data:
+            raise WireFormatError(f"{topic} message must provide {key}")
+        if not isinstance(data[key], expected):
+            raise WireFormatError(f"{topic} {key} must be type: {expected}")
+    if fields:
+        _check_fields(topic, data)
+
+
+def _check_fields(topic, value):
+    if isinstance(value, dict):
+        for key, v in value.items():
+            expected = wire_fields.get(key)
+            if expected is not None and not isinstance(v, expected):
+                raise WireFormatError(f"{topic} {key} must be type: {expected}")
+            _check_fields(topic, v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _check_fields(topic, v)
+
+
+_wire_topics = {v: k for k, v in wire_types.items()}
+
+
+def encode_message(topic: str, data) -> bytes:
+    """
+    encodes data in the binary wire format, falls back to pickle for anything untyped
+    (only receivers with allow_pickle can read those)
+    """
+    msg_type = wire_types.get(topic, 0)
+    flags = 0
+    payload = bytearray()
+    try:
+        _check_schema(topic, data, fields=False)
+        _encode_value(data, payload)
+    except (TypeError, WireFormatError, struct.error):
+        payload = pickle.dumps(data)
+        flags |= WIRE_PICKLED
+    return (
+        wire_header.pack(WIRE_MAGIC, WIRE_VERSION, msg_type, flags, len(payload))
+        + payload
+    )
+
+
+def decode_message(frame, allow_pickle=False):
+    """
+    decodes a wire format frame
+
+    pickles (plain send_pyobj frames or wire frames with WIRE_PICKLED) run code on load,
+    they are only decoded with allow_pickle -- for trusted, same host peers
+    """
+    buffer = memoryview(frame)
+    if bytes(buffer[:2]) != WIRE_MAGIC:
+        if not allow_pickle:
+            raise WireFormatError("not wire format, pickles need allow_pickle")
+        return pickle.loads(buffer)
+
+    if len(buffer) < wire_header.size:
+        raise WireFormatError("truncated wire header")
+    magic, version, msg_type, flags, length = wire_header.unpack_from(buffer, 0)
+    if version > WIRE_VERSION:
+        raise WireFormatError(f"wire version {version} is newer than {WIRE_VERSION}")
+    payload = buffer[wire_header.size :]
+    if len(payload) != length:
+        raise WireFormatError(f"wire payload length {len(payload)}, expected {length}")
+    if flags & WIRE_PICKLED:
+        if not allow_pickle:
+            raise WireFormatError("pickled wire message, pickles need allow_pickle")
+        return pickle.loads(payload)
+
+    try:
+        data, end = _decode_value(payload, 0)
+    except (struct.error, IndexError, UnicodeDecodeError, RecursionError) as e:
+        raise WireFormatError(f"malformed wire message: {e}") from e
+    if end != length:
+        raise WireFormatError(f"{length - end} bytes left over in the wire message")
+
+    topic = _wire_topics.get(msg_type)
+    if topic:
+        _check_schema(topic, data)
+    return data
+
+
+def decode_frames(frames, allow_pickle=False):
+    """
+    topic + payload frames (zmq.Frame, copy=False, or plain bytes) to (topic, data)
+    a third frame is a raw array (see Publisher.send_array), wrapped without copying
+    """
+    frames = [getattr(frame, "buffer", frame) for frame in frames]
+    data = decode_message(frames[1], allow_pickle=allow_pickle)
+    if len(frames) > 2:
+        data["array"] = np.frombuffer(frames[2], dtype=data["dtype"]).reshape(
+            data["shape"]
+        )
+    return bytes(frames[0]).decode(), data
+
+
+def package_protocol(stimuli, priority=0) -> dict:
+    """
+    packs a list of monocular/binocular stimuli into one "protocol" message
+
+    textures are deduplicated into a shared table, each stimulus keeps only indices
+    """
+    textures = []
+    texture_ids = {}
+
+    def texture_index(tex_dict):
+        key = repr(sorted(tex_dict.items()))
+        if key not in texture_ids:
+            texture_ids[key] = len(textures)
+            textures.append(tex_dict)
+        return texture_ids[key]
+
+    packed = []
+    for stim in stimuli:
+        stim_dict = stim.return_dict()
+        if isinstance(stim_dict["texture"], dict):
+            tex = texture_index(stim_dict["texture"])
+        else:
+            tex = [texture_index(t) for t in stim_dict["texture"]]
+        packed.append({"stimulus": stim_dict["stimulus"], "texture": tex})
+
+    return {"textures": textures, "stimuli": packed, "priority": priority}
+
+
+class StimulusRegistry:
+    """
+    gives each distinct stimulus an integer id so events can carry the id instead of the
+    full return_dict. the same class works on the receiving end, learn the parameters as
+    they are published and look ids back up
+
+    stimuli get registered from the hub thread (receipts) and the render thread (saving)
+    at once, a lock keeps an id from being handed out twice
+    """
+
+    def __init__(self):
+        self.params = {}  # stim id -> return_dict
+        self._ids = {}  # parameter key -> stim id
+        # stimulus -> stim id, skips return_dict for known stimuli without keeping them alive
+        self._stimuli = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def register(self, stimulus):
+        """
+        :return: stim id, whether it was new
+        """
+        with self._lock:
+            try:
+                return self._stimuli[stimulus], False
+            except (KeyError, TypeError):
+                pass
+
+        params = stimulus.return_dict()
+        key = json.dumps(params, sort_keys=True, default=str)
+        with self._lock:
+            new = key not in self._ids
+            if new:
+                self._ids[key] = len(self._ids)
+                self.params[self._ids[key]] = json.loads(key)
+            try:
+                self._stimuli[stimulus] = self._ids[key]
+            except TypeError:
+                pass
+            return self._ids[key], new
+
+    def learn(self, stim_id, params):
+        with self._lock:
+            self.params[int(stim_id)] = params
+
+    def lookup(self, stim_id):
+        with self._lock:
+            return self.params.get(int(stim_id))
+
+    def items(self):
+        """
+        copy of (stim id, return_dict) pairs, safe to iterate while others register
+        """
+        with self._lock:
+            return list(self.params.items())
+
+    def __len__(self):
+        return len(self.params)
+
+
+def pickle_allowed(address, allow_pickle=None) -> bool:
+    """
+    allow_pickle as given, by default pickles are only read off ipc/inproc addresses
+    """
+    if allow_pickle is None:
+        return not address.startswith("tcp://")
+    return allow_pickle
+
+
+class WeakIdentityMap:
+    """
+    a weakref.WeakKeyDictionary by identity: stimulus details are frozen dataclasses
+    that hash and compare by value, but a protocol repeating a stimulus still holds
+    distinct objects. entries go when their key is collected, so a reused id() never
+    finds them, on_collect(value) hears about those that weren't popped first
+    """
+
+    def __init__(self, on_collect=None):
+        self._items = {}  # id(key) -> (weakref to key, value)
+        self.on_collect = on_collect
+
+    def __setitem__(self, key, value):
+        key_id = id(key)
+        items = self._items
+        on_collect = self.on_collect
+
+        def collected(ref):
+            item = items.get(key_id)
+            if item is not None and item[0] is ref:
+                del items[key_id]
+                if on_collect is not None:
+                    on_collect(item[1])
+
+        items[key_id] = (weakref.ref(key, collected), value)
+
+    def _item(self, key):
+        item = self._items.get(id(key))
+        if item is None or item[0]() is not key:
+            return None
+        return item
+
+    def get(self, key, default=None):
+        item = self._item(key)
+        return default if item is None else item[1]
+
+    def pop(self, key, default=None):
+        item = self._item(key)
+        if item is None:
+            return default
+        self._items.pop(id(key), None)
+        return item[1]
+
+    def __getitem__(self, key):
+        item = self._item(key)
+        if item is None:
+            raise KeyError(key)
+        return item[1]
+
+    def __contains__(self, key):
+        return self._item(key) is not None
+
+    def __len__(self):
+        return len(self._items)
+
+
 class Subscriber:
     """
     Subscriber wrapper class for zmq.
     Default topic is every topic ("").
+    Pass a context to share one between sockets, shared contexts are left open on kill.
+    Pickled messages are rejected over tcp unless allow_pickle is set (decode_message)
+    conflate keeps only the newest message, for Publisher.send_latest (recv_latest)
     """
 
-    def __init__(self, port="1234", topic="", ip=None):
+    def __init__(
+        self,
+        port="1234",
+        topic="",
+        ip=None,
+        context=None,
+        allow_pickle=None,
+        conflate=False,
+    ):
+        import zmq
+
         self.port = port
         self.topic = topic
-        self.context = zmq.Context()
+        self._own_context = context is None
+        self.context = context or zmq.Context()
         self.socket = self.context.socket(zmq.SUB)
-        if ip is not None:
-            self.socket.connect(ip + str(self.port))
-        else:
-            self.socket.connect("tcp://localhost:" + str(self.port))
+        if conflate:
+            # has to be set before connecting
+            self.socket.setsockopt(zmq.CONFLATE, 1)
+        address = (ip if ip is not None else "tcp://localhost:") + str(self.port)
+        self.allow_pickle = pickle_allowed(address, allow_pickle)
+        self.socket.connect(address)
         self.socket.subscribe(self.topic)
 
+    def recv_message(self):
+        """
+        receives a topic + payload message in either the wire format or pickle
+
+        a third frame is a raw array (see Publisher.send_array), it is wrapped as
+        data["array"] straight from the zmq buffer without copying
+        """
+        return decode_frames(
+            self.socket.recv_multipart(copy=False), allow_pickle=self.allow_pickle
+        )
+
+    def recv_latest(self, timeout=0):
+        """
+        the single frame message waiting (Publisher.send_latest), None if there isn't
+        one within timeout ms
+        """
+        if not self.socket.poll(timeout):
+            return None
+        return decode_message(
+            self.socket.recv(copy=False).buffer, allow_pickle=self.allow_pickle
+        )
+
     def kill(self):
         self.socket.close()
-        self.context.term()
+        if self._own_context:
+            self.context.term()
 
 
 class Publisher:
     """
     Publisher wrapper class for zmq.
+    Pass a context to share one between sockets, shared contexts are left open on kill.
     """
 
-    def __init__(self, port="1234"):
+    def __init__(self, port="1234", context=None, sndhwm=None):
+        import zmq
+
         self.port = port
-        self.context = zmq.Context()
+        self._own_context = context is None
+        self.context = context or zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
+        if sndhwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, sndhwm)
         self.socket.bind("tcp://*:" + self.port)
 
+    def send_message(self, topic, data, binary=True, flags=0):
+        """
+        sends a topic + payload message, binary uses the wire format, otherwise pickle
+        """
+        payload = encode_message(topic, data) if binary else pickle.dumps(data)
+        self.socket.send_multipart([topic.encode(), payload], flags=flags)
+
+    def send_pyobj(self, obj, flags=0):
+        """
+        a single pickled frame, how buddy events have always gone out (recv_pyobj)
+        """
+        self.socket.send_pyobj(obj, flags=flags)
+
+    def send_latest(self, topic, data, flags=0):
+        """
+        sends data as a single wire format frame, for CONFLATE subscribers (which only keep
+        the newest message and can't take multipart ones) on a port of their own
+        """
+        self.socket.send(encode_message(topic, data), flags=flags)
+
+    def send_array(self, topic, array, name, flags=0, **extra):
+        """
+        sends an array as a small header (name, shape, dtype and any extra fields) plus its
+        raw buffer, zmq sends the buffer without copying it
+        """
+        array = np.ascontiguousarray(array)
+        header = {"name": name, "shape": list(array.shape), "dtype": str(array.dtype), **extra}
+        self.socket.send_multipart(
+            [topic.encode(), encode_message(topic, header), array], flags=flags, copy=False
+        )
+
     def kill(self):
         self.socket.close()
-        self.context.term()
+        if self._own_context:
+            self.context.term()